@@ -0,0 +1,67 @@
+"""
+Micro-benchmark for matching source_file_dependencies against a large file diff.
+
+Usage: python -m scripts.benchmarks.bench_dependency_index
+"""
+import random
+import timeit
+from typing import List
+
+from scripts.pipeline_generator.dependency_index import DependencyIndex
+from scripts.pipeline_generator.step import TestStep
+
+NUM_STEPS = 200
+NUM_FILES = 10000
+DIRECTORIES = ["vllm", "tests", "csrc", "benchmarks", "docs", "examples"]
+SUBDIRECTORIES = ["lora", "engine", "model_executor", "attention", "distributed", "core", "entrypoints", "kernels"]
+
+
+def _random_path(rng: random.Random, depth: int) -> str:
+    parts = [rng.choice(DIRECTORIES)] + [rng.choice(SUBDIRECTORIES) for _ in range(depth - 1)]
+    return "/".join(parts)
+
+
+def get_synthetic_test_steps(rng: random.Random) -> List[TestStep]:
+    return [
+        TestStep(
+            label=f"Test {i}",
+            command="pytest",
+            source_file_dependencies=[f"{_random_path(rng, rng.randint(2, 3))}/" for _ in range(rng.randint(1, 6))],
+        )
+        for i in range(NUM_STEPS)
+    ]
+
+
+def get_synthetic_file_diff(rng: random.Random) -> List[str]:
+    # Large refactors touch a few subtrees, so most steps stay blocked and must scan the whole diff.
+    touched = [_random_path(rng, 2) for _ in range(3)]
+    return [f"{rng.choice(touched)}/module_{i % 100}/file_{i}.py" for i in range(NUM_FILES)]
+
+
+def naive_match(test_steps: List[TestStep], list_file_diff: List[str]):
+    return {
+        step.label for step in test_steps
+        if any(source_file in file for source_file in step.source_file_dependencies for file in list_file_diff)
+    }
+
+
+def main():
+    rng = random.Random(0)
+    test_steps = get_synthetic_test_steps(rng)
+    list_file_diff = get_synthetic_file_diff(rng)
+
+    index = DependencyIndex(test_steps)
+    assert index.match(list_file_diff) == naive_match(test_steps, list_file_diff)
+
+    runs = 5
+    naive_time = timeit.timeit(lambda: naive_match(test_steps, list_file_diff), number=runs) / runs
+    build_time = timeit.timeit(lambda: DependencyIndex(test_steps), number=runs) / runs
+    match_time = timeit.timeit(lambda: index.match(list_file_diff), number=runs) / runs
+    print(f"{NUM_STEPS} steps, {len(list_file_diff)} changed files, {len(index.match(list_file_diff))} steps matched")
+    print(f"naive substring scan: {naive_time * 1000:.1f} ms")
+    print(f"index build:          {build_time * 1000:.1f} ms")
+    print(f"index match:          {match_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
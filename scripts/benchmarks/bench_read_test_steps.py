@@ -0,0 +1,55 @@
+"""
+Benchmark reading a synthetic 1000-step test pipeline yaml.
+
+Usage: python -m scripts.benchmarks.bench_read_test_steps
+"""
+import os
+import random
+import tempfile
+import timeit
+from typing import List
+
+import yaml
+
+from scripts.pipeline_generator.pipeline_generator import read_test_steps
+from scripts.pipeline_generator.step import TestStep
+
+NUM_STEPS = 1000
+
+
+def get_synthetic_test_pipeline(rng: random.Random) -> dict:
+    steps = []
+    for i in range(NUM_STEPS):
+        step = {
+            "label": f"Test {i}",
+            "source_file_dependencies": [f"vllm/module_{i}/", f"tests/test_{i}"],
+            "commands": [f"pytest -v -s test_{i}/test_a.py", f"pytest -v -s test_{i}/test_b.py"],
+        }
+        step.update(rng.choice([{"no_gpu": True}, {"num_gpus": 1}, {"num_gpus": 4}, {"gpu": "a100", "num_gpus": 2}]))
+        steps.append(step)
+    return {"steps": steps}
+
+
+def read_test_steps_pure_python(file_path: str) -> List[TestStep]:
+    with open(file_path, "r") as f:
+        content = yaml.safe_load(f)
+    return [TestStep(**step) for step in content["steps"]]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        test_path = os.path.join(temp_dir, "test-pipeline.yaml")
+        with open(test_path, "w") as f:
+            yaml.safe_dump(get_synthetic_test_pipeline(random.Random(0)), f, sort_keys=False)
+        assert read_test_steps(test_path) == read_test_steps_pure_python(test_path)
+
+        runs = 5
+        pure_python_time = timeit.timeit(lambda: read_test_steps_pure_python(test_path), number=runs) / runs
+        read_time = timeit.timeit(lambda: read_test_steps(test_path), number=runs) / runs
+    print(f"{NUM_STEPS} steps, libyaml: {yaml.__with_libyaml__}")
+    print(f"safe_load + per-step validation: {pure_python_time * 1000:.1f} ms")
+    print(f"read_test_steps:                 {read_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Cold-start benchmark for the pipeline generator entry point based on `python -X importtime`.
+
+Only the self time of the pipeline generator's own modules (including model class construction)
+is counted against the budget, since third-party import time depends on the installed versions.
+Exits with a non-zero status if the median over several fresh interpreters exceeds the budget.
+
+Usage: python -m scripts.benchmarks.bench_startup [--budget_ms 60]
+"""
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+import click
+
+ENTRY_POINT_MODULE = "scripts.pipeline_generator.pipeline_generator"
+PACKAGE_PREFIX = "scripts.pipeline_generator"
+DEFAULT_BUDGET_MS = 60
+NUM_RUNS = 7
+# Set by bootstrap.sh and the zipapp entry point
+STARTUP_ENV = {"PYDANTIC_DISABLE_PLUGINS": "1", "PYDANTIC_SKIP_VALIDATING_CORE_SCHEMAS": "1"}
+
+
+def get_import_times() -> Dict[str, int]:
+    """Return self import time in microseconds per module, from a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {ENTRY_POINT_MODULE}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, **STARTUP_ENV},
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, _, module = line[len("import time:"):].split("|")
+        import_times[module.strip()] = int(self_time)
+    return import_times
+
+
+def get_median_import_times(num_runs: int = NUM_RUNS) -> Tuple[float, float]:
+    """Median import time in milliseconds of the package's own modules, and of all modules."""
+    package_times = []
+    total_times = []
+    for _ in range(num_runs):
+        import_times = get_import_times()
+        package_times.append(sum(t for module, t in import_times.items() if module.startswith(PACKAGE_PREFIX)) / 1000)
+        total_times.append(sum(import_times.values()) / 1000)
+    return statistics.median(package_times), statistics.median(total_times)
+
+
+@click.command()
+@click.option("--budget_ms", type=float, default=DEFAULT_BUDGET_MS, help="Maximum median import time of the package")
+def main(budget_ms: float):
+    package_time, total_time = get_median_import_times()
+    click.echo(f"total import time:   {total_time:.1f} ms")
+    click.echo(f"package import time: {package_time:.1f} ms (budget {budget_ms:.0f} ms)")
+    if package_time > budget_ms:
+        click.echo("Startup time is over budget", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
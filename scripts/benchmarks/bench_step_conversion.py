@@ -0,0 +1,57 @@
+"""
+Benchmark converting a 500-step pipeline with and without memoized plugin configs.
+
+Usage: python -m scripts.benchmarks.bench_step_conversion
+"""
+import random
+import timeit
+import warnings
+from typing import List
+from unittest import mock
+
+from scripts.pipeline_generator.pipeline_generator import PipelineGenerator, PipelineGeneratorConfig
+from scripts.pipeline_generator.plugin import get_docker_plugin_config, get_kubernetes_plugin_config
+from scripts.pipeline_generator.step import TestStep
+
+NUM_STEPS = 500
+TEST_COMMIT = "abcdef0123456789abcdef0123456789abcdef01"
+HELPER_MODULE = "scripts.pipeline_generator.pipeline_generator_helper"
+
+
+def get_synthetic_test_steps(rng: random.Random) -> List[TestStep]:
+    test_steps = []
+    for i in range(NUM_STEPS):
+        hardware = rng.choice([{"no_gpu": True}, {"num_gpus": 1}, {"num_gpus": 4}, {"gpu": "a100", "num_gpus": 2}])
+        test_steps.append(TestStep(
+            label=f"Test {i}",
+            commands=[f"pytest -v -s test_{i}/test_a.py", f"pytest -v -s test_{i}/test_b.py"],
+            source_file_dependencies=[f"vllm/module_{i}/"],
+            **hardware,
+        ))
+    return test_steps
+
+
+def main():
+    warnings.simplefilter("ignore")
+    test_steps = get_synthetic_test_steps(random.Random(0))
+    generator = PipelineGenerator(PipelineGeneratorConfig(
+        container_registry="registry",
+        container_registry_repo="repo",
+        commit=TEST_COMMIT,
+        list_file_diff=[],
+        run_all=True,
+    ))
+    runs = 20
+
+    with mock.patch(f"{HELPER_MODULE}.get_docker_plugin_config", get_docker_plugin_config.__wrapped__), \
+            mock.patch(f"{HELPER_MODULE}.get_kubernetes_plugin_config", get_kubernetes_plugin_config.__wrapped__):
+        unmemoized_time = timeit.timeit(lambda: generator.generate_test_steps(test_steps), number=runs) / runs
+    memoized_time = timeit.timeit(lambda: generator.generate_test_steps(test_steps), number=runs) / runs
+
+    print(f"{NUM_STEPS} steps")
+    print(f"plugin configs built per step: {unmemoized_time * 1000:.1f} ms")
+    print(f"plugin configs memoized:       {memoized_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Benchmark writing a 500-step pipeline with a single pure-Python yaml.dump versus the streaming writer.
+
+Usage: python -m scripts.benchmarks.bench_write_buildkite_steps
+"""
+import os
+import random
+import tempfile
+import timeit
+import warnings
+
+import yaml
+
+from scripts.benchmarks.bench_step_conversion import TEST_COMMIT, get_synthetic_test_steps
+from scripts.pipeline_generator.pipeline_generator import PipelineGenerator, PipelineGeneratorConfig, write_buildkite_steps
+
+
+def write_single_dump(steps, file_path: str) -> None:
+    buildkite_steps_dict = {"steps": [step.model_dump(exclude_none=True) for step in steps]}
+    with open(file_path, "w") as f:
+        yaml.dump(buildkite_steps_dict, f, sort_keys=False)
+
+
+def main():
+    warnings.simplefilter("ignore")
+    generator = PipelineGenerator(PipelineGeneratorConfig(
+        container_registry="registry",
+        container_registry_repo="repo",
+        commit=TEST_COMMIT,
+        list_file_diff=[],
+    ))
+    steps = generator.generate(get_synthetic_test_steps(random.Random(0)))
+    runs = 5
+    with tempfile.TemporaryDirectory() as temp_dir:
+        single_dump_path = os.path.join(temp_dir, "single.yaml")
+        streaming_path = os.path.join(temp_dir, "streaming.yaml")
+        single_dump_time = timeit.timeit(lambda: write_single_dump(steps, single_dump_path), number=runs) / runs
+        streaming_time = timeit.timeit(lambda: write_buildkite_steps(steps, streaming_path), number=runs) / runs
+        with open(single_dump_path, "rb") as f1, open(streaming_path, "rb") as f2:
+            assert f1.read() == f2.read()
+    print(f"{len(steps)} steps, libyaml: {yaml.__with_libyaml__}")
+    print(f"single yaml.dump: {single_dump_time * 1000:.1f} ms")
+    print(f"streaming writer: {streaming_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
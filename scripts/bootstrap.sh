@@ -14,102 +14,87 @@ if [[ -z "${VLLM_CI_BRANCH:-}" ]]; then
     VLLM_CI_BRANCH="main"
 fi
 
-upload_pipeline() {
-    echo "Uploading pipeline..."
-    # Install minijinja
-    ls .buildkite || buildkite-agent annotate --style error 'Please merge upstream main branch for buildkite CI'
-    curl -sSfL https://github.com/mitsuhiko/minijinja/releases/download/2.3.1/minijinja-cli-installer.sh | sh
-    source /var/lib/buildkite-agent/.cargo/env
-
-    # If pipeline is fastcheck
-    if [[ $BUILDKITE_PIPELINE_SLUG == "fastcheck" ]]; then
-        curl -o .buildkite/test-template.j2 https://raw.githubusercontent.com/vllm-project/ci-infra/"$VLLM_CI_BRANCH"/scripts/test-template-fastcheck.j2
+# Release of the prebuilt pipeline generator (scripts/build-pipeline-generator.sh) that builds of main run
+PIPELINE_GENERATOR_VERSION="pipeline-generator-v1"
+PIPELINE_GENERATOR_CACHE_DIR="${PIPELINE_GENERATOR_CACHE_DIR:-$HOME/.cache/vllm-ci}"
+
+# Empty when the script is piped to bash
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]:-.}")" && pwd)
+
+# Import path of the pipeline_generator package: the one next to this script in a checkout of
+# vllm-project/ci-infra, otherwise the prebuilt release, downloaded once per agent.
+# Builds testing another VLLM_CI_BRANCH download the package of that branch.
+get_generator_path() {
+    if [[ -d "$script_dir/pipeline_generator" ]]; then
+        echo "$script_dir"
+        return
     fi
+    if [[ "$VLLM_CI_BRANCH" != "main" ]]; then
+        local generator_dir
+        generator_dir=$(mktemp -d)
+        curl -sSfL "https://github.com/vllm-project/ci-infra/archive/refs/heads/${VLLM_CI_BRANCH}.tar.gz" |
+            tar xz -C "$generator_dir" --strip-components=2 --wildcards "*/scripts/pipeline_generator"
+        echo "$generator_dir"
+        return
+    fi
+    local generator_path="$PIPELINE_GENERATOR_CACHE_DIR/$PIPELINE_GENERATOR_VERSION.pyz"
+    if [[ ! -f "$generator_path" ]]; then
+        mkdir -p "$PIPELINE_GENERATOR_CACHE_DIR"
+        curl -sSfL -o "$generator_path.$$" \
+            "https://github.com/vllm-project/ci-infra/releases/download/$PIPELINE_GENERATOR_VERSION/pipeline_generator.pyz"
+        mv "$generator_path.$$" "$generator_path"
+    fi
+    echo "$generator_path"
+}
 
-    # If pipeline is CI
-    if [[ $BUILDKITE_PIPELINE_SLUG == "ci" ]]; then
-        curl -o .buildkite/test-template.j2 https://raw.githubusercontent.com/vllm-project/ci-infra/"$VLLM_CI_BRANCH"/scripts/test-template-ci.j2?$(date +%s)
+# Agents usually have the dependencies already, pip takes seconds even when there is nothing to install
+install_dependencies() {
+    python -c "import click, pydantic, yaml" 2>/dev/null || python -m pip install click pydantic pyyaml
+}
+
+# Run a module of the pipeline generator at generator_path, the prebuilt release bundling its dependencies,
+# or a copy of the package.
+run_generator() {
+    local module=$1
+    shift
+    if [[ "$generator_path" == *.pyz ]]; then
+        PIPELINE_GENERATOR_CACHE_DIR="$PIPELINE_GENERATOR_CACHE_DIR" PIPELINE_GENERATOR_MAIN="$module" \
+            python "$generator_path" "$@"
+        return
     fi
+    install_dependencies
+    PYTHONPATH="$generator_path" python -m "$module" "$@"
+}
+
+upload_pipeline() {
+    echo "Uploading pipeline..."
+    ls .buildkite || buildkite-agent annotate --style error 'Please merge upstream main branch for buildkite CI'
 
     # (WIP) Use pipeline generator instead of jinja template
     if [ -e ".buildkite/pipeline_generator/pipeline_generator.py" ]; then
-        python -m pip install click pydantic
-        python .buildkite/pipeline_generator/pipeline_generator.py --run_all=$RUN_ALL --list_file_diff="$LIST_FILE_DIFF" --nightly="$NIGHTLY"
+        install_dependencies
+        # Skip pydantic's plugin discovery and the self-check of the schemas it builds, about half of our startup time
+        PYDANTIC_DISABLE_PLUGINS=1 PYDANTIC_SKIP_VALIDATING_CORE_SCHEMAS=1 \
+            python .buildkite/pipeline_generator/pipeline_generator.py --run_all=$RUN_ALL --nightly="$NIGHTLY"
         buildkite-agent pipeline upload .buildkite/pipeline.yaml
         exit 0
     fi
-    echo "List file diff: $LIST_FILE_DIFF"
     echo "Run all: $RUN_ALL"
     echo "Nightly: $NIGHTLY"
 
-    cd .buildkite
-    minijinja-cli test-template.j2 test-pipeline.yaml -D branch="$BUILDKITE_BRANCH" -D list_file_diff="$LIST_FILE_DIFF" -D run_all="$RUN_ALL" -D nightly="$NIGHTLY" > pipeline.yml
-    cat pipeline.yml
-    buildkite-agent pipeline upload pipeline.yml
+    echo "CI branch: $VLLM_CI_BRANCH"
+
+    # The CI and fastcheck pipelines, rendered by the pipeline generator of this repository.
+    # It diffs the branch and checks whether to run all tests itself.
+    generator_path=$(get_generator_path)
+    run_generator pipeline_generator.template_pipeline \
+        --pipeline "$BUILDKITE_PIPELINE_SLUG" \
+        --test_path .buildkite/test-pipeline.yaml \
+        --run_all="$RUN_ALL" \
+        --nightly="$NIGHTLY"
+    cat .buildkite/pipeline.yaml
+    buildkite-agent pipeline upload .buildkite/pipeline.yaml
     exit 0
 }
 
-get_diff() {
-    $(git add .)
-    echo $(git diff --name-only --diff-filter=ACMDR $(git merge-base origin/main HEAD))
-}
-
-get_diff_main() {
-    $(git add .)
-    echo $(git diff --name-only --diff-filter=ACMDR HEAD~1)
-}
-
-file_diff=$(get_diff)
-if [[ $BUILDKITE_BRANCH == "main" ]]; then
-    file_diff=$(get_diff_main)
-fi
-
-patterns=(
-    ".buildkite/test-pipeline"
-    "docker/Dockerfile"
-    "CMakeLists.txt"
-    "requirements/common.txt"
-    "requirements/cuda.txt"
-    "requirements/build.txt"
-    "requirements/test.txt"
-    "setup.py"
-    "csrc/"
-)
-
-ignore_patterns=(
-    "docker/Dockerfile."
-)
-
-for file in $file_diff; do
-    # First check if file matches any pattern
-    matches_pattern=0
-    for pattern in "${patterns[@]}"; do
-        if [[ $file == $pattern* ]] || [[ $file == $pattern ]]; then
-            matches_pattern=1
-            break
-        fi
-    done
-
-    # If file matches pattern, check it's not in ignore patterns
-    if [[ $matches_pattern -eq 1 ]]; then
-        matches_ignore=0
-        for ignore in "${ignore_patterns[@]}"; do
-            if [[ $file == $ignore* ]] || [[ $file == $ignore ]]; then
-                matches_ignore=1
-                break
-            fi
-        done
-
-        if [[ $matches_ignore -eq 0 ]]; then
-            RUN_ALL=1
-            echo "Found changes: $file. Run all tests"
-            break
-        fi
-    fi
-done
-
-LIST_FILE_DIFF=$(get_diff | tr ' ' '|')
-if [[ $BUILDKITE_BRANCH == "main" ]]; then
-    LIST_FILE_DIFF=$(get_diff_main | tr ' ' '|')
-fi
 upload_pipeline
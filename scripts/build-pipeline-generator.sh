@@ -0,0 +1,99 @@
+#!/bin/bash
+
+# Build the pipeline generator into a single precompiled file that runs with `python pipeline_generator.pyz`,
+# `PIPELINE_GENERATOR_MAIN=pipeline_generator.template_pipeline python pipeline_generator.pyz` for the template pipelines.
+# Its dependencies (click, pydantic, pyyaml) are bundled as installed for the Python building it, so build it
+# with the Python version of the agents. pydantic-core is a compiled extension that cannot be imported from a zip
+# archive, so the dependencies are extracted once per build, under PIPELINE_GENERATOR_CACHE_DIR (~/.cache/vllm-ci).
+
+set -euo pipefail
+
+output=${1:-pipeline_generator.pyz}
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+build_dir=$(mktemp -d)
+trap 'rm -rf "$build_dir"' EXIT
+
+cp -r "$script_dir/pipeline_generator" "$build_dir/"
+# Files of the installed distributions of the dependencies, and of theirs
+python - "$build_dir/_deps" <<"EOF"
+import importlib.metadata
+import os
+import re
+import shutil
+import sys
+
+deps_dir = sys.argv[1]
+pending, seen = ["click", "pydantic", "pyyaml"], set()
+while pending:
+    requirement = pending.pop()
+    try:
+        dist = importlib.metadata.distribution(re.match(r"[A-Za-z0-9._-]+", requirement).group())
+    except importlib.metadata.PackageNotFoundError:
+        # Requirements of other platforms and Python versions are not installed
+        if ";" in requirement:
+            continue
+        raise
+    name = dist.metadata["Name"].lower()
+    if name in seen:
+        continue
+    seen.add(name)
+    for requirement in dist.requires or []:
+        if "extra ==" not in requirement:
+            pending.append(requirement)
+    for file in dist.files or []:
+        if "__pycache__" in file.parts or file.parts[0] == "..":
+            continue
+        target = f"{deps_dir}/{file}"
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(file.locate(), target)
+print(f"Bundled {', '.join(sorted(seen))}")
+EOF
+build_id=$(cd "$build_dir/_deps" && find . -type f -print0 | sort -z | xargs -0 sha256sum | sha256sum | cut -c1-16)
+cat > "$build_dir/__main__.py" <<EOF
+import os
+import runpy
+import shutil
+import sys
+import zipfile
+
+BUILD_ID = "$build_id"
+EOF
+cat >> "$build_dir/__main__.py" <<"EOF"
+
+# Skip pydantic's plugin discovery and the self-check of the schemas it builds, about half of our startup time
+os.environ.setdefault("PYDANTIC_DISABLE_PLUGINS", "1")
+os.environ.setdefault("PYDANTIC_SKIP_VALIDATING_CORE_SCHEMAS", "1")
+
+
+def get_deps_dir() -> str:
+    """Directory of the bundled dependencies, extracted from the archive on the first run of this build."""
+    archive = os.path.dirname(os.path.abspath(__file__))
+    if not zipfile.is_zipfile(archive):
+        return os.path.join(archive, "_deps")
+    cache_dir = os.environ.get("PIPELINE_GENERATOR_CACHE_DIR") or os.path.expanduser("~/.cache/vllm-ci")
+    deps_dir = os.path.join(cache_dir, f"deps-{BUILD_ID}")
+    if not os.path.isdir(deps_dir):
+        temp_dir = f"{deps_dir}.{os.getpid()}.tmp"
+        with zipfile.ZipFile(archive) as zip_file:
+            for name in zip_file.namelist():
+                if name.startswith("_deps/"):
+                    zip_file.extract(name, temp_dir)
+        try:
+            os.rename(os.path.join(temp_dir, "_deps"), deps_dir)
+        except OSError:
+            # Extracted by a concurrent run meanwhile
+            pass
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return deps_dir
+
+
+sys.path.insert(0, get_deps_dir())
+runpy.run_module(os.environ.get("PIPELINE_GENERATOR_MAIN", "pipeline_generator.pipeline_generator"), run_name="__main__", alter_sys=True)
+EOF
+find "$build_dir" -name "__pycache__" -prune -exec rm -rf {} +
+# Bytecode next to the sources (-b) is what zipimport loads, so nothing is compiled at startup
+python -m compileall -q -b "$build_dir/pipeline_generator"
+python -m zipapp "$build_dir" \
+    --python "/usr/bin/env python3" \
+    --output "$output"
+echo "Built $output"
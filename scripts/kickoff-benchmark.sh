@@ -3,53 +3,44 @@
 # NOTE(simon): this script runs inside a buildkite agent with CPU only access.
 set -euo pipefail
 
-# install yq to merge yaml files
-(which tar) || (apt update && apt install -y tar)
-(which wget) || (apt update && apt install -y wget)
-
-# download yq binary
-rm -f yq_linux_amd64
-(wget https://github.com/mikefarah/yq/releases/download/v4.44.2/yq_linux_amd64.tar.gz -O - |\
-  tar xz)
-vllm_root_directory=$(pwd)
-
-# the final buildkite pipeline
-rm -f final.yaml
-touch final.yaml
-
-merge () {
-  # append $1 to final.yaml, and resolve anchors
-  $vllm_root_directory/yq_linux_amd64 -n "load(\"final.yaml\") *+ (load(\"$1\") | explode(.))" > temp.yaml
-  mv temp.yaml final.yaml
-}
-
+if [[ -z "${VLLM_CI_BRANCH:-}" ]]; then
+  VLLM_CI_BRANCH="main"
+fi
 
-# If BUILDKITE_PULL_REQUEST != "false", then we check the PR labels using curl and jq
-if [ "$BUILDKITE_PULL_REQUEST" != "false" ]; then
-  PR_LABELS=$(curl -s "https://api.github.com/repos/vllm-project/vllm/pulls/$BUILDKITE_PULL_REQUEST" | jq -r '.labels[].name')
+# Empty when the script is piped to bash
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]:-.}")" && pwd)
 
-  # put nightly benchmark in the front, as it contains a blocking step.
-  if [[ $PR_LABELS == *"nightly-benchmarks"* ]]; then
-    echo "This PR has the 'nightly-benchmark' label. Proceeding with the nightly benchmarks."
-    merge ".buildkite/nightly-benchmarks/nightly-pipeline.yaml"
+# Directory with the pipeline_generator package: the one next to this script in a checkout of
+# vllm-project/ci-infra, otherwise the one of its VLLM_CI_BRANCH branch, downloaded.
+get_generator_dir() {
+  if [[ -d "$script_dir/pipeline_generator" ]]; then
+    echo "$script_dir"
+    return
   fi
+  local generator_dir
+  generator_dir=$(mktemp -d)
+  curl -sSfL "https://github.com/vllm-project/ci-infra/archive/refs/heads/${VLLM_CI_BRANCH}.tar.gz" |
+    tar xz -C "$generator_dir" --strip-components=2 --wildcards "*/scripts/pipeline_generator"
+  echo "$generator_dir"
+}
 
-  if [[ $PR_LABELS == *"perf-benchmarks"* ]]; then
-    echo "This PR has the 'perf-benchmarks' label. Proceeding with the performance benchmarks."
-    merge ".buildkite/nightly-benchmarks/benchmark-pipeline.yaml"
-  fi
+python -c "import yaml" 2>/dev/null || python -m pip install pyyaml
 
-elif [ "$BUILDKITE_BRANCH" == "main" ]; then
-  echo "This is a build from a new commit on main branch. Proceeding with the performance benchmark."
-  merge ".buildkite/nightly-benchmarks/benchmark-pipeline.yaml"
-else
-  echo "Skipping performance benchmark."
-  exit 0
+# The benchmark pipelines selected by the PR labels, or by a build on main, merged into final.yaml.
+# Nightly benchmarks go first, as they contain a blocking step. With BENCHMARK_STORE set, the results are
+# added to that SQLite store and main commits that regress are annotated.
+rm -f final.yaml
+generator_dir=$(get_generator_dir)
+PYTHONPATH="$generator_dir" python -m pipeline_generator.benchmark_pipeline --output final.yaml \
+  ${BENCHMARK_STORE:+--benchmark_store "$BENCHMARK_STORE"}
+
+if [[ -s final.yaml && -n "${BENCHMARK_STORE:-}" ]]; then
+  # The store step of the pipeline runs this same copy of the generator
+  tar czf pipeline_generator.tar.gz -C "$generator_dir" --exclude __pycache__ pipeline_generator
+  buildkite-agent artifact upload pipeline_generator.tar.gz
 fi
 
-
 if [ -s final.yaml ]; then
   # final.yaml is not an empty file. Proceed with the pipeline upload.
   buildkite-agent pipeline upload final.yaml
 fi
-
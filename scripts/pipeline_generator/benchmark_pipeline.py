@@ -0,0 +1,225 @@
+"""
+Benchmark pipeline of a build: the benchmark pipelines selected by the PR labels, or by a build on main,
+merged into one Buildkite pipeline.
+
+Pipelines are merged as `yq '. *+ (load(file) | explode(.))'` did: mappings are merged deeply, lists are
+appended to and other values replaced, with anchors and aliases resolved. This runs on CPU agents that
+may only have PyYAML, so it only depends on it and the standard library.
+
+Usage: python3 -m pipeline_generator.benchmark_pipeline [--labels_file FILE | --github_api URL] --output final.yaml
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import sys
+import urllib.request
+from typing import Any, Dict, Iterable, List, Optional
+
+import yaml
+
+from .utils import get_generator_download_commands
+
+try:
+    from yaml import CSafeDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeDumper as YamlDumper, SafeLoader as YamlLoader
+
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_REPO = "vllm-project/vllm"
+MAIN_BRANCH = "main"
+NIGHTLY_BENCHMARKS_LABEL = "nightly-benchmarks"
+PERF_BENCHMARKS_LABEL = "perf-benchmarks"
+NIGHTLY_PIPELINE = ".buildkite/nightly-benchmarks/nightly-pipeline.yaml"
+PERF_PIPELINE = ".buildkite/nightly-benchmarks/benchmark-pipeline.yaml"
+# Pipeline of each label, in merge order: the nightly benchmarks go first, as they contain a blocking step
+LABEL_PIPELINES = [
+    (NIGHTLY_BENCHMARKS_LABEL, NIGHTLY_PIPELINE),
+    (PERF_BENCHMARKS_LABEL, PERF_PIPELINE),
+]
+BENCHMARK_STORE_STEP_KEY = "store-benchmark-results"
+BENCHMARK_RESULTS_ARTIFACTS = "results/*.json"
+BENCHMARK_RESULTS_DIR = "results"
+NON_COMMAND_STEP_TYPES = {"wait", "block", "input", "trigger", "group"}
+# Where the store step extracts the pipeline_generator package the kickoff ran, uploaded by
+# kickoff-benchmark.sh as GENERATOR_ARTIFACT
+GENERATOR_DIR = ".benchmark-store"
+CPU_QUEUE = "small_cpu_queue"
+
+
+class _Dumper(YamlDumper):
+    """Write the values of resolved aliases in full, as yq explode does."""
+
+    def ignore_aliases(self, data: Any) -> bool:
+        return True
+
+
+def merge_append(left: Any, right: Any) -> Any:
+    """yq `left *+ right`, without modifying either side, which may share values through aliases."""
+    if isinstance(left, dict) and isinstance(right, dict):
+        merged = dict(left)
+        for key, value in right.items():
+            merged[key] = merge_append(left[key], value) if key in left else value
+        return merged
+    if isinstance(left, list) and isinstance(right, list):
+        return [*left, *right]
+    return right
+
+
+def load_pipeline(file_path: str) -> Any:
+    """Load a pipeline, the loader resolves anchors, aliases and merge keys."""
+    with open(file_path, "r") as f:
+        return yaml.load(f, Loader=YamlLoader)
+
+
+def merge_pipelines(file_paths: Iterable[str]) -> Any:
+    """Load every pipeline once and merge them in order, None without any pipeline."""
+    merged = None
+    for file_path in file_paths:
+        merged = merge_append(merged, load_pipeline(file_path))
+    return merged
+
+
+def get_selected_pipelines(pull_request: Optional[str], branch: Optional[str], labels: Iterable[str]) -> List[str]:
+    """Pipelines selected by the labels of a PR, the performance benchmarks on main, none otherwise."""
+    if pull_request and pull_request != "false":
+        labels = set(labels)
+        return [file_path for label, file_path in LABEL_PIPELINES if label in labels]
+    if branch == MAIN_BRANCH:
+        return [PERF_PIPELINE]
+    return []
+
+
+def parse_labels(content: str) -> List[str]:
+    """Labels from a GitHub pull request response, a JSON list of labels, or one label per line."""
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return [line.strip() for line in content.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get("labels") or []
+    if not isinstance(data, list):
+        raise ValueError(f"Expected a pull request or a list of labels, got {type(data).__name__}")
+    return [label["name"] if isinstance(label, dict) else str(label) for label in data]
+
+
+def fetch_labels(pull_request: str, api_url: str = GITHUB_API_URL, repo: str = GITHUB_REPO) -> List[str]:
+    """Labels of a pull request from the GitHub API, or a local stub of it at `api_url`."""
+    request = urllib.request.Request(
+        f"{api_url.rstrip('/')}/repos/{repo}/pulls/{pull_request}",
+        headers={"Accept": "application/vnd.github+json"},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return parse_labels(response.read().decode())
+
+
+def get_benchmark_step_keys(pipeline: Any) -> List[str]:
+    """
+    Keys of the command steps of a pipeline, including those in groups. Steps without a key get one
+    derived from their label, the same in every build, as results are stored per step.
+    """
+    keys: List[str] = []
+    used_keys = set()
+
+    def visit(steps: List[Any]) -> List[Dict]:
+        command_steps = []
+        for step in steps or []:
+            if not isinstance(step, dict):
+                continue
+            if "group" in step:
+                command_steps.extend(visit(step.get("steps")))
+            elif not NON_COMMAND_STEP_TYPES & step.keys():
+                # Benchmark steps often run their command through a plugin
+                command_steps.append(step)
+            if step.get("key"):
+                used_keys.add(step["key"])
+        return command_steps
+
+    for step in visit(pipeline.get("steps")):
+        if not step.get("key"):
+            base_key = re.sub(r"[^a-z0-9]+", "-", str(step.get("label", "")).lower()).strip("-") or "benchmark"
+            key, index = base_key, 1
+            while key in used_keys:
+                index += 1
+                key = f"{base_key}-{index}"
+            step["key"] = key
+            used_keys.add(key)
+        keys.append(step["key"])
+    return keys
+
+
+def get_store_steps(benchmark_store: str, step_keys: List[str]) -> List[Dict]:
+    """
+    Steps adding the results of the benchmarks to the store once they have all finished, and checking for regressions.
+    The results of each step are downloaded into their own directory, as the same benchmarks run on several GPUs.
+    """
+    store_option = f"--store {shlex.quote(benchmark_store)}"
+    run_store = f"PYTHONPATH={GENERATOR_DIR} python -m pipeline_generator.benchmark_store"
+    download_commands = [
+        # Fails for steps that failed before uploading their results, or produce none
+        f'buildkite-agent artifact download "{BENCHMARK_RESULTS_ARTIFACTS}" {BENCHMARK_RESULTS_DIR}/{key} --step {key} '
+        f'|| echo "No benchmark results of {key}"'
+        for key in step_keys
+    ]
+    return [
+        {"wait": None, "continue_on_failure": True},
+        {
+            "label": "Store benchmark results",
+            "key": BENCHMARK_STORE_STEP_KEY,
+            "agents": {"queue": CPU_QUEUE},
+            "commands": [
+                'python -c "import click, pydantic, yaml" 2>/dev/null || python -m pip install click pydantic pyyaml',
+                *get_generator_download_commands(GENERATOR_DIR),
+                *download_commands,
+                f"{run_store} ingest {store_option} --results_dir {BENCHMARK_RESULTS_DIR}",
+                f"{run_store} detect {store_option} --annotate",
+            ],
+        },
+    ]
+
+
+def write_pipeline(pipeline: Any, file_path: str) -> None:
+    with open(file_path, "w") as f:
+        yaml.dump(pipeline, f, sort_keys=False, Dumper=_Dumper)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Merge the benchmark pipelines selected for the build into one pipeline.")
+    labels_source = parser.add_mutually_exclusive_group()
+    labels_source.add_argument("--labels_file", type=str, help="PR labels, one per line, as a JSON list, or a GitHub pull request response")
+    labels_source.add_argument("--github_api", type=str, default=GITHUB_API_URL, help="GitHub API to get the PR labels from, e.g. a local stub")
+    parser.add_argument("--pull_request", type=str, default=os.getenv("BUILDKITE_PULL_REQUEST", "false"), help="PR number, \"false\" outside PRs")
+    parser.add_argument("--branch", type=str, default=os.getenv("BUILDKITE_BRANCH"), help="Branch of the build")
+    parser.add_argument("--output", type=str, default="final.yaml", help="Merged pipeline, not written when no benchmark is selected")
+    parser.add_argument("--benchmark_store", type=str, help="If set, add the results to this SQLite benchmark store, e.g. on a shared volume")
+    args = parser.parse_args(argv)
+
+    labels: List[str] = []
+    if args.pull_request != "false":
+        if args.labels_file:
+            with open(args.labels_file, "r") as f:
+                labels = parse_labels(f.read())
+        else:
+            try:
+                labels = fetch_labels(args.pull_request, args.github_api)
+            except (OSError, ValueError) as e:
+                # E.g. rate limiting of unauthenticated requests, the benchmarks are skipped as for a PR without labels
+                print(f"Could not get the labels of PR {args.pull_request}: {e}", file=sys.stderr)
+    file_paths = get_selected_pipelines(args.pull_request, args.branch, labels)
+    if not file_paths:
+        print("Skipping performance benchmark.")
+        return 0
+    for file_path in file_paths:
+        print(f"Merging {file_path}")
+    pipeline = merge_pipelines(file_paths)
+    if pipeline and args.benchmark_store:
+        step_keys = get_benchmark_step_keys(pipeline)
+        pipeline = merge_append(pipeline, {"steps": get_store_steps(args.benchmark_store, step_keys)})
+    if pipeline:
+        write_pipeline(pipeline, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
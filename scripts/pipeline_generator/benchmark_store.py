@@ -0,0 +1,377 @@
+import glob
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import click
+from pydantic import BaseModel
+
+MAIN_BRANCH = "main"
+REGRESSION_ANNOTATION_CONTEXT = "benchmark-regressions"
+# Whether a higher value of each metric is better, only these metrics are stored
+HIGHER_IS_BETTER = True
+METRICS = {
+    # Serving benchmarks
+    "request_throughput": HIGHER_IS_BETTER,
+    "output_throughput": HIGHER_IS_BETTER,
+    "total_token_throughput": HIGHER_IS_BETTER,
+    "mean_ttft_ms": not HIGHER_IS_BETTER,
+    "median_ttft_ms": not HIGHER_IS_BETTER,
+    "p99_ttft_ms": not HIGHER_IS_BETTER,
+    "mean_tpot_ms": not HIGHER_IS_BETTER,
+    "median_tpot_ms": not HIGHER_IS_BETTER,
+    "p99_tpot_ms": not HIGHER_IS_BETTER,
+    "mean_itl_ms": not HIGHER_IS_BETTER,
+    "median_itl_ms": not HIGHER_IS_BETTER,
+    "p99_itl_ms": not HIGHER_IS_BETTER,
+    # Throughput benchmarks
+    "requests_per_second": HIGHER_IS_BETTER,
+    "tokens_per_second": HIGHER_IS_BETTER,
+    # Latency benchmarks, percentiles being stored as latency_p<percentile>
+    "avg_latency": not HIGHER_IS_BETTER,
+    "latency_p50": not HIGHER_IS_BETTER,
+    "latency_p90": not HIGHER_IS_BETTER,
+    "latency_p99": not HIGHER_IS_BETTER,
+}
+# Commits of history each side of the comparison covers: the latest RECENT_COMMITS, ending with the
+# commit checked, against the BASELINE_COMMITS before them
+RECENT_COMMITS = 3
+BASELINE_COMMITS = 10
+# A shift is only a regression when it is both significant and larger than the run-to-run noise
+SIGNIFICANCE_LEVEL = 0.05
+MIN_RELATIVE_CHANGE = 0.05
+# Above this many outcomes, the exact distribution of the Mann-Whitney statistic is not enumerated
+MAX_EXACT_OUTCOMES = 100_000
+
+
+class BenchmarkResult(BaseModel):
+    """A metric of a benchmark in one build of a commit."""
+    commit: str
+    branch: str
+    build: int = 0
+    timestamp: float
+    benchmark: str
+    metric: str
+    value: float
+
+    @property
+    def date(self) -> str:
+        return datetime.fromtimestamp(self.timestamp, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+class Regression(BaseModel):
+    benchmark: str
+    metric: str
+    commit: str
+    # First commit of the recent window, the regression landed between it and the commit checked
+    since_commit: str
+    baseline_median: float
+    recent_median: float
+    p_value: float
+
+    @property
+    def relative_change(self) -> float:
+        return (self.recent_median - self.baseline_median) / abs(self.baseline_median)
+
+
+class BenchmarkStore:
+    """
+    Benchmark results in a SQLite database, partitioned by date and commit: results of a date or a
+    commit are read and replaced through the index on them.
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS benchmark_results ("
+                "date TEXT NOT NULL, commit_sha TEXT NOT NULL, branch TEXT NOT NULL, build INTEGER NOT NULL, "
+                "timestamp REAL NOT NULL, benchmark TEXT NOT NULL, metric TEXT NOT NULL, value REAL NOT NULL, "
+                "PRIMARY KEY (date, commit_sha, build, benchmark, metric))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS benchmark_results_history "
+                "ON benchmark_results (branch, benchmark, metric, timestamp)"
+            )
+
+    def put(self, results: Iterable[BenchmarkResult]) -> int:
+        """Store results, replacing those of a re-ingested build, and return their number."""
+        rows = [
+            (result.date, result.commit, result.branch, result.build, result.timestamp, result.benchmark, result.metric, result.value)
+            for result in results
+        ]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO benchmark_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def get_series(self) -> List[Tuple[str, str]]:
+        """(benchmark, metric) of every stored series."""
+        return self.connection.execute(
+            "SELECT DISTINCT benchmark, metric FROM benchmark_results ORDER BY benchmark, metric"
+        ).fetchall()
+
+    def get_history(self, branch: str, benchmark: str, metric: str, commits: int) -> List[Tuple[str, List[float]]]:
+        """Values of the latest commits of a branch, oldest first, a commit being ordered by its first result."""
+        rows = self.connection.execute(
+            "SELECT commit_sha, value FROM benchmark_results "
+            "JOIN (SELECT commit_sha AS latest_commit, MIN(timestamp) AS first_timestamp FROM benchmark_results "
+            "      WHERE branch = ? AND benchmark = ? AND metric = ? GROUP BY commit_sha "
+            "      ORDER BY first_timestamp DESC LIMIT ?) ON commit_sha = latest_commit "
+            "WHERE branch = ? AND benchmark = ? AND metric = ? ORDER BY first_timestamp, timestamp",
+            (branch, benchmark, metric, commits, branch, benchmark, metric),
+        ).fetchall()
+        history: Dict[str, List[float]] = {}
+        for commit, value in rows:
+            history.setdefault(commit, []).append(value)
+        return list(history.items())
+
+
+def read_benchmark_metrics(file_path: str) -> Dict[str, float]:
+    """Tracked metrics of a benchmark JSON output, from the serving, throughput or latency benchmarks."""
+    with open(file_path, "r") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        return {}
+    values = dict(data)
+    for percentile, value in (data.get("percentiles") or {}).items():
+        values[f"latency_p{percentile}"] = value
+    return {
+        metric: float(value)
+        for metric, value in values.items()
+        if metric in METRICS and isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+    }
+
+
+def get_benchmark_name(results_dir: str, file_path: str) -> str:
+    """
+    Name of the benchmark of a JSON output: its file name, prefixed with the subdirectory of `results_dir`
+    it is in, e.g. the key of the step that ran it, as the same benchmarks run on several GPUs.
+    """
+    parts = os.path.relpath(file_path, results_dir).split(os.sep)
+    benchmark = os.path.splitext(parts[-1])[0]
+    return f"{parts[0]}/{benchmark}" if len(parts) > 1 else benchmark
+
+
+def read_benchmark_results(results_dir: str, commit: str, branch: str, build: int, timestamp: float) -> List[BenchmarkResult]:
+    """Results of the benchmark JSON outputs of a directory and its subdirectories, see get_benchmark_name."""
+    results = []
+    for file_path in sorted(glob.glob(os.path.join(results_dir, "**", "*.json"), recursive=True)):
+        benchmark = get_benchmark_name(results_dir, file_path)
+        try:
+            metrics = read_benchmark_metrics(file_path)
+        except ValueError:
+            # Partial output of a failed benchmark
+            continue
+        for metric, value in metrics.items():
+            results.append(BenchmarkResult(
+                commit=commit,
+                branch=branch,
+                build=build,
+                timestamp=timestamp,
+                benchmark=benchmark,
+                metric=metric,
+                value=value,
+            ))
+    return results
+
+
+@lru_cache(maxsize=None)
+def _count_rank_sums(m: int, n: int) -> Tuple[int, ...]:
+    """Number of orderings of m and n distinct values giving each Mann-Whitney U of the m values."""
+    if m == 0 or n == 0:
+        return (1,)
+    # The largest value is either one of the m values, beating all n others, or one of the n values
+    with_m = _count_rank_sums(m - 1, n)
+    with_n = _count_rank_sums(m, n - 1)
+    counts = [0] * (m * n + 1)
+    for u, count in enumerate(with_m):
+        counts[u + n] += count
+    for u, count in enumerate(with_n):
+        counts[u] += count
+    return tuple(counts)
+
+
+def mann_whitney_u(sample: List[float], reference: List[float]) -> float:
+    """
+    One-sided p-value of the Mann-Whitney U test that `sample` tends to be greater than `reference`.
+    Exact for small samples without ties, normal approximation with tie and continuity correction otherwise.
+    """
+    m, n = len(sample), len(reference)
+    if not m or not n:
+        return 1.0
+    u = sum(1.0 if x > y else 0.5 if x == y else 0.0 for x in sample for y in reference)
+    values = [*sample, *reference]
+    ties = len(values) != len(set(values))
+    if not ties and math.comb(m + n, m) <= MAX_EXACT_OUTCOMES:
+        counts = _count_rank_sums(m, n)
+        return sum(counts[int(u):]) / sum(counts)
+    tie_counts: Dict[float, int] = {}
+    for value in values:
+        tie_counts[value] = tie_counts.get(value, 0) + 1
+    total = m + n
+    tie_correction = sum(t ** 3 - t for t in tie_counts.values()) / (total * (total - 1))
+    variance = m * n / 12 * (total + 1 - tie_correction)
+    if variance <= 0:
+        return 1.0
+    z = (u - m * n / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _median(values: List[float]) -> float:
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def detect_regression(
+        history: List[Tuple[str, List[float]]],
+        higher_is_better: bool,
+        recent_commits: int = RECENT_COMMITS,
+        significance_level: float = SIGNIFICANCE_LEVEL,
+        min_relative_change: float = MIN_RELATIVE_CHANGE,
+    ) -> Optional[Tuple[float, float, float]]:
+    """
+    Compare the values of the latest `recent_commits` commits of a history, oldest first, to the commits
+    before them. Return (baseline median, recent median, p-value) if they got worse beyond the noise.
+    """
+    if len(history) <= recent_commits:
+        return None
+    baseline = [value for _, values in history[:-recent_commits] for value in values]
+    recent = [value for _, values in history[-recent_commits:] for value in values]
+    baseline_median, recent_median = _median(baseline), _median(recent)
+    if baseline_median == 0:
+        return None
+    change = (recent_median - baseline_median) / abs(baseline_median)
+    if (change if higher_is_better else -change) > -min_relative_change:
+        return None
+    # Worse means lower for a throughput, higher for a latency
+    p_value = mann_whitney_u(baseline, recent) if higher_is_better else mann_whitney_u(recent, baseline)
+    if p_value >= significance_level:
+        return None
+    return baseline_median, recent_median, p_value
+
+
+def find_regressions(
+        store: BenchmarkStore,
+        commit: str,
+        branch: str = MAIN_BRANCH,
+        recent_commits: int = RECENT_COMMITS,
+        baseline_commits: int = BASELINE_COMMITS,
+        significance_level: float = SIGNIFICANCE_LEVEL,
+        min_relative_change: float = MIN_RELATIVE_CHANGE,
+    ) -> List[Regression]:
+    """Metrics of the commit that regressed, over a rolling window of the branch's latest commits."""
+    regressions = []
+    for benchmark, metric in store.get_series():
+        if metric not in METRICS:
+            continue
+        history = store.get_history(branch, benchmark, metric, recent_commits + baseline_commits)
+        # Only the commit checked raises a regression, not a later check of an older commit
+        if not history or history[-1][0] != commit:
+            continue
+        detected = detect_regression(history, METRICS[metric], recent_commits, significance_level, min_relative_change)
+        if detected:
+            baseline_median, recent_median, p_value = detected
+            regressions.append(Regression(
+                benchmark=benchmark,
+                metric=metric,
+                commit=commit,
+                since_commit=history[-recent_commits][0],
+                baseline_median=baseline_median,
+                recent_median=recent_median,
+                p_value=p_value,
+            ))
+    return regressions
+
+
+def get_regression_annotation(regressions: List[Regression], recent_commits: int = RECENT_COMMITS) -> str:
+    lines = [
+        f"### Benchmark regressions at {regressions[0].commit[:12]}",
+        "",
+        f"Median of the last {recent_commits} commits against the commits before them on {MAIN_BRANCH}.",
+        "",
+        "| Benchmark | Metric | Since | Baseline | Recent | Change | p-value |",
+        "| --- | --- | --- | --- | --- | --- | --- |",
+    ]
+    for regression in regressions:
+        lines.append(
+            f"| {regression.benchmark} | {regression.metric} | {regression.since_commit[:12]} "
+            f"| {regression.baseline_median:.4g} | {regression.recent_median:.4g} "
+            f"| {regression.relative_change:+.1%} | {regression.p_value:.3g} |"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def annotate(body: str) -> None:
+    subprocess.run(
+        ["buildkite-agent", "annotate", "--style", "error", "--context", REGRESSION_ANNOTATION_CONTEXT, body],
+        check=True,
+    )
+
+
+@click.group()
+def main():
+    """Store benchmark results across commits and detect regressions."""
+
+
+@main.command()
+@click.option("--store", type=str, required=True, help="Path to the SQLite result store, created if missing")
+@click.option("--results_dir", type=str, required=True, help="Directory with the benchmark JSON outputs, in a subdirectory per step")
+@click.option("--commit", type=str, default=lambda: os.getenv("BUILDKITE_COMMIT", ""), help="Commit benchmarked")
+@click.option("--branch", type=str, default=lambda: os.getenv("BUILDKITE_BRANCH", MAIN_BRANCH), help="Branch of the commit")
+@click.option("--build", type=int, default=lambda: int(os.getenv("BUILDKITE_BUILD_NUMBER", "0")), help="Build number")
+@click.option("--timestamp", type=float, help="Unix time of the results, now by default")
+def ingest(store: str, results_dir: str, commit: str, branch: str, build: int, timestamp: Optional[float]):
+    """Add the results of a benchmark run to the store."""
+    if not commit:
+        raise click.UsageError("--commit is required outside Buildkite")
+    results = read_benchmark_results(results_dir, commit, branch, build, time.time() if timestamp is None else timestamp)
+    count = BenchmarkStore(store).put(results)
+    click.echo(f"Stored {count} results of {len({result.benchmark for result in results})} benchmarks")
+
+
+@main.command()
+@click.option("--store", type=str, required=True, help="Path to the SQLite result store")
+@click.option("--commit", type=str, default=lambda: os.getenv("BUILDKITE_COMMIT", ""), help="Commit to check")
+@click.option("--branch", type=str, default=lambda: os.getenv("BUILDKITE_BRANCH", MAIN_BRANCH), help="Branch of the commit")
+@click.option("--recent_commits", type=int, default=RECENT_COMMITS, help="Commits compared to the baseline, ending with the commit")
+@click.option("--baseline_commits", type=int, default=BASELINE_COMMITS, help="Commits before them in the baseline")
+@click.option("--significance_level", type=float, default=SIGNIFICANCE_LEVEL, help="Maximum one-sided p-value of a regression")
+@click.option("--min_relative_change", type=float, default=MIN_RELATIVE_CHANGE, help="Minimum change of the median of a regression")
+@click.option("--annotate/--no_annotate", "should_annotate", default=False, help="Annotate the build with the regressions")
+def detect(
+        store: str,
+        commit: str,
+        branch: str,
+        recent_commits: int,
+        baseline_commits: int,
+        significance_level: float,
+        min_relative_change: float,
+        should_annotate: bool,
+    ):
+    """Report the metrics a commit of main regressed."""
+    if branch != MAIN_BRANCH:
+        click.echo(f"Skipping regression detection on branch {branch}")
+        return
+    if not commit:
+        raise click.UsageError("--commit is required outside Buildkite")
+    regressions = find_regressions(
+        BenchmarkStore(store), commit, branch, recent_commits, baseline_commits, significance_level, min_relative_change
+    )
+    if not regressions:
+        click.echo(f"No regression at {commit}")
+        return
+    body = get_regression_annotation(regressions, recent_commits)
+    click.echo(body)
+    if should_annotate:
+        annotate(body)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import json
+import re
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+MAIN_BRANCH = "main"
+BUILDER_NAME = "vllm-builder"
+BAKE_FILE = "docker-bake.json"
+MAX_TAG_LENGTH = 128
+REGISTRY_CACHE_TYPE = "registry"
+LOCAL_CACHE_TYPE = "local"
+
+
+class BuildCache(BaseModel):
+    """
+    BuildKit layer cache location, either a registry repository (`ref` being e.g. "registry/repo")
+    or a local directory that outlives the agent's builds, and the branch caches are keyed by.
+    """
+    type: str = REGISTRY_CACHE_TYPE
+    ref: str
+    branch: str = MAIN_BRANCH
+
+
+class ImageBuild(BaseModel):
+    """An image to build: a Dockerfile target with build args, pushed with its tags."""
+    name: str
+    tags: List[str]
+    target: str = "test"
+    cuda_version: Optional[str] = None
+
+
+def get_build_cache(url: str, branch: Optional[str] = None) -> BuildCache:
+    """`file:///path/to/dir` for a local directory, otherwise a registry repository, with an optional `registry://` prefix."""
+    branch = branch or MAIN_BRANCH
+    if url.startswith("file://"):
+        return BuildCache(type=LOCAL_CACHE_TYPE, ref=url[len("file://"):], branch=branch)
+    return BuildCache(type=REGISTRY_CACHE_TYPE, ref=url[len("registry://"):] if url.startswith("registry://") else url, branch=branch)
+
+
+def get_variant(image_build: ImageBuild) -> str:
+    """Part of the cache key shared by builds of the same target and build args, e.g. "cu121-test"."""
+    cuda_tag = "cu" + "".join(image_build.cuda_version.split(".")[:2]) if image_build.cuda_version else "default"
+    return f"{cuda_tag}-{image_build.target}"
+
+
+def get_cache_key(branch: str, variant: str) -> str:
+    """Cache tag of a branch and variant, e.g. "feature-x-cu121-test" for branch "feature/x"."""
+    branch = re.sub(r"[^A-Za-z0-9_.-]", "-", branch).lstrip(".-") or MAIN_BRANCH
+    return f"{branch[:MAX_TAG_LENGTH - len(variant) - 1]}-{variant}"
+
+
+def _get_cache_location(build_cache: BuildCache, key: str, export: bool) -> str:
+    if build_cache.type == LOCAL_CACHE_TYPE:
+        return f"type=local,dest={build_cache.ref}/{key},mode=max" if export else f"type=local,src={build_cache.ref}/{key}"
+    # Image manifest caches are the ones ECR accepts
+    options = ",mode=max,image-manifest=true,oci-mediatypes=true" if export else ""
+    return f"type=registry,ref={build_cache.ref}:{key}{options}"
+
+
+def get_cache_from(build_cache: BuildCache, variant: str) -> List[str]:
+    """Caches to import: the branch's own, then main's for the first build of a branch."""
+    keys = dict.fromkeys([get_cache_key(build_cache.branch, variant), get_cache_key(MAIN_BRANCH, variant)])
+    return [_get_cache_location(build_cache, key, export=False) for key in keys]
+
+
+def get_cache_to(build_cache: BuildCache, variant: str) -> str:
+    """Cache to export, with the layers of every stage (mode=max), so later stages and builds reuse them."""
+    return _get_cache_location(build_cache, get_cache_key(build_cache.branch, variant), export=True)
+
+
+def get_builder_command() -> str:
+    """Cache export needs a BuildKit builder of its own, created once per agent."""
+    return (
+        f"docker buildx inspect {BUILDER_NAME} >/dev/null 2>&1 || "
+        f"docker buildx create --name {BUILDER_NAME} --driver docker-container"
+    )
+
+
+def get_cache_options(build_cache: Optional[BuildCache], image_build: ImageBuild) -> List[str]:
+    """`docker buildx build` options importing and exporting the layer cache of an image build."""
+    if not build_cache:
+        return []
+    variant = get_variant(image_build)
+    options = [f"--cache-from {location}" for location in get_cache_from(build_cache, variant)]
+    options.append(f"--cache-to {get_cache_to(build_cache, variant)}")
+    return options
+
+
+def get_bake_file(image_builds: List[ImageBuild], build_args: Dict[str, str], build_cache: Optional[BuildCache] = None) -> Dict:
+    """`docker buildx bake` definition building all images in parallel, sharing the build context."""
+    targets = {}
+    for image_build in image_builds:
+        args = dict(build_args)
+        if image_build.cuda_version:
+            args["CUDA_VERSION"] = image_build.cuda_version
+        target = {
+            "context": ".",
+            "dockerfile": "docker/Dockerfile",
+            "target": image_build.target,
+            "args": args,
+            "tags": image_build.tags,
+        }
+        if build_cache:
+            variant = get_variant(image_build)
+            target["cache-from"] = get_cache_from(build_cache, variant)
+            target["cache-to"] = [get_cache_to(build_cache, variant)]
+        targets[image_build.name] = target
+    return {"group": {"default": {"targets": list(targets)}}, "target": targets}
+
+
+def get_bake_commands(image_builds: List[ImageBuild], build_args: Dict[str, str], build_cache: Optional[BuildCache] = None) -> List[str]:
+    bake_file = json.dumps(get_bake_file(image_builds, build_args, build_cache), indent=2)
+    builder_option = f"--builder {BUILDER_NAME} " if build_cache else ""
+    return [
+        *([get_builder_command()] if build_cache else []),
+        f"cat > {BAKE_FILE} <<'EOF'\n{bake_file}\nEOF",
+        f"docker buildx bake {builder_option}--file {BAKE_FILE} --push --progress plain",
+    ]
@@ -0,0 +1,212 @@
+"""
+Preemption-safe test execution: record completed pytest tests and skip them when the step is retried.
+
+This file is both the wrapper around a step's command and the pytest plugin it loads, and runs inside
+the test image, so it only uses the standard library. The wrapper puts its own directory on PYTHONPATH
+and loads itself into every pytest invocation of the command with PYTEST_ADDOPTS.
+
+The checkpoint is a list of "<invocation>\\t<node id>" lines, the invocation being the position of the
+pytest run within the command, so that the same test run twice with different settings is kept apart.
+Only tests that passed or were skipped are recorded: failed tests run again on resume and still fail.
+
+Usage: python3 checkpoint.py (--checkpoint_dir DIR | --artifact) --name NAME -- COMMAND...
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+from typing import List, Optional, Set
+
+CHECKPOINT_FILE_ENV = "PYTEST_CHECKPOINT_FILE"
+CHECKPOINT_COUNTER_ENV = "PYTEST_CHECKPOINT_COUNTER"
+CHECKPOINT_INVOCATION_ENV = "PYTEST_CHECKPOINT_INVOCATION"
+PLUGIN_NAME = "checkpoint"
+DEFAULT_SYNC_INTERVAL = 60  # seconds
+PREEMPTED_EXIT_STATUS = -1 & 0xFF
+NO_TESTS_COLLECTED_EXIT_STATUS = 5
+
+
+def read_completed_tests(checkpoint_file: str, invocation: str) -> Set[str]:
+    if not os.path.exists(checkpoint_file):
+        return set()
+    completed_tests = set()
+    with open(checkpoint_file, "r") as f:
+        for line in f:
+            # A line cut by preemption has no newline and is ignored
+            if line.endswith("\n") and line.startswith(f"{invocation}\t"):
+                completed_tests.add(line[len(invocation) + 1:-1])
+    return completed_tests
+
+
+# pytest plugin
+
+
+class _Checkpoint:
+    """Per-session state and hooks, registered by pytest_configure."""
+
+    def __init__(self, checkpoint_file: str, invocation: str, record: bool):
+        self.checkpoint_file = checkpoint_file
+        self.invocation = invocation
+        self.completed_tests = read_completed_tests(checkpoint_file, invocation)
+        self.failed_tests: Set[str] = set()
+        self.deselected = False
+        self.record = record
+
+    def pytest_collection_modifyitems(self, config, items):
+        deselected = [item for item in items if item.nodeid in self.completed_tests]
+        if deselected:
+            self.deselected = True
+            config.hook.pytest_deselected(items=deselected)
+            items[:] = [item for item in items if item.nodeid not in self.completed_tests]
+
+    def pytest_runtest_logreport(self, report):
+        if not self.record:
+            return
+        if report.failed:
+            self.failed_tests.add(report.nodeid)
+        elif report.when == "teardown" and report.nodeid not in self.failed_tests:
+            with open(self.checkpoint_file, "a") as f:
+                f.write(f"{self.invocation}\t{report.nodeid}\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def pytest_sessionfinish(self, session, exitstatus):
+        # Every test was completed before the preemption
+        if self.deselected and exitstatus == NO_TESTS_COLLECTED_EXIT_STATUS:
+            session.exitstatus = 0
+
+
+def _next_invocation() -> str:
+    """Number the pytest runs of the command, the wrapper resets the counter on every attempt."""
+    counter_file = os.environ[CHECKPOINT_COUNTER_ENV]
+    with open(counter_file, "r+") as f:
+        invocation = int(f.read() or 0)
+        f.seek(0)
+        f.write(str(invocation + 1))
+        f.truncate()
+    return str(invocation)
+
+
+def pytest_configure(config):
+    if CHECKPOINT_FILE_ENV not in os.environ:
+        return
+    worker = hasattr(config, "workerinput")
+    if worker:
+        # pytest-xdist worker: numbered by the controller, which also records the results
+        invocation = os.environ[CHECKPOINT_INVOCATION_ENV]
+    else:
+        invocation = _next_invocation()
+        os.environ[CHECKPOINT_INVOCATION_ENV] = invocation
+    config.pluginmanager.register(_Checkpoint(os.environ[CHECKPOINT_FILE_ENV], invocation, record=not worker))
+
+
+# Wrapper
+
+
+class DirectoryStore:
+    """Checkpoint written directly to a directory that outlives the job, e.g. a shared volume."""
+
+    def __init__(self, directory: str, name: str):
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoint_file = os.path.join(directory, name)
+
+    def restore(self) -> None:
+        pass
+
+    def save(self) -> None:
+        pass
+
+
+class ArtifactStore:
+    """Checkpoint kept locally and uploaded as a Buildkite artifact of the step, downloaded on retry."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.directory, name)
+
+    def restore(self) -> None:
+        subprocess.run(
+            ["buildkite-agent", "artifact", "download", self.name, self.directory, "--step", os.environ["BUILDKITE_STEP_ID"]],
+            capture_output=True,
+        )
+
+    def save(self) -> None:
+        if os.path.exists(self.checkpoint_file):
+            subprocess.run(["buildkite-agent", "artifact", "upload", self.name], cwd=self.directory, capture_output=True)
+
+
+def run_with_checkpoint(
+        command: List[str],
+        store,
+        sync_interval: float = DEFAULT_SYNC_INTERVAL,
+        preempt_after: Optional[int] = None,
+    ) -> int:
+    """
+    Run the command with the checkpoint plugin loaded into pytest, saving the checkpoint periodically
+    and at the end. `preempt_after` kills the command without a final save once that many tests are
+    recorded, to simulate losing the agent.
+    """
+    store.restore()
+    counter_file = tempfile.NamedTemporaryFile(delete=False)
+    counter_file.close()
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    env = {
+        **os.environ,
+        CHECKPOINT_FILE_ENV: store.checkpoint_file,
+        CHECKPOINT_COUNTER_ENV: counter_file.name,
+        "PYTHONPATH": os.pathsep.join(filter(None, [plugin_dir, os.environ.get("PYTHONPATH")])),
+        "PYTEST_ADDOPTS": " ".join(filter(None, [os.environ.get("PYTEST_ADDOPTS"), f"-p {PLUGIN_NAME}"])),
+    }
+    process = subprocess.Popen(command, env=env, start_new_session=True)
+    finished = threading.Event()
+    preempted = threading.Event()
+
+    def monitor():
+        while not finished.wait(sync_interval if preempt_after is None else 0.05):
+            if preempt_after is not None and _count_lines(store.checkpoint_file) >= preempt_after:
+                preempted.set()
+                os.killpg(process.pid, signal.SIGKILL)
+                return
+            if preempt_after is None:
+                store.save()
+
+    monitor_thread = threading.Thread(target=monitor, daemon=True)
+    monitor_thread.start()
+    returncode = process.wait()
+    finished.set()
+    monitor_thread.join()
+    os.unlink(counter_file.name)
+    if preempted.is_set():
+        return PREEMPTED_EXIT_STATUS
+    store.save()
+    return returncode
+
+
+def _count_lines(file_path: str) -> int:
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, "r") as f:
+        return sum(1 for line in f if line.endswith("\n"))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a test command, resuming from the tests completed by a previous attempt.")
+    location = parser.add_mutually_exclusive_group(required=True)
+    location.add_argument("--checkpoint_dir", type=str, help="Directory that outlives the job to keep the checkpoint in")
+    location.add_argument("--artifact", action="store_true", help="Keep the checkpoint as a Buildkite artifact of the step")
+    parser.add_argument("--name", type=str, required=True, help="Checkpoint name, unique per step and parallel job")
+    parser.add_argument("--sync_interval", type=float, default=DEFAULT_SYNC_INTERVAL, help="Seconds between artifact uploads")
+    parser.add_argument("--preempt_after", type=int, help="Simulate a preemption after this many completed tests")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run, after --")
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    store = ArtifactStore(args.name) if args.artifact else DirectoryStore(args.checkpoint_dir, args.name)
+    return run_with_checkpoint(command, store, args.sync_interval, args.preempt_after)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import json
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Union
+
+from .scheduling import get_estimated_duration
+from .sharding import TimingDatabase
+from .step import BuildkiteStep, BuildkiteBlockStep, BUILD_STEP_KEY
+
+DEFAULT_COALESCE_BUDGET = 15 * 60  # seconds
+DEFAULT_COALESCE_MAX_STEP_DURATION = 5 * 60  # seconds
+COALESCED_STEP_LABEL_PREFIX = "Coalesced"
+COALESCED_STEP_KEY_PREFIX = "coalesced"
+
+
+def _get_compatibility_key(step: BuildkiteStep) -> str:
+    """Steps with the same key run in the same kind of container on the same queue."""
+    return json.dumps(
+        [step.agents, step.plugins, step.env, step.soft_fail, step.retry],
+        sort_keys=True,
+    )
+
+
+def _is_coalescable(step: BuildkiteStep, duration: Optional[float], max_step_duration: float) -> bool:
+    return (
+        duration is not None
+        and duration <= max_step_duration
+        and step.depends_on == [BUILD_STEP_KEY]
+        and not step.parallelism
+        and step.plugins is not None
+    )
+
+
+def get_coalesced_commands(steps: List[BuildkiteStep]) -> List[str]:
+    """
+    Run each step's commands in its own subshell and log section, keep going on failure,
+    and fail at the end listing the steps that failed.
+    The commands are kept on their own lines, so comments, trailing `;` and heredocs work as in
+    the step. The subshell runs on its own: bash ignores `set -e` on the left of `||` or `&&`.
+    """
+    commands = ["set +e", "FAILED_STEPS=()"]
+    for step in steps:
+        label = step.label.replace('"', '\\"')
+        commands.append(f'echo "--- {label}"')
+        commands.append("\n".join(["(", "set -e", *step.commands, ")"]))
+        commands.append(f'if [ $$? -ne 0 ]; then echo "^^^ +++"; FAILED_STEPS+=("{label}"); fi')
+    commands.append(
+        'if [ $${#FAILED_STEPS[@]} -gt 0 ]; then '
+        'printf "Failed: %s\\n" "$${FAILED_STEPS[@]}"; exit 1; '
+        'fi'
+    )
+    return commands
+
+
+def _pack(steps_with_duration: List[Tuple[BuildkiteStep, float]], budget: float) -> List[List[BuildkiteStep]]:
+    """First-fit decreasing bin packing of steps into jobs of at most `budget` seconds."""
+    bins: List[Tuple[float, List[BuildkiteStep]]] = []
+    for step, duration in sorted(steps_with_duration, key=lambda item: -item[1]):
+        for index, (load, bin_steps) in enumerate(bins):
+            if load + duration <= budget:
+                bins[index] = (load + duration, bin_steps + [step])
+                break
+        else:
+            bins.append((duration, [step]))
+    return [bin_steps for _, bin_steps in bins]
+
+
+def coalesce_steps(
+        steps: List[Union[BuildkiteStep, BuildkiteBlockStep]],
+        timing_database: TimingDatabase,
+        budget: float = DEFAULT_COALESCE_BUDGET,
+        max_step_duration: float = DEFAULT_COALESCE_MAX_STEP_DURATION,
+        coalesced_keys: Optional[Dict[str, str]] = None,
+    ) -> List[Union[BuildkiteStep, BuildkiteBlockStep]]:
+    """
+    Merge short compatible steps into combined jobs, each placed where its first step was.
+    If given, `coalesced_keys` is filled with the key of the combined job of each merged step.
+    """
+    groups: Dict[str, List[Tuple[BuildkiteStep, float]]] = defaultdict(list)
+    for step in steps:
+        if not isinstance(step, BuildkiteStep):
+            continue
+        duration = get_estimated_duration(step, timing_database)
+        if _is_coalescable(step, duration, max_step_duration):
+            groups[_get_compatibility_key(step)].append((step, duration))
+
+    positions = {id(step): position for position, step in enumerate(steps)}
+    replacements: Dict[int, Optional[BuildkiteStep]] = {}
+    for group in groups.values():
+        for bin_steps in _pack(group, budget):
+            if len(bin_steps) == 1:
+                continue
+            bin_steps.sort(key=lambda step: positions[id(step)])
+            coalesced_step = bin_steps[0].model_copy(update={
+                "label": f"{COALESCED_STEP_LABEL_PREFIX}: {', '.join(step.label for step in bin_steps)}",
+                "key": f"{COALESCED_STEP_KEY_PREFIX}-{bin_steps[0].key}",
+                "commands": get_coalesced_commands(bin_steps),
+                "priority": None,
+            })
+            replacements[id(bin_steps[0])] = coalesced_step
+            for step in bin_steps[1:]:
+                replacements[id(step)] = None
+            if coalesced_keys is not None:
+                coalesced_keys.update((step.key, coalesced_step.key) for step in bin_steps)
+
+    coalesced_steps = []
+    for step in steps:
+        if id(step) not in replacements:
+            coalesced_steps.append(step)
+        elif replacements[id(step)] is not None:
+            coalesced_steps.append(replacements[id(step)])
+    return coalesced_steps
@@ -0,0 +1,73 @@
+from graphlib import CycleError, TopologicalSorter
+from typing import Dict, List, Tuple, Union
+
+from .step import BuildkiteStep, BuildkiteBlockStep, BuildkiteWaitStep, get_dependency_key
+
+PipelineStep = Union[BuildkiteStep, BuildkiteBlockStep, BuildkiteWaitStep]
+
+
+def _get_step_key(step: PipelineStep, index: int) -> str:
+    """Key of a step in the graph, steps without a key are named by position."""
+    key = getattr(step, "key", None)
+    if key:
+        return key
+    return f"wait-{index}" if isinstance(step, BuildkiteWaitStep) else f"step-{index}"
+
+
+def get_step_graph(steps: List[PipelineStep]) -> Dict[str, List[str]]:
+    """
+    Dependencies of each step by key: its depends_on, and for steps after a wait step, the wait step,
+    which itself depends on every step before it.
+    """
+    graph: Dict[str, List[str]] = {}
+    last_wait = None
+    for index, step in enumerate(steps):
+        key = _get_step_key(step, index)
+        if key in graph:
+            raise ValueError(f"Duplicate step key {key}")
+        if isinstance(step, BuildkiteWaitStep):
+            graph[key] = list(graph)
+            last_wait = key
+            continue
+        dependencies = [get_dependency_key(dependency) for dependency in step.depends_on or []]
+        if last_wait:
+            dependencies.append(last_wait)
+        graph[key] = dependencies
+    return graph
+
+
+def validate_dag(steps: List[PipelineStep]) -> List[str]:
+    """Check that every dependency exists and that there is no cycle, and return the keys in topological order."""
+    graph = get_step_graph(steps)
+    for key, dependencies in graph.items():
+        unknown = [dependency for dependency in dependencies if dependency not in graph]
+        if unknown:
+            raise ValueError(f"Step {key} depends on unknown steps {unknown}")
+    try:
+        return list(TopologicalSorter(graph).static_order())
+    except CycleError as e:
+        raise ValueError(f"Steps depend on each other in a cycle: {' -> '.join(e.args[1])}") from e
+
+
+def get_critical_path(steps: List[PipelineStep], durations: Dict[str, float]) -> Tuple[List[str], float]:
+    """
+    Longest chain of dependent steps, weighted by the wall time of each step (missing ones count as 0),
+    and its total duration. It bounds the duration of the build whatever the number of agents.
+    """
+    graph = get_step_graph(steps)
+    finish_times: Dict[str, float] = {}
+    previous: Dict[str, str] = {}
+    for key in validate_dag(steps):
+        start = 0.0
+        if graph[key]:
+            previous[key] = max(graph[key], key=lambda dependency: finish_times[dependency])
+            start = finish_times[previous[key]]
+        finish_times[key] = start + durations.get(key, 0.0)
+    if not finish_times:
+        return [], 0.0
+    key = max(finish_times, key=lambda key: finish_times[key])
+    total = finish_times[key]
+    path = [key]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+    return path[::-1], total
@@ -0,0 +1,71 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+from .step import TestStep
+
+
+class DependencyIndex:
+    """
+    Index over all test steps' source_file_dependencies.
+
+    A step is unblocked when one of its dependencies is a substring of a file
+    in the diff (same as `source_file in file` in the Jinja template). Plain
+    prefix lookup would change that behaviour, so the dependencies are compiled
+    into a prefix trie with failure links (Aho-Corasick), which finds every
+    dependency occurring anywhere in a path in one pass over its characters.
+    """
+
+    def __init__(self, test_steps: Iterable[TestStep]):
+        # State 0 is the root of the trie.
+        self._transitions: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._labels: List[Set[str]] = [set()]
+        self.indexed_labels: Set[str] = set()
+
+        for step in test_steps:
+            for dependency in step.source_file_dependencies or []:
+                self._insert(dependency, step.label)
+        self._build_fail_links()
+
+    def _insert(self, dependency: str, label: str) -> None:
+        self.indexed_labels.add(label)
+        state = 0
+        for char in dependency:
+            next_state = self._transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions.append({})
+                self._fail.append(0)
+                self._labels.append(set())
+                self._transitions[state][char] = next_state
+            state = next_state
+        self._labels[state].add(label)
+
+    def _build_fail_links(self) -> None:
+        """Breadth-first pass setting failure links and merging outputs along them."""
+        queue = deque(self._transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._transitions[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._transitions[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._transitions[fail].get(char, 0)
+                self._labels[next_state] |= self._labels[self._fail[next_state]]
+                queue.append(next_state)
+
+    def match(self, list_file_diff: Iterable[str]) -> Set[str]:
+        """Return labels of the steps with at least one dependency found in the file diff."""
+        transitions, fail, labels = self._transitions, self._fail, self._labels
+        matched: Set[str] = set()
+        for file in list_file_diff:
+            state = 0
+            for char in file:
+                while state and char not in transitions[state]:
+                    state = fail[state]
+                state = transitions[state].get(char, 0)
+                if labels[state]:
+                    matched |= labels[state]
+            if len(matched) == len(self.indexed_labels):
+                break
+        return matched
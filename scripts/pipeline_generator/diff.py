@@ -0,0 +1,69 @@
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+MAIN_BRANCH = "main"
+MAIN_REF = "origin/main"
+# Same statuses as the shell diff of the bootstrap script: added, copied, modified, deleted and renamed
+DIFF_FILTER = "ACMDR"
+
+# Merge-base of each (repo, main commit, HEAD commit), so it is only recomputed once either moves
+_merge_bases: Dict[Tuple[str, str, str], str] = {}
+
+
+class FileDiff(BaseModel):
+    """Files changed by a branch, renames being (old path, new path) pairs."""
+    files: List[str] = []
+    renames: List[Tuple[str, str]] = []
+
+
+def _git(repo_root: str, *args: str) -> bytes:
+    return subprocess.run(["git", *args], cwd=repo_root, capture_output=True, check=True).stdout
+
+
+def get_merge_base(repo_root: str, main_ref: str = MAIN_REF) -> str:
+    """Commit HEAD forked from main, cached per main and HEAD commit."""
+    main_commit, head_commit = _git(repo_root, "rev-parse", main_ref, "HEAD").decode().split()
+    key = (repo_root, main_commit, head_commit)
+    if key not in _merge_bases:
+        _merge_bases[key] = _git(repo_root, "merge-base", main_commit, head_commit).decode().strip()
+    return _merge_bases[key]
+
+
+def get_diff_base(repo_root: str, branch: Optional[str], main_ref: str = MAIN_REF) -> str:
+    """Revision to diff against: the previous commit on main, the merge-base with main otherwise."""
+    if branch == MAIN_BRANCH:
+        return "HEAD~1"
+    return get_merge_base(repo_root, main_ref)
+
+
+def parse_name_status(output: bytes) -> FileDiff:
+    """
+    Parse `git diff -z --name-status` output, NUL-separated so that paths are never quoted or split.
+    Both paths of a rename count as changed, only the new one of a copy.
+    """
+    fields = output.decode().split("\0")
+    files: Dict[str, None] = {}
+    renames = []
+    index = 0
+    while index < len(fields) and fields[index]:
+        status = fields[index]
+        if status[0] in "RC":
+            old_path, new_path = fields[index + 1], fields[index + 2]
+            if status[0] == "R":
+                renames.append((old_path, new_path))
+                files[old_path] = None
+            files[new_path] = None
+            index += 3
+        else:
+            files[fields[index + 1]] = None
+            index += 2
+    return FileDiff(files=list(files), renames=renames)
+
+
+def get_file_diff(repo_root: str = ".", branch: Optional[str] = None, main_ref: str = MAIN_REF) -> FileDiff:
+    """Files of the working tree changed since the diff base of the branch, with a single `git diff`."""
+    base = get_diff_base(repo_root, branch, main_ref)
+    output = _git(repo_root, "diff", "-z", "--name-status", "--find-renames", f"--diff-filter={DIFF_FILTER}", base)
+    return parse_name_status(output)
@@ -0,0 +1,235 @@
+import glob
+import json
+import os
+import shlex
+import xml.etree.ElementTree as ElementTree
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+import click
+from pydantic import BaseModel
+
+from .step import BuildkiteStep
+from .utils import AGENT_RETRY_RULES
+
+# Only the most recent runs of a step count, so fixed flakes leave quarantine
+FLAKE_HISTORY_WINDOW = 50
+# A test is quarantined after flaking in at least this many runs and this share of runs
+QUARANTINE_MIN_FLAKY_RUNS = 2
+QUARANTINE_FLAKE_RATE = 0.05
+# Share of runs a step flaked in, not explained by quarantined tests
+RETRY_FLAKE_RATE = 0.05
+RETRY_TWICE_FLAKE_RATE = 0.2
+SOFT_FAIL_FLAKE_RATE = 0.3
+PASSED_JOB_STATE = "passed"
+FAILED_JOB_STATE = "failed"
+
+
+class StepRun(BaseModel):
+    """Outcome of a step in one build, over all its attempts (Buildkite retries and parallel jobs)."""
+    build: int
+    passed: bool = False
+    failed: bool = False
+    # Tests that failed in at least one attempt, and tests that both failed and passed (including pytest reruns)
+    failed_tests: List[str] = []
+    flaky_tests: List[str] = []
+
+    @property
+    def flaky(self) -> bool:
+        return self.passed and self.failed
+
+
+class FlakeHistory(BaseModel):
+    """Recent runs of each step, keyed by step key."""
+    steps: Dict[str, List[StepRun]] = {}
+
+
+class FlakePolicy(BaseModel):
+    """What to do about a step's flakiness."""
+    quarantined_tests: List[str] = []
+    retry_limit: int = 0
+    soft_fail: bool = False
+
+
+def read_flake_history(file_path: str) -> FlakeHistory:
+    if not os.path.exists(file_path):
+        return FlakeHistory()
+    with open(file_path, "r") as f:
+        return FlakeHistory.model_validate_json(f.read())
+
+
+def write_flake_history(flake_history: FlakeHistory, file_path: str) -> None:
+    with open(file_path, "w") as f:
+        f.write(flake_history.model_dump_json())
+
+
+def get_node_id(classname: str, name: str) -> str:
+    """
+    Rebuild the pytest node id of a JUnit test case, e.g. classname "tests.lora.test_layers.TestLoRA"
+    and name "test_a[1]" give "tests/lora/test_layers.py::TestLoRA::test_a[1]".
+    The test module is the last part named like a pytest test file.
+    """
+    parts = classname.split(".") if classname else []
+    module_end = max(
+        (index for index, part in enumerate(parts) if part.startswith("test_") or part.endswith("_test")),
+        default=len(parts) - 1,
+    )
+    module = "/".join(parts[:module_end + 1])
+    return "::".join([f"{module}.py", *parts[module_end + 1:], name]) if module else name
+
+
+def read_junit_outcomes(file_path: str) -> Dict[str, str]:
+    """
+    Return "passed", "failed" or "flaky" per node id from a JUnit XML file.
+    Tests that passed after reruns within pytest (pytest-rerunfailures) are flaky.
+    """
+    outcomes = {}
+    for testcase in ElementTree.parse(file_path).getroot().iter("testcase"):
+        node_id = get_node_id(testcase.get("classname", ""), testcase.get("name", ""))
+        tags = {child.tag for child in testcase}
+        if tags & {"failure", "error"}:
+            outcomes[node_id] = "failed"
+        elif tags & {"rerunFailure", "rerunError"}:
+            outcomes[node_id] = "flaky"
+        elif "skipped" not in tags:
+            outcomes[node_id] = "passed"
+    return outcomes
+
+
+def get_step_runs(builds: List[Dict], junit_dir: Optional[str] = None) -> Dict[str, List[StepRun]]:
+    """
+    Combine Buildkite builds (REST API shape: number and jobs with step_key and state, where retried
+    jobs are listed next to their retries) with JUnit files stored as <junit_dir>/<build>/<step_key>/*.xml,
+    one file per attempt or parallel job.
+    """
+    runs: Dict[str, Dict[int, StepRun]] = defaultdict(dict)
+    for build in builds:
+        for job in build.get("jobs", []):
+            step_key = job.get("step_key")
+            if not step_key or job.get("state") not in (PASSED_JOB_STATE, FAILED_JOB_STATE):
+                continue
+            run = runs[step_key].setdefault(build["number"], StepRun(build=build["number"]))
+            if job["state"] == PASSED_JOB_STATE:
+                run.passed = True
+            else:
+                run.failed = True
+
+    for step_key, step_runs in runs.items():
+        for build_number, run in step_runs.items():
+            if not junit_dir:
+                continue
+            outcomes: Dict[str, Set[str]] = defaultdict(set)
+            for file_path in sorted(glob.glob(os.path.join(junit_dir, str(build_number), step_key, "*.xml"))):
+                for node_id, outcome in read_junit_outcomes(file_path).items():
+                    outcomes[node_id].add(outcome)
+            run.failed_tests = sorted(node_id for node_id, outcome in outcomes.items() if "failed" in outcome)
+            run.flaky_tests = sorted(
+                node_id for node_id, outcome in outcomes.items()
+                if "flaky" in outcome or outcome >= {"failed", "passed"}
+            )
+    return {step_key: sorted(step_runs.values(), key=lambda run: run.build) for step_key, step_runs in runs.items()}
+
+
+def update_flake_history(flake_history: FlakeHistory, step_runs: Dict[str, List[StepRun]]) -> None:
+    """Add new runs, replacing runs of the same build, and keep the most recent ones."""
+    for step_key, new_runs in step_runs.items():
+        runs = {run.build: run for run in flake_history.steps.get(step_key, [])}
+        runs.update({run.build: run for run in new_runs})
+        flake_history.steps[step_key] = sorted(runs.values(), key=lambda run: run.build)[-FLAKE_HISTORY_WINDOW:]
+
+
+def get_flake_policy(runs: List[StepRun]) -> FlakePolicy:
+    """
+    Quarantine tests that flake repeatedly. Retry the step, or let it soft fail, when it flakes
+    for other reasons: a rerun of a whole step is only worth it when a quarantine cannot avoid it.
+    """
+    runs = runs[-FLAKE_HISTORY_WINDOW:]
+    if not runs:
+        return FlakePolicy()
+    flaky_runs_by_test = Counter(test for run in runs for test in run.flaky_tests)
+    quarantined_tests = sorted(
+        test for test, flaky_runs in flaky_runs_by_test.items()
+        if flaky_runs >= QUARANTINE_MIN_FLAKY_RUNS and flaky_runs / len(runs) >= QUARANTINE_FLAKE_RATE
+    )
+    unexplained_flaky_runs = [
+        run for run in runs
+        if run.flaky and not (run.failed_tests and set(run.failed_tests) <= set(quarantined_tests))
+    ]
+    flake_rate = len(unexplained_flaky_runs) / len(runs)
+    retry_limit = 0
+    if flake_rate >= RETRY_TWICE_FLAKE_RATE:
+        retry_limit = 2
+    elif flake_rate >= RETRY_FLAKE_RATE:
+        retry_limit = 1
+    return FlakePolicy(
+        quarantined_tests=quarantined_tests,
+        retry_limit=retry_limit,
+        soft_fail=flake_rate >= SOFT_FAIL_FLAKE_RATE,
+    )
+
+
+def _add_deselect_options(command: str, tests: List[str]) -> str:
+    """Deselect tests in a plain pytest command, other commands are left as they are."""
+    if "pytest" not in command.split() or any(operator in command for operator in ("&&", "||", ";", "|")):
+        return command
+    deselect_options = " ".join(f"--deselect {shlex.quote(test)}" for test in tests).replace("$", "$$")
+    return f"{command} {deselect_options}"
+
+
+def apply_flake_policy(buildkite_step: BuildkiteStep, policy: FlakePolicy, multi_node: bool = False) -> None:
+    """Add retry rules, soft_fail and deselect options for quarantined tests to a step."""
+    if policy.retry_limit:
+        buildkite_step.retry = {
+            "automatic": [*AGENT_RETRY_RULES, {"exit_status": "*", "limit": policy.retry_limit}],
+        }
+    if policy.soft_fail:
+        buildkite_step.soft_fail = True
+    if policy.quarantined_tests and not multi_node:
+        buildkite_step.commands = [
+            _add_deselect_options(command, policy.quarantined_tests) for command in buildkite_step.commands
+        ]
+
+
+def get_deselect_lists(flake_history: FlakeHistory) -> Dict[str, List[str]]:
+    """Quarantined tests per step key."""
+    deselect_lists = {}
+    for step_key, runs in flake_history.steps.items():
+        quarantined_tests = get_flake_policy(runs).quarantined_tests
+        if quarantined_tests:
+            deselect_lists[step_key] = quarantined_tests
+    return deselect_lists
+
+
+def _read_builds(file_paths: Iterable[str]) -> List[Dict]:
+    builds = []
+    for file_path in file_paths:
+        with open(file_path, "r") as f:
+            builds.extend(json.load(f))
+    return builds
+
+
+@click.command()
+@click.option("--flake_history", type=str, required=True, help="Path to the flake history JSON file, updated in place")
+@click.option("--builds", type=str, multiple=True, help="Path to a JSON list of Buildkite builds with their jobs")
+@click.option("--junit_dir", type=str, help="Directory with JUnit files as <build>/<step_key>/*.xml")
+@click.option("--deselect_list", type=str, help="If set, write the quarantined tests per step key to this JSON file")
+def main(flake_history: str, builds: List[str], junit_dir: Optional[str], deselect_list: Optional[str]):
+    """Ingest build history into the flake history and report the resulting policies."""
+    history = read_flake_history(flake_history)
+    update_flake_history(history, get_step_runs(_read_builds(builds), junit_dir))
+    write_flake_history(history, flake_history)
+
+    for step_key in sorted(history.steps):
+        policy = get_flake_policy(history.steps[step_key])
+        if policy != FlakePolicy():
+            click.echo(
+                f"{step_key}: retry {policy.retry_limit}, soft_fail {policy.soft_fail}, "
+                f"quarantined {', '.join(policy.quarantined_tests) or '-'}"
+            )
+    if deselect_list:
+        with open(deselect_list, "w") as f:
+            json.dump(get_deselect_lists(history), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import hashlib
+import subprocess
+from typing import Dict, List
+
+from .run_all import compile_prefix_patterns
+from .utils import IMAGE_INPUT_IGNORE_PATTERNS
+
+CONTENT_TAG_PREFIX = "content-"
+
+
+def get_image_content_hash(
+        repo_root: str = ".",
+        revision: str = "HEAD",
+        ignore_patterns: List[str] = IMAGE_INPUT_IGNORE_PATTERNS,
+    ) -> str:
+    """
+    Hash the files that go into the test image at a given revision.
+    Git already stores a content hash for every blob, so this only hashes the tree listing.
+    """
+    ignore_regex = compile_prefix_patterns(ignore_patterns)
+    tree = subprocess.run(
+        ["git", "ls-tree", "-r", "-z", revision],
+        cwd=repo_root,
+        capture_output=True,
+        check=True,
+    ).stdout
+    content_hash = hashlib.sha256()
+    for entry in tree.split(b"\0"):
+        if not entry:
+            continue
+        # Entry is "<mode> <type> <object>\t<path>", mode is kept since the executable bit matters
+        path = entry.split(b"\t", 1)[1].decode()
+        if ignore_regex and ignore_regex.match(path):
+            continue
+        content_hash.update(entry + b"\0")
+    return content_hash.hexdigest()
+
+
+def get_file_blobs(repo_root: str = ".", revision: str = "HEAD") -> Dict[str, str]:
+    """Map every file at a revision to its git blob hash."""
+    tree = subprocess.run(
+        ["git", "ls-tree", "-r", "-z", revision],
+        cwd=repo_root,
+        capture_output=True,
+        check=True,
+    ).stdout
+    blobs = {}
+    for entry in tree.split(b"\0"):
+        if not entry:
+            continue
+        info, path = entry.decode().split("\t", 1)
+        _, object_type, blob = info.split(" ")
+        if object_type == "blob":
+            blobs[path] = blob
+    return blobs
+
+
+def get_content_addressed_image(container_registry: str, container_registry_repo: str, content_hash: str) -> str:
+    return f"{container_registry}/{container_registry_repo}:{CONTENT_TAG_PREFIX}{content_hash}"
@@ -0,0 +1,410 @@
+import ast
+import bisect
+import os
+import posixpath
+import shlex
+import subprocess
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from .dependency_index import DependencyIndex
+from .image import get_file_blobs
+from .sharding import SHARD_FLAGS_REGEX
+from .step import DEFAULT_TEST_WORKING_DIR, IMAGE_WORKSPACE_DIR, TestStep
+
+IMPORT_CACHE_VERSION = 1
+# pytest options whose value is the next argument and may look like a path
+PYTEST_OPTIONS_WITH_VALUE = {"-k", "-m", "-p", "-c", "-o", "--ignore", "--ignore-glob", "--deselect", "--rootdir"}
+# Commands using these are not rewritten, the pytest invocation may not be the whole command
+SHELL_OPERATORS = ("&&", "||", ";", "|", "`", "$(")
+# Modules loaded by name at runtime, e.g. by the model registry, plugin entry points or worker classes
+# named in configs, and servers that tests start in a subprocess. The import graph does not see these
+# uses, so changes to them also unblock the steps whose source_file_dependencies match.
+RUNTIME_LOADED_PATHS = (
+    "vllm/model_executor/models/",
+    "vllm/plugins/",
+    "vllm/entrypoints/",
+    "vllm/worker/",
+    "vllm/executor/",
+)
+
+
+class CachedImports(BaseModel):
+    """Modules imported by a file, keyed by the git blob hash of its content."""
+    blob: str
+    imports: List[str]
+
+
+class ImportCache(BaseModel):
+    version: int = IMPORT_CACHE_VERSION
+    files: Dict[str, CachedImports] = {}
+
+
+def get_module_name(path: str) -> str:
+    """vllm/core/block.py -> vllm.core.block, vllm/core/__init__.py -> vllm.core"""
+    module = path[:-len(".py")].replace("/", ".")
+    if module.endswith(".__init__"):
+        module = module[:-len(".__init__")]
+    return module
+
+
+def get_imports(source: bytes, path: str) -> List[str]:
+    """
+    Return the absolute names of the modules a file imports, anywhere in the file.
+    `from a import b` yields both `a` and `a.b` since `b` may be a submodule.
+    Files that do not parse import nothing.
+    """
+    try:
+        tree = ast.parse(source, filename=path)
+    except (SyntaxError, ValueError):
+        return []
+    package = get_module_name(path).split(".")
+    if not path.endswith("__init__.py"):
+        package = package[:-1]
+
+    imports = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                if node.level - 1 > len(package):
+                    continue
+                base = package[:len(package) - node.level + 1]
+                module = ".".join(base + ([node.module] if node.module else []))
+            else:
+                module = node.module
+            if module:
+                imports.add(module)
+            imports.update(f"{module}.{alias.name}" if module else alias.name for alias in node.names if alias.name != "*")
+    return sorted(imports)
+
+
+def _read_blobs(repo_root: str, blobs: List[str]) -> List[bytes]:
+    """Read the content of many blobs with a single git process."""
+    if not blobs:
+        return []
+    output = subprocess.run(
+        ["git", "cat-file", "--batch"],
+        cwd=repo_root,
+        input="".join(f"{blob}\n" for blob in blobs).encode(),
+        capture_output=True,
+        check=True,
+    ).stdout
+    contents = []
+    position = 0
+    for _ in blobs:
+        header_end = output.index(b"\n", position)
+        size = int(output[position:header_end].split(b" ")[2])
+        contents.append(output[header_end + 1:header_end + 1 + size])
+        position = header_end + 1 + size + 1
+    return contents
+
+
+def update_import_cache(cache: ImportCache, repo_root: str = ".", revision: str = "HEAD") -> int:
+    """
+    Bring the cache up to date with a revision, parsing only the files whose content changed.
+    Return the number of files parsed.
+    """
+    blobs = {path: blob for path, blob in get_file_blobs(repo_root, revision).items() if path.endswith(".py")}
+    for path in set(cache.files) - set(blobs):
+        del cache.files[path]
+    changed_paths = [path for path, blob in blobs.items() if path not in cache.files or cache.files[path].blob != blob]
+    for path, source in zip(changed_paths, _read_blobs(repo_root, [blobs[path] for path in changed_paths])):
+        cache.files[path] = CachedImports(blob=blobs[path], imports=get_imports(source, path))
+    return len(changed_paths)
+
+
+def read_import_cache(file_path: str) -> ImportCache:
+    """Read the import cache, starting over if it is missing or from another version."""
+    if os.path.exists(file_path):
+        with open(file_path, "r") as f:
+            cache = ImportCache.model_validate_json(f.read())
+        if cache.version == IMPORT_CACHE_VERSION:
+            return cache
+    return ImportCache()
+
+
+def write_import_cache(cache: ImportCache, file_path: str) -> None:
+    with open(file_path, "w") as f:
+        f.write(cache.model_dump_json())
+
+
+class ImportGraph:
+    """
+    Reverse dependency graph between the Python files of a repository.
+
+    An import of `a.b.c` depends on the file of the longest known module prefix
+    (`a.b.c` or `a.b` when `c` is a name defined in it) and on the `__init__.py`
+    of every package on the way, since importing a module runs them.
+    """
+
+    def __init__(self, cache: ImportCache):
+        self.files: List[str] = sorted(cache.files)
+        module_files = {get_module_name(path): path for path in cache.files}
+        self.importers: Dict[str, Set[str]] = defaultdict(set)
+        self.dependencies: Dict[str, Set[str]] = defaultdict(set)
+        for path, cached_imports in cache.files.items():
+            for module in cached_imports.imports:
+                parts = module.split(".")
+                for end in range(1, len(parts) + 1):
+                    dependency = module_files.get(".".join(parts[:end]))
+                    if dependency and dependency != path:
+                        self.importers[dependency].add(path)
+                        self.dependencies[path].add(dependency)
+
+    def _get_closure(self, files: Iterable[str], edges: Dict[str, Set[str]]) -> Set[str]:
+        closure = set(files) & set(self.files)
+        queue = deque(closure)
+        while queue:
+            for file in edges.get(queue.popleft(), ()):
+                if file not in closure:
+                    closure.add(file)
+                    queue.append(file)
+        return closure
+
+    def get_dependents(self, files: Iterable[str]) -> Set[str]:
+        """Return the given files and every file that imports one of them, directly or not."""
+        return self._get_closure(files, self.importers)
+
+    def get_dependencies(self, files: Iterable[str]) -> Set[str]:
+        """Return the given files and every file they import, directly or not."""
+        return self._get_closure(files, self.dependencies)
+
+
+def _get_repo_dir(working_dir: Optional[str]) -> str:
+    """Map a step's working directory in the image to a directory of the repository."""
+    relative_dir = posixpath.relpath(working_dir or DEFAULT_TEST_WORKING_DIR, IMAGE_WORKSPACE_DIR)
+    return "" if relative_dir == "." else relative_dir
+
+
+def _get_files_under(files: List[str], path: str) -> List[str]:
+    """Return the file at `path` or the files below it, `files` being sorted."""
+    if path == ".":
+        return files
+    index = bisect.bisect_left(files, path)
+    if index < len(files) and files[index] == path:
+        return [path]
+    prefix = path + "/"
+    start = bisect.bisect_left(files, prefix, lo=index)
+    end = bisect.bisect_left(files, prefix + "\uffff", lo=start)
+    return files[start:end]
+
+
+def get_test_targets(step: TestStep, files: List[str]) -> Optional[Set[str]]:
+    """
+    Return the Python files a step runs: files and directories named in its commands
+    (relative to its working directory), plus the conftest.py files pytest loads for them.
+    Return None if there is none, the step then relies on its source_file_dependencies.
+    `files` is the sorted list of Python files of the repository.
+    """
+    current_dir = _get_repo_dir(step.working_dir)
+    targets = set()
+    for command in step.commands:
+        try:
+            tokens = shlex.split(command)
+        except ValueError:
+            return None
+        for index, token in enumerate(tokens):
+            if token == "cd" and index + 1 < len(tokens):
+                current_dir = posixpath.normpath(posixpath.join(current_dir, tokens[index + 1]))
+            elif not token.startswith("-"):
+                path = posixpath.normpath(posixpath.join(current_dir, token.split("::")[0].rstrip(";")))
+                targets.update(_get_files_under(files, path))
+    if not targets:
+        return None
+
+    conftests = set()
+    for directory in {posixpath.dirname(target) for target in targets}:
+        while True:
+            conftests.update(_get_files_under(files, posixpath.join(directory, "conftest.py")))
+            if not directory:
+                break
+            directory = posixpath.dirname(directory)
+    return targets | conftests
+
+
+def _split_file_diff(
+        list_file_diff: List[str],
+        graph: ImportGraph,
+        targets: Set[str],
+        runtime_loaded_paths: Iterable[str],
+    ) -> Tuple[List[str], List[str]]:
+    """
+    Split the diff into the Python files the import graph follows (imported ones and test targets)
+    and the others: other files, Python files nothing imports and files loaded by name at runtime.
+    """
+    runtime_loaded_paths = tuple(runtime_loaded_paths)
+    graph_changes, other_changes = [], []
+    for file in list_file_diff:
+        followed = (graph.importers.get(file) or file in targets) and not file.startswith(runtime_loaded_paths)
+        (graph_changes if followed else other_changes).append(file)
+    return graph_changes, other_changes
+
+
+def get_impacted_step_labels(
+        test_steps: List[TestStep],
+        list_file_diff: List[str],
+        graph: ImportGraph,
+        runtime_loaded_paths: Iterable[str] = RUNTIME_LOADED_PATHS,
+    ) -> Set[str]:
+    """
+    Return labels of the steps with source_file_dependencies that the file diff can affect.
+
+    A changed Python file the import graph follows only affects the steps whose test targets import
+    it, directly or not, even if their source_file_dependencies match it. Other changed files, and
+    every change for steps without test targets, fall back to source_file_dependencies.
+    """
+    steps = [step for step in test_steps if step.source_file_dependencies]
+    targets_by_label = {step.label: get_test_targets(step, graph.files) for step in steps}
+    all_targets = set().union(*(targets for targets in targets_by_label.values() if targets))
+    graph_changes, other_changes = _split_file_diff(list_file_diff, graph, all_targets, runtime_loaded_paths)
+
+    impacted = DependencyIndex(steps).match(other_changes)
+    unanalyzed_steps = [step for step in steps if targets_by_label[step.label] is None]
+    impacted |= DependencyIndex(unanalyzed_steps).match(graph_changes)
+    dependents = graph.get_dependents(graph_changes)
+    impacted |= {
+        label for label, targets in targets_by_label.items()
+        if targets is not None and not targets.isdisjoint(dependents)
+    }
+    return impacted
+
+
+def get_import_graph(repo_root: str = ".", cache_path: Optional[str] = None) -> ImportGraph:
+    """Build the import graph of the checked out revision, reusing and refreshing the on-disk cache if given."""
+    cache = read_import_cache(cache_path) if cache_path else ImportCache()
+    update_import_cache(cache, repo_root)
+    if cache_path:
+        write_import_cache(cache, cache_path)
+    return ImportGraph(cache)
+
+
+def _is_test_file(path: str) -> bool:
+    """Files pytest collects from a directory by default."""
+    name = posixpath.basename(path)
+    return name.endswith(".py") and (name.startswith("test_") or name.endswith("_test.py"))
+
+
+def _split_command(command: str) -> List[Tuple[str, str]]:
+    """
+    Split a command into (token as written, token value) pairs, as the shell does for plain words
+    and quotes, so that a selected command can keep its other tokens as written.
+    Raise ValueError on unbalanced quotes.
+    """
+    raw_tokens = []
+    current = ""
+    quote = None
+    escaped = False
+    for char in command:
+        if escaped:
+            current += char
+            escaped = False
+        elif char == "\\" and quote != "'":
+            current += char
+            escaped = True
+        elif quote:
+            current += char
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            current += char
+            quote = char
+        elif char.isspace():
+            if current:
+                raw_tokens.append(current)
+            current = ""
+        else:
+            current += char
+    if quote or escaped:
+        raise ValueError(f"Unbalanced quotes in {command}")
+    if current:
+        raw_tokens.append(current)
+    return [(raw_token, "".join(shlex.split(raw_token))) for raw_token in raw_tokens]
+
+
+def _select_pytest_command(tokens: List[Tuple[str, str]], current_dir: str, files: List[str], affected: Set[str]) -> Optional[str]:
+    """
+    Narrow the test paths of a pytest command, split by _split_command, to the affected test files.
+    Return "" if it runs none of them, None if it has no test path (pytest would collect from its rootdir).
+    """
+    selected_tokens = []
+    found_paths = False
+    selected_paths = False
+    is_option_value = False
+    for raw_token, token in tokens:
+        if is_option_value or token.startswith("-") or "=" in token:
+            is_option_value = not is_option_value and token in PYTEST_OPTIONS_WITH_VALUE
+            selected_tokens.append(raw_token)
+            continue
+        path = posixpath.normpath(posixpath.join(current_dir, token.split("::")[0]))
+        files_under = _get_files_under(files, path)
+        if not files_under:
+            selected_tokens.append(raw_token)
+            continue
+        found_paths = True
+        if files_under == [path]:
+            selected_files = [raw_token] if path in affected else []
+        else:
+            selected_files = [
+                shlex.quote(posixpath.relpath(file, current_dir or "."))
+                for file in files_under if file in affected and _is_test_file(file)
+            ]
+        selected_tokens.extend(selected_files)
+        selected_paths = selected_paths or bool(selected_files)
+    if not found_paths:
+        return None
+    return " ".join(selected_tokens) if selected_paths else ""
+
+
+def get_selected_test_step(
+        step: TestStep,
+        list_file_diff: List[str],
+        graph: ImportGraph,
+        runtime_loaded_paths: Iterable[str] = RUNTIME_LOADED_PATHS,
+    ) -> Optional[TestStep]:
+    """
+    Return a copy of the step whose pytest commands only run the test files the diff affects,
+    or None when that is uncertain and the step should run in full: a change the graph does not
+    follow (see get_impacted_step_labels) matches its source_file_dependencies, a conftest.py it
+    loads is affected, or a command is not a plain pytest invocation.
+    A step narrowed to a few files also drops its pytest-shard flags and runs as a single job.
+    """
+    targets = get_test_targets(step, graph.files)
+    if targets is None or (step.num_nodes and step.num_nodes > 1):
+        return None
+    graph_changes, other_changes = _split_file_diff(list_file_diff, graph, targets, runtime_loaded_paths)
+    if DependencyIndex([step]).match(other_changes):
+        return None
+    affected = graph.get_dependents(graph_changes)
+    if any(posixpath.basename(target) == "conftest.py" for target in targets & affected):
+        return None
+
+    current_dir = _get_repo_dir(step.working_dir)
+    commands = []
+    sharded = False
+    for command in step.commands:
+        try:
+            tokens = _split_command(command)
+        except ValueError:
+            return None
+        values = [token for _, token in tokens]
+        if "pytest" not in values:
+            if "cd" in values:
+                return None
+            commands.append(command)
+            continue
+        if any(operator in command for operator in SHELL_OPERATORS):
+            return None
+        selected_command = _select_pytest_command(tokens, current_dir, graph.files, affected)
+        if selected_command is None:
+            return None
+        if selected_command:
+            sharded = sharded or bool(SHARD_FLAGS_REGEX.search(selected_command))
+            commands.append(SHARD_FLAGS_REGEX.sub("", selected_command).rstrip())
+    if commands == step.commands or not any("pytest" in shlex.split(command) for command in commands):
+        return None
+    if step.parallelism and not sharded:
+        return None
+    return step.model_copy(update={"commands": commands, "parallelism": None})
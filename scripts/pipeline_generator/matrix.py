@@ -0,0 +1,122 @@
+import enum
+from typing import TYPE_CHECKING, Iterator, List, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+from .utils import AMD_REPO, SEPARATE_IMAGE_STAGES, ImageStage
+
+if TYPE_CHECKING:
+    from .step import TestStep
+
+# The CUDA version the Dockerfile builds without a CUDA_VERSION build arg
+DEFAULT_CUDA_VERSION = "default"
+AMD_BUILD_STEP_KEY = "amd-build"
+
+
+class Hardware(str, enum.Enum):
+    CUDA = "cuda"
+    AMD = "amd"
+
+
+class Matrix(BaseModel):
+    """Axes a test step runs across, every combination of their values being a separate Buildkite step."""
+    cuda_version: List[str] = [DEFAULT_CUDA_VERSION]
+    hardware: List[Hardware] = [Hardware.CUDA]
+
+
+class MatrixFilter(BaseModel):
+    """Values each axis is restricted to, None keeps all of them."""
+    cuda_version: Optional[List[str]] = None
+    hardware: Optional[List[Hardware]] = None
+
+
+class MatrixCell(BaseModel):
+    """One combination of axis values."""
+    model_config = ConfigDict(frozen=True)
+
+    cuda_version: str = DEFAULT_CUDA_VERSION
+    hardware: Hardware = Hardware.CUDA
+
+    @property
+    def cuda_tag(self) -> str:
+        """e.g. "cu121" for CUDA 12.1.0, empty for the default version."""
+        if self.cuda_version == DEFAULT_CUDA_VERSION:
+            return ""
+        return "cu" + "".join(self.cuda_version.split(".")[:2])
+
+    @property
+    def name(self) -> str:
+        """Suffix of the steps of the cell, empty for the default cell so that their labels and keys do not change."""
+        if self.hardware != Hardware.CUDA:
+            return self.hardware.value
+        return self.cuda_tag
+
+    @property
+    def build_step_key(self) -> str:
+        # Imported here as step imports this module
+        from .step import BUILD_STEP_KEY
+        if self.hardware == Hardware.AMD:
+            return AMD_BUILD_STEP_KEY
+        return f"{BUILD_STEP_KEY}-{self.cuda_tag}" if self.cuda_tag else BUILD_STEP_KEY
+
+
+DEFAULT_MATRIX_CELL = MatrixCell()
+# PRs only run the default CUDA version, on CUDA hardware and the AMD mirrors, nightly builds run every combination
+PR_MATRIX_FILTER = MatrixFilter(cuda_version=[DEFAULT_CUDA_VERSION])
+NIGHTLY_MATRIX_FILTER = MatrixFilter()
+
+
+def get_step_matrix(test_step: "TestStep") -> Matrix:
+    """The step's matrix, with AMD added by `mirror_hardwares`."""
+    matrix = test_step.matrix or Matrix()
+    if test_step.mirror_hardwares and Hardware.AMD.value in test_step.mirror_hardwares and Hardware.AMD not in matrix.hardware:
+        matrix = matrix.model_copy(update={"hardware": [*matrix.hardware, Hardware.AMD]})
+    return matrix
+
+
+def iter_matrix_cells(test_step: "TestStep", matrix_filter: MatrixFilter) -> Iterator[MatrixCell]:
+    """
+    Combinations of the step's axis values allowed by the filter. CUDA versions only apply to CUDA
+    hardware, and multi-node steps only run on CUDA hardware.
+    """
+    matrix = get_step_matrix(test_step)
+    multi_node = bool(test_step.num_nodes and test_step.num_nodes > 1)
+    for hardware in matrix.hardware:
+        if matrix_filter.hardware is not None and hardware not in matrix_filter.hardware:
+            continue
+        if hardware != Hardware.CUDA and multi_node:
+            continue
+        cuda_versions = matrix.cuda_version if hardware == Hardware.CUDA else [DEFAULT_CUDA_VERSION]
+        for cuda_version in cuda_versions:
+            if matrix_filter.cuda_version is not None and cuda_version not in matrix_filter.cuda_version:
+                continue
+            yield MatrixCell(cuda_version=cuda_version, hardware=hardware)
+
+
+def get_cell_test_step(test_step: "TestStep", cell: MatrixCell) -> "TestStep":
+    if not cell.name:
+        return test_step
+    return test_step.model_copy(update={"label": f"{test_step.label} ({cell.name})"})
+
+
+def get_cell_image(cell: MatrixCell, container_image: str, commit: str) -> str:
+    """Image of the cell, given the default image `container_image` of the commit."""
+    if cell.hardware == Hardware.AMD:
+        return f"{AMD_REPO}:{commit}"
+    return f"{container_image}-{cell.cuda_tag}" if cell.cuda_tag else container_image
+
+
+def get_build_step_key(cell: MatrixCell, stage: ImageStage = ImageStage.TEST) -> str:
+    """Key of the step building the image of a cell, up to a stage."""
+    return f"{cell.build_step_key}-{stage.value}" if stage in SEPARATE_IMAGE_STAGES else cell.build_step_key
+
+
+def parse_matrix_filter(values: List[str]) -> MatrixFilter:
+    """Parse "axis=value1,value2" options, e.g. "cuda_version=default,12.1.0"."""
+    axes = {}
+    for value in values:
+        axis, separator, axis_values = value.partition("=")
+        if not separator or axis not in MatrixFilter.model_fields:
+            raise ValueError(f"Invalid matrix filter {value}, expected one of {list(MatrixFilter.model_fields)}=value,...")
+        axes[axis] = [axis_value for axis_value in axis_values.split(",") if axis_value]
+    return MatrixFilter(**axes)
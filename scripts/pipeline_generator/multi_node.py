@@ -0,0 +1,256 @@
+"""
+Launcher of multi-node test steps: one container per node on a shared Docker network, organized into a
+Ray cluster, each node running its own command.
+
+Nodes are started concurrently and wait for each other at readiness barriers instead of fixed sleeps.
+Every node's output is streamed with a "[nodeN]" prefix. The first node command that fails stops all
+the others. Containers and the network are always removed at the end.
+
+This file runs on the agent host, outside of the test image and the generator's environment, so it
+only uses the standard library.
+
+Usage: python3 multi_node.py --spec '{"num_nodes": 2, "num_gpus": 2, "commands": [...], ...}'
+"""
+import argparse
+import dataclasses
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, List, Optional
+
+NETWORK_NAME = "docker-net"
+NETWORK_SUBNET = "192.168.10.0/24"
+# Test commands reach the head node at 192.168.10.10, the other nodes follow
+NODE_IP_PREFIX = "192.168.10."
+HEAD_NODE_IP_SUFFIX = 10
+RAY_PORT = 6379
+HOST_HF_CACHE = "~/.cache/huggingface"
+CONTAINER_HF_CACHE = "/root/.cache/huggingface"
+SHM_SIZE = "10.24gb"
+DEFAULT_READY_TIMEOUT = 300  # seconds
+READY_POLL_INTERVAL = 1  # seconds
+NOT_READY_EXIT_STATUS = 124
+
+
+class NodesNotReady(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class MultiNodeSpec:
+    """What a multi-node test step runs: one command per node, each node with `num_gpus` GPUs."""
+    num_nodes: int
+    num_gpus: int
+    commands: List[str]
+    working_dir: str
+    image: str
+
+    def __post_init__(self):
+        if len(self.commands) != self.num_nodes:
+            raise ValueError("Number of commands must match the number of nodes.")
+
+    def to_json(self) -> str:
+        return json.dumps(dataclasses.asdict(self))
+
+    @classmethod
+    def from_json(cls, spec: str) -> "MultiNodeSpec":
+        return cls(**json.loads(spec))
+
+
+def get_node_name(node: int) -> str:
+    return f"node{node}"
+
+
+def get_node_ip(node: int) -> str:
+    return f"{NODE_IP_PREFIX}{HEAD_NODE_IP_SUFFIX + node}"
+
+
+def get_gpu_devices(node: int, num_gpus: int) -> str:
+    """GPUs of a node, in `docker run --gpus` syntax: node 1 of 2-GPU nodes gets "device=2,3"."""
+    devices = ",".join(str(node * num_gpus + gpu) for gpu in range(num_gpus))
+    return f'"device={devices}"'
+
+
+def get_cluster_size_check_command(num_nodes: int) -> str:
+    """Exits 0 once the Ray cluster has all its nodes."""
+    check = (
+        "import ray, sys; ray.init(address='auto', logging_level='ERROR'); "
+        f"sys.exit(0 if sum(node['Alive'] for node in ray.nodes()) >= {num_nodes} else 1)"
+    )
+    return f'python3 -c "{check}"'
+
+
+class DockerRuntime:
+    """Containers run with the Docker CLI."""
+
+    def create_network(self, network: str, subnet: str) -> None:
+        subprocess.run(["docker", "network", "create", f"--subnet={subnet}", network], check=True)
+
+    def remove_network(self, network: str) -> None:
+        subprocess.run(["docker", "network", "rm", network])
+
+    def start_container(self, name: str, image: str, gpu_devices: str, network: str, ip: str) -> None:
+        subprocess.run(
+            [
+                "docker", "run", "-d", "--rm",
+                "--gpus", gpu_devices,
+                # Needed by NCCL, --ipc=host is not used so that nodes do not share memory
+                f"--shm-size={SHM_SIZE}",
+                "-e", "HF_TOKEN",
+                "-v", f"{os.path.expanduser(HOST_HF_CACHE)}:{CONTAINER_HF_CACHE}",
+                "--name", name,
+                "--network", network,
+                "--ip", ip,
+                image,
+                "/bin/bash", "-c", "tail -f /dev/null",
+            ],
+            check=True,
+        )
+
+    def stop_container(self, name: str) -> None:
+        subprocess.run(["docker", "stop", name])
+
+    def exec(self, name: str, command: str, detach: bool = False) -> subprocess.Popen:
+        """Run a command in the container, with its output (stdout and stderr) readable from the returned process."""
+        return subprocess.Popen(
+            ["docker", "exec", *(["-d"] if detach else []), name, "/bin/bash", "-c", command],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+
+
+class MultiNodeLauncher:
+    def __init__(
+            self,
+            spec: MultiNodeSpec,
+            runtime=None,
+            output: Optional[IO[str]] = None,
+            ready_timeout: float = DEFAULT_READY_TIMEOUT,
+        ):
+        self.spec = spec
+        self.runtime = runtime or DockerRuntime()
+        self.output = output or sys.stdout
+        self.ready_timeout = ready_timeout
+        self.nodes = range(spec.num_nodes)
+        self.output_lock = threading.Lock()
+        self.processes: List[subprocess.Popen] = []
+
+    def log(self, node: Optional[int], line: str) -> None:
+        prefix = f"[{get_node_name(node)}] " if node is not None else ""
+        with self.output_lock:
+            self.output.write(f"{prefix}{line.rstrip()}\n")
+            self.output.flush()
+
+    def wait_until_ready(self, node: int, command: str, description: str) -> None:
+        """Barrier: run the command on the node until it succeeds, fail once the timeout is reached."""
+        deadline = time.monotonic() + self.ready_timeout
+        while True:
+            process = self.runtime.exec(get_node_name(node), command)
+            process.communicate()
+            if process.returncode == 0:
+                self.log(None, f"{description}: ready")
+                return
+            if time.monotonic() >= deadline:
+                raise NodesNotReady(f"{description}: not ready after {self.ready_timeout}s")
+            time.sleep(READY_POLL_INTERVAL)
+
+    def start_cluster(self) -> None:
+        """Start all containers at once, then the Ray head, then all Ray workers at once."""
+        self.runtime.create_network(NETWORK_NAME, NETWORK_SUBNET)
+        with ThreadPoolExecutor(max_workers=self.spec.num_nodes) as executor:
+            # Consumed to wait for every container and to raise the first error
+            list(executor.map(
+                lambda node: self.runtime.start_container(
+                    get_node_name(node),
+                    self.spec.image,
+                    get_gpu_devices(node, self.spec.num_gpus),
+                    NETWORK_NAME,
+                    get_node_ip(node),
+                ),
+                self.nodes,
+            ))
+            head = get_node_name(0)
+            self.runtime.exec(head, f"ray start --head --port={RAY_PORT} --block", detach=True).wait()
+            self.wait_until_ready(0, "ray status", "Ray head")
+            list(executor.map(
+                lambda node: self.runtime.exec(
+                    get_node_name(node),
+                    f"ray start --address={get_node_ip(0)}:{RAY_PORT} --block",
+                    detach=True,
+                ).wait(),
+                self.nodes[1:],
+            ))
+        self.wait_until_ready(0, get_cluster_size_check_command(self.spec.num_nodes), "Ray cluster")
+
+    def stream(self, node: int, process: subprocess.Popen) -> None:
+        for line in process.stdout:
+            self.log(node, line)
+
+    def run_commands(self) -> int:
+        """Run every node's command, return the exit status of the first one to fail, or 0."""
+        self.processes = [
+            self.runtime.exec(get_node_name(node), f"cd {self.spec.working_dir} ; {self.spec.commands[node]}")
+            for node in self.nodes
+        ]
+        streams = [
+            threading.Thread(target=self.stream, args=(node, process), daemon=True)
+            for node, process in zip(self.nodes, self.processes)
+        ]
+        for thread in streams:
+            thread.start()
+        running = set(self.nodes)
+        while running:
+            for node in sorted(running):
+                returncode = self.processes[node].poll()
+                if returncode is None:
+                    continue
+                running.discard(node)
+                self.log(None, f"{get_node_name(node)} exited with status {returncode}")
+                if returncode != 0:
+                    return returncode
+            time.sleep(0.1)
+        for thread in streams:
+            thread.join()
+        return 0
+
+    def cleanup(self) -> None:
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+        with ThreadPoolExecutor(max_workers=self.spec.num_nodes) as executor:
+            list(executor.map(lambda node: self.runtime.stop_container(get_node_name(node)), self.nodes))
+        self.runtime.remove_network(NETWORK_NAME)
+
+    def run(self) -> int:
+        try:
+            self.start_cluster()
+            return self.run_commands()
+        except NodesNotReady as e:
+            self.log(None, str(e))
+            return NOT_READY_EXIT_STATUS
+        finally:
+            self.cleanup()
+
+
+def _exit_on_sigterm(signum, frame):
+    # Raised in the main thread so that the launcher cleans up when Buildkite cancels the job
+    sys.exit(128 + signum)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a multi-node test step.")
+    parser.add_argument("--spec", type=str, required=True, help="JSON multi-node spec")
+    parser.add_argument("--ready_timeout", type=float, default=DEFAULT_READY_TIMEOUT, help="Seconds to wait at each readiness barrier")
+    args = parser.parse_args(argv)
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    return MultiNodeLauncher(MultiNodeSpec.from_json(args.spec), ready_timeout=args.ready_timeout).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
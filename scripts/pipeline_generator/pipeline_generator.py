@@ -1,13 +1,60 @@
 import click
 import os
 import re
-from typing import List, Optional, Union
+import subprocess
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple, Union
 import yaml
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator
 
-from .step import BuildkiteStep, BuildkiteBlockStep, TestStep
-from .utils import VLLM_ECR_URL, VLLM_ECR_REPO, AgentQueue
-from .pipeline_generator_helper import get_build_commands
+try:
+    from yaml import CDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import Dumper as YamlDumper, SafeLoader as YamlLoader
+
+from .step import BUILD_STEP_KEY, BuildkiteStep, BuildkiteBlockStep, BuildkiteWaitStep, TestStep, get_block_step, get_step_key, get_working_dir
+from .utils import (
+    AGENT_RETRY_RULES,
+    IMAGE_STAGE_TARGETS,
+    SEPARATE_IMAGE_STAGES,
+    PIPELINE_FILE_PATH,
+    STEPS_TO_BLOCK,
+    VLLM_ECR_REPO_NAME,
+    VLLM_ECR_URL,
+    AgentQueue,
+    ImageStage,
+)
+from .pipeline_generator_helper import (
+    add_checkpoint,
+    add_profiler,
+    convert_test_step_to_amd_buildkite_step,
+    convert_test_step_to_buildkite_step,
+    get_amd_build_commands,
+    get_bake_build_commands,
+    get_build_commands,
+)
+from .build_cache import BuildCache, ImageBuild, get_build_cache
+from .matrix import (
+    DEFAULT_MATRIX_CELL,
+    NIGHTLY_MATRIX_FILTER,
+    PR_MATRIX_FILTER,
+    Hardware,
+    MatrixCell,
+    MatrixFilter,
+    get_build_step_key,
+    get_cell_image,
+    get_cell_test_step,
+    iter_matrix_cells,
+    parse_matrix_filter,
+)
+from .dag import get_critical_path, validate_dag
+from .diff import MAIN_REF, get_file_diff
+from .dependency_index import DependencyIndex
+from .run_all import RunAllMatcher
+from .sharding import ShardPlan, TimingDatabase, DEFAULT_SHARD_TARGET_DURATION, get_shard_plan, read_timing_database
+
+if TYPE_CHECKING:
+    from .flaky import FlakeHistory
+    from .impact import ImportGraph
 
 class PipelineGeneratorConfig:
     def __init__(
@@ -17,8 +64,36 @@ class PipelineGeneratorConfig:
         commit: str,
         list_file_diff: List[str],
         run_all: bool = False,
+        nightly: bool = False,
+        timing_database: Optional[TimingDatabase] = None,
+        shard_target_duration: float = DEFAULT_SHARD_TARGET_DURATION,
+        coalesce_budget: Optional[float] = None,
+        image_content_hash: Optional[str] = None,
+        import_graph: Optional["ImportGraph"] = None,
+        result_store_url: Optional[str] = None,
+        file_blobs: Optional[Dict[str, str]] = None,
+        flake_history: Optional["FlakeHistory"] = None,
+        checkpoint_tests: bool = False,
+        matrix_filter: Optional[MatrixFilter] = None,
+        build_cache: Optional[BuildCache] = None,
+        bake: bool = False,
+        profile_steps: bool = False,
     ):
         self.run_all = run_all
+        self.nightly = nightly
+        self.timing_database = timing_database
+        self.shard_target_duration = shard_target_duration
+        self.coalesce_budget = coalesce_budget
+        self.image_content_hash = image_content_hash
+        self.import_graph = import_graph
+        self.result_store_url = result_store_url
+        self.file_blobs = file_blobs
+        self.flake_history = flake_history
+        self.checkpoint_tests = checkpoint_tests
+        self.matrix_filter = matrix_filter
+        self.build_cache = build_cache
+        self.bake = bake
+        self.profile_steps = profile_steps
         self.list_file_diff = list_file_diff
         self.container_registry = container_registry
         self.container_registry_repo = container_registry_repo
@@ -27,6 +102,24 @@ class PipelineGeneratorConfig:
     @property
     def container_image(self):
         return f"{self.container_registry}/{self.container_registry_repo}:{self.commit}"
+
+    def get_matrix_filter(self) -> MatrixFilter:
+        """Matrix cells to run: the given filter, or the cheap cells on PRs and every cell in nightly builds."""
+        if self.matrix_filter:
+            return self.matrix_filter
+        return NIGHTLY_MATRIX_FILTER if self.nightly else PR_MATRIX_FILTER
+
+    def get_image(self, cell: MatrixCell = DEFAULT_MATRIX_CELL, stage: ImageStage = ImageStage.TEST) -> str:
+        """Image of a matrix cell, up to a stage."""
+        image = get_cell_image(cell, self.container_image, self.commit)
+        return image if stage == ImageStage.TEST else f"{image}-{stage.value}"
+
+    @property
+    def content_addressed_image(self) -> Optional[str]:
+        if not self.image_content_hash:
+            return None
+        from .image import get_content_addressed_image
+        return get_content_addressed_image(self.container_registry, self.container_registry_repo, self.image_content_hash)
     
     def validate(self):
         """Validate the configuration."""
@@ -43,49 +136,417 @@ class PipelineGenerator:
         ):
         config.validate()
         self.config = config
+        # Input fingerprints of the steps that run, by step key, for recording their results
+        self.step_fingerprints: Dict[str, str] = {}
+        # Images the test steps use, by matrix cell and stage, and whether any of their steps is unblocked
+        self.images: Dict[Tuple[MatrixCell, ImageStage], bool] = {}
+        # Longest chain of dependent steps and its estimated duration, with a timing database
+        self.critical_path: Optional[Tuple[List[str], float]] = None
+
+    def get_chained_image_stages(self, cell: MatrixCell) -> List[ImageStage]:
+        """Earlier stages of the cell's image the test steps use, pushed by the build of its full image."""
+        return [
+            stage for stage in ImageStage
+            if stage != ImageStage.TEST and stage not in SEPARATE_IMAGE_STAGES and (cell, stage) in self.images
+        ]
 
-    def generate_build_step(self) -> BuildkiteStep:
-        """Build the Docker image and push it to container registry."""
-        build_commands = get_build_commands(self.config.container_registry, self.config.commit, self.config.container_image)
+    def generate_build_step(self, cell: MatrixCell = DEFAULT_MATRIX_CELL, stage: ImageStage = ImageStage.TEST) -> BuildkiteStep:
+        """Build the Docker image of a matrix cell, up to a stage, and push it to container registry."""
+        image = self.config.get_image(cell, stage)
+        if cell.hardware == Hardware.AMD:
+            return BuildkiteStep(
+                label="AMD: :docker: build image",
+                key=cell.build_step_key,
+                agents={"queue": AgentQueue.AMD_CPU.value},
+                env={"DOCKER_BUILDKIT": "1"},
+                soft_fail=True,
+                # AMD builders also fail occasionally
+                retry={"automatic": [*AGENT_RETRY_RULES, {"exit_status": 1, "limit": 1}]},
+                commands=get_amd_build_commands(image),
+                depends_on=None,
+            )
+        stage_images = {
+            IMAGE_STAGE_TARGETS[chained_stage]: self.config.get_image(cell, chained_stage)
+            for chained_stage in (self.get_chained_image_stages(cell) if stage == ImageStage.TEST else [])
+        }
+        # Retagging an image of the same content would leave the images of earlier stages missing
+        content_addressed = (cell, stage) == (DEFAULT_MATRIX_CELL, ImageStage.TEST) and not stage_images
+        build_commands = get_build_commands(
+            self.config.container_registry,
+            self.config.commit,
+            image,
+            self.config.content_addressed_image if content_addressed else None,
+            cell.cuda_version if cell.cuda_tag else None,
+            IMAGE_STAGE_TARGETS[stage],
+            self.config.build_cache,
+            stage_images,
+        )
+        stage_name = "" if stage == ImageStage.TEST else stage.value
 
         return BuildkiteStep(
-            label=":docker: build image",
-            key="build",
+            label=f":docker: build image {cell.name} {stage_name}".replace("  ", " ").rstrip(),
+            key=get_build_step_key(cell, stage),
             agents={"queue": AgentQueue.AWS_CPU.value},
             env={"DOCKER_BUILDKIT": "1"},
-            retry={
-                "automatic": [
-                    {"exit_status": -1, "limit": 2},
-                    {"exit_status": -10, "limit": 2}
-                ]
-            },
+            retry={"automatic": AGENT_RETRY_RULES},
             commands=build_commands,
             depends_on=None,
         )
 
+    def generate_bake_step(self) -> BuildkiteStep:
+        """Build the full images of all CUDA versions the test steps use in parallel, in one step."""
+        cells = dict.fromkeys([DEFAULT_MATRIX_CELL, *(
+            cell for cell, stage in self.images
+            if self.get_build_step_key(cell, stage) == BUILD_STEP_KEY
+        )])
+        image_builds = []
+        for cell in cells:
+            name = f"image-{cell.name}" if cell.name else "image"
+            cuda_version = cell.cuda_version if cell.cuda_tag else None
+            # BuildKit builds the layers shared by the targets of one bake once
+            image_builds.extend(
+                ImageBuild(
+                    name=f"{name}-{stage.value}",
+                    tags=[self.config.get_image(cell, stage)],
+                    target=IMAGE_STAGE_TARGETS[stage],
+                    cuda_version=cuda_version,
+                )
+                for stage in self.get_chained_image_stages(cell)
+            )
+            image_builds.append(ImageBuild(name=name, tags=[self.config.get_image(cell)], cuda_version=cuda_version))
+        if self.config.content_addressed_image and not self.get_chained_image_stages(DEFAULT_MATRIX_CELL):
+            image_builds[0].tags.append(self.config.content_addressed_image)
+        return BuildkiteStep(
+            label=":docker: build images",
+            key=BUILD_STEP_KEY,
+            agents={"queue": AgentQueue.AWS_CPU.value},
+            env={"DOCKER_BUILDKIT": "1"},
+            retry={"automatic": AGENT_RETRY_RULES},
+            commands=get_bake_build_commands(
+                self.config.container_registry,
+                self.config.commit,
+                image_builds,
+                self.config.build_cache,
+            ),
+            depends_on=None,
+        )
+
+    def get_build_step_key(self, cell: MatrixCell, stage: ImageStage) -> str:
+        """With bake, the full CUDA images, and the stages pushed with them, are all built by the build step."""
+        key = get_build_step_key(cell, stage)
+        if self.config.bake and cell.hardware == Hardware.CUDA and key == cell.build_step_key:
+            return BUILD_STEP_KEY
+        return key
+
+    def generate_build_steps(self) -> List[Union[BuildkiteStep, BuildkiteBlockStep]]:
+        """
+        Build the default image, and every other image the test steps use, once each.
+        Base images are built next to the full image, for the steps that do not need the kernels,
+        later stages are pushed by the build of the full image.
+        An image only used by blocked steps is built after a block step of its own.
+        """
+        build_steps = [self.generate_bake_step() if self.config.bake else self.generate_build_step()]
+        build_step_keys = {BUILD_STEP_KEY}
+        for cell, stage in self.images:
+            key = self.get_build_step_key(cell, stage)
+            if key in build_step_keys:
+                continue
+            build_step_keys.add(key)
+            build_step = self.generate_build_step(cell, stage if stage in SEPARATE_IMAGE_STAGES else ImageStage.TEST)
+            if not any(unblocked for image, unblocked in self.images.items() if self.get_build_step_key(*image) == key):
+                block_step = get_block_step(build_step.label.replace(":docker: b", "B"))
+                block_step.depends_on = None
+                build_steps.append(block_step)
+                build_step.depends_on = [block_step.key]
+            build_steps.append(build_step)
+        return build_steps
+
+    def get_shard_plan(self, test_step: TestStep) -> Optional[ShardPlan]:
+        """Plan parallelism and test assignment from historical timings, if available."""
+        if not self.config.timing_database:
+            return None
+        return get_shard_plan(
+            test_step,
+            get_step_key(test_step.label),
+            self.config.timing_database,
+            target_duration=self.config.shard_target_duration,
+        )
+
+    def get_selected_test_step(self, test_step: TestStep) -> TestStep:
+        """Narrow the step's pytest commands to the affected test files when the import graph allows it."""
+        graph = self.config.import_graph
+        if not graph or not test_step.source_file_dependencies or self.config.run_all or self.config.nightly:
+            return test_step
+        from .impact import get_selected_test_step
+        return get_selected_test_step(test_step, self.config.list_file_diff, graph) or test_step
+
+    def get_unblocked_step_labels(self, test_steps: List[TestStep]) -> Set[str]:
+        """Return labels of the test steps that run without manual unblock."""
+        if self.config.run_all or self.config.nightly:
+            unblocked = {step.label for step in test_steps}
+        else:
+            unblocked = {step.label for step in test_steps if not step.source_file_dependencies}
+            if self.config.import_graph:
+                from .impact import get_impacted_step_labels
+                unblocked |= get_impacted_step_labels(test_steps, self.config.list_file_diff, self.config.import_graph)
+            else:
+                unblocked |= DependencyIndex(test_steps).match(self.config.list_file_diff)
+        return unblocked - set(STEPS_TO_BLOCK)
+
+    def generate_test_steps(self, test_steps: List[TestStep]) -> List[Union[BuildkiteStep, BuildkiteBlockStep]]:
+        """
+        Convert test steps into Buildkite steps, preceded by a block step if not unblocked.
+        With a flake history, flaky steps get retries or soft_fail and flaky tests are deselected.
+        With a result store, steps whose inputs already passed become no-op "cached pass" steps.
+        With checkpointing, a step retried after losing its agent skips the tests it already completed.
+        """
+        unblocked_labels = self.get_unblocked_step_labels(test_steps)
+        fingerprinter, result_store = None, None
+        if self.config.result_store_url and not self.config.nightly:
+            from .result_cache import StepFingerprinter, get_result_store
+            fingerprinter = StepFingerprinter(test_steps, self.config.file_blobs, self.config.import_graph)
+            result_store = get_result_store(self.config.result_store_url)
+        buildkite_steps = []
+        for test_step in test_steps:
+            blocked = test_step.label not in unblocked_labels or (test_step.optional and not self.config.nightly)
+            if test_step.label in unblocked_labels:
+                test_step = self.get_selected_test_step(test_step)
+            cells = list(iter_matrix_cells(test_step, self.config.get_matrix_filter()))
+            if not cells and not self.config.matrix_filter:
+                # A step with none of the cells of PRs can still be run on demand
+                cells = list(iter_matrix_cells(test_step, NIGHTLY_MATRIX_FILTER))
+                blocked = True
+            for cell in cells:
+                buildkite_steps.extend(self.generate_cell_steps(
+                    get_cell_test_step(test_step, cell),
+                    cell,
+                    blocked,
+                    fingerprinter,
+                    result_store,
+                ))
+        return buildkite_steps
+
+    def generate_cell_steps(
+            self,
+            test_step: TestStep,
+            cell: MatrixCell,
+            blocked: bool,
+            fingerprinter=None,
+            result_store=None,
+        ) -> List[Union[BuildkiteStep, BuildkiteBlockStep]]:
+        """
+        The Buildkite step of a test step in one matrix cell, preceded by its block step if blocked.
+        The step waits for the build of the image stage it uses only.
+        """
+        multi_node = bool(test_step.num_nodes and test_step.num_nodes > 1)
+        stage = test_step.image_stage if test_step.image_stage and cell.hardware == Hardware.CUDA else ImageStage.TEST
+        if stage != ImageStage.TEST:
+            test_step = test_step.model_copy(update={"working_dir": get_working_dir(test_step, stage)})
+        self.images[(cell, stage)] = self.images.get((cell, stage), False) or not blocked
+        container_image = self.config.get_image(cell, stage)
+        build_step_key = self.get_build_step_key(cell, stage)
+        if cell.hardware == Hardware.AMD:
+            buildkite_step = convert_test_step_to_amd_buildkite_step(test_step)
+        else:
+            buildkite_step = convert_test_step_to_buildkite_step(
+                test_step,
+                container_image,
+                self.get_shard_plan(test_step)
+            )
+        buildkite_step.depends_on = [build_step_key]
+        if self.config.flake_history:
+            from .flaky import apply_flake_policy, get_flake_policy
+            policy = get_flake_policy(self.config.flake_history.steps.get(buildkite_step.key, []))
+            apply_flake_policy(buildkite_step, policy, multi_node=multi_node)
+        profile = self.config.profile_steps and cell.hardware == Hardware.CUDA and not multi_node
+        if self.config.checkpoint_tests and cell.hardware == Hardware.CUDA and not multi_node:
+            add_checkpoint(buildkite_step, test_step.working_dir, profile)
+        elif profile:
+            add_profiler(buildkite_step, test_step.working_dir)
+        if blocked:
+            block_step = get_block_step(test_step.label)
+            block_step.depends_on = [build_step_key]
+            buildkite_step.depends_on = [block_step.key]
+            return [block_step, buildkite_step]
+        if fingerprinter:
+            fingerprint = fingerprinter.get_fingerprint(test_step, buildkite_step, container_image)
+            result = result_store.get(fingerprint)
+            if result:
+                from .result_cache import get_cached_pass_step
+                return [get_cached_pass_step(buildkite_step, result)]
+            self.step_fingerprints[buildkite_step.key] = fingerprint
+        return [buildkite_step]
+
+    def generate(self, test_steps: List[TestStep]) -> List[Union[BuildkiteStep, BuildkiteBlockStep, BuildkiteWaitStep]]:
+        """Generate all Buildkite steps for the pipeline."""
+        buildkite_test_steps = self.generate_test_steps(test_steps)
+        coalesced_keys: Dict[str, str] = {}
+        if self.config.timing_database:
+            # Imported here to keep them off the startup path when no timing database is used
+            from .coalesce import coalesce_steps
+            from .scheduling import schedule_steps
+            if self.config.coalesce_budget:
+                buildkite_test_steps = coalesce_steps(
+                    buildkite_test_steps,
+                    self.config.timing_database,
+                    budget=self.config.coalesce_budget,
+                    coalesced_keys=coalesced_keys,
+                )
+            buildkite_test_steps = schedule_steps(buildkite_test_steps, self.config.timing_database)
+        if self.step_fingerprints:
+            from .result_cache import get_record_steps
+            buildkite_test_steps.extend(get_record_steps(self.step_fingerprints, self.config.result_store_url, coalesced_keys))
+        steps = [*self.generate_build_steps(), *buildkite_test_steps]
+        validate_dag(steps)
+        if self.config.timing_database:
+            from .scheduling import get_wall_time
+            durations = {
+                step.key: get_wall_time(step, self.config.timing_database)
+                for step in steps if isinstance(step, BuildkiteStep) and step.key
+            }
+            self.critical_path = get_critical_path(steps, durations)
+        return steps
+
+TEST_STEPS_ADAPTER = TypeAdapter(List[TestStep])
+
+
 def read_test_steps(file_path: str) -> List[TestStep]:
     """Read test steps from test pipeline yaml and parse them into TestStep objects."""
     with open(file_path, "r") as f:
-        content = yaml.safe_load(f)
-    return [TestStep(**step) for step in content["steps"]]
+        content = yaml.load(f, Loader=YamlLoader)
+    steps = content["steps"]
+    try:
+        return TEST_STEPS_ADAPTER.validate_python(steps)
+    except ValidationError as e:
+        invalid_indices = sorted({error["loc"][0] for error in e.errors() if error["loc"]})
+        labels = [
+            steps[index].get("label") if isinstance(steps[index], dict) else None
+            for index in invalid_indices
+        ]
+        raise ValueError(f"Invalid test steps {labels}: {e}") from e
 
-def write_buildkite_steps(steps: List[Union[BuildkiteStep, BuildkiteBlockStep]], file_path: str) -> None:
-    """Write the buildkite steps to the Buildkite pipeline yaml file."""
-    buildkite_steps_dict = {"steps": [step.dict(exclude_none=True) for step in steps]}
+def write_buildkite_steps(steps: Iterable[Union[BuildkiteStep, BuildkiteBlockStep, BuildkiteWaitStep]], file_path: str) -> None:
+    """
+    Write the buildkite steps to the Buildkite pipeline yaml file, one step at a time.
+    Each step is dumped as a one-item list, which is byte-identical to dumping the whole {"steps": [...]} mapping.
+    """
     with open(file_path, "w") as f:
-        yaml.dump(buildkite_steps_dict, f, sort_keys=False)
+        empty = True
+        for step in steps:
+            if empty:
+                f.write("steps:\n")
+                empty = False
+            yaml.dump([step.model_dump(exclude_none=True)], f, sort_keys=False, Dumper=YamlDumper)
+        if empty:
+            f.write("steps: []\n")
 
 @click.command()
 @click.option("--test_path", type=str, required=True, help="Path to the test pipeline yaml file")
 @click.option("--run_all", type=str, help="If set to 1, run all tests")
-@click.option("--list_file_diff", type=str, help="List of files in the diff between current branch and main")
-def main(test_path: str, external_hardware_test_path: str, run_all: str, list_file_diff: str):
+@click.option("--main_ref", type=str, default=MAIN_REF, help="Git ref of main, the diff of a branch starts at its merge-base with it")
+@click.option("--nightly", type=str, help="If set to 1, run all tests including optional ones")
+@click.option("--timing_database", type=str, help="Path to the JSON file with historical step and test durations")
+@click.option("--coalesce_budget", type=float, help="If set, merge short compatible steps into jobs of up to this many seconds")
+@click.option("--reuse_image_by_content", is_flag=True, help="Reuse a test image built from identical sources instead of rebuilding")
+@click.option("--impact_analysis", is_flag=True, help="Select test steps and the test files they run from the Python import graph")
+@click.option("--import_graph_cache", type=str, help="Path to the import graph cache file, reused and updated across builds")
+@click.option("--flake_history", type=str, help="Path to the flake history JSON file, to retry flaky steps and quarantine flaky tests")
+@click.option("--result_store", type=str, help="URL of the store of passing step results, steps whose inputs already passed are skipped")
+@click.option("--matrix_filter", type=str, multiple=True, help="Restrict a matrix axis to some values, e.g. cuda_version=default,12.1.0 (default: all cells in nightly builds, the default cell otherwise)")
+@click.option("--build_cache", type=str, help="Registry repository, or file:// directory, of BuildKit layer caches keyed by branch")
+@click.option("--bake", is_flag=True, help="Build the images of all CUDA versions in parallel with docker buildx bake, in one step")
+@click.option("--profile_steps", is_flag=True, help="Sample the CPU, memory and GPU usage of test steps and upload a summary per step")
+@click.option("--checkpoint_tests", is_flag=True, help="Record completed tests so that steps retried after a preemption resume where they stopped")
+def main(
+        test_path: str,
+        run_all: str,
+        main_ref: str,
+        nightly: str,
+        timing_database: Optional[str],
+        coalesce_budget: Optional[float],
+        reuse_image_by_content: bool,
+        impact_analysis: bool,
+        import_graph_cache: Optional[str],
+        flake_history: Optional[str],
+        result_store: Optional[str],
+        matrix_filter: List[str],
+        build_cache: Optional[str],
+        bake: bool,
+        profile_steps: bool,
+        checkpoint_tests: bool,
+    ):
     test_steps = read_test_steps(test_path)
+    run_all = run_all == "1"
+    try:
+        list_file_diff = get_file_diff(branch=os.getenv("BUILDKITE_BRANCH"), main_ref=main_ref).files
+    except subprocess.CalledProcessError as e:
+        # E.g. a shallow clone without main
+        click.echo(f"Could not diff against {main_ref}: {e.stderr.decode().strip()}. Run all tests")
+        list_file_diff = []
+        run_all = True
+    if not run_all:
+        trigger = RunAllMatcher().find_trigger(list_file_diff)
+        if trigger:
+            file, pattern = trigger
+            click.echo(f"Found changes: {file} (matches {pattern}). Run all tests")
+            run_all = True
+
+    image_content_hash = None
+    if reuse_image_by_content:
+        from .image import get_image_content_hash
+        image_content_hash = get_image_content_hash()
+
+    if result_store and not impact_analysis:
+        raise click.UsageError("--result_store needs the import graph of --impact_analysis to find step inputs")
+
+    import_graph = None
+    file_blobs = None
+    if impact_analysis and (not run_all or result_store):
+        from .impact import get_import_graph
+        import_graph = get_import_graph(cache_path=import_graph_cache)
+    if result_store:
+        from .image import get_file_blobs
+        file_blobs = get_file_blobs()
+
+    try:
+        matrix_filter = parse_matrix_filter(matrix_filter) if matrix_filter else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--matrix_filter") from e
+
+    if flake_history:
+        from .flaky import read_flake_history
+        flake_history = read_flake_history(flake_history)
 
     pipeline_generator_config = PipelineGeneratorConfig(
-        run_all=run_all == "1",
+        run_all=run_all,
+        nightly=nightly == "1",
         list_file_diff=list_file_diff,
+        timing_database=read_timing_database(timing_database) if timing_database else None,
+        coalesce_budget=coalesce_budget,
+        image_content_hash=image_content_hash,
+        import_graph=import_graph,
+        result_store_url=result_store,
+        file_blobs=file_blobs,
+        flake_history=flake_history,
+        checkpoint_tests=checkpoint_tests,
+        matrix_filter=matrix_filter,
+        build_cache=get_build_cache(build_cache, os.getenv("BUILDKITE_BRANCH")) if build_cache else None,
+        bake=bake,
+        profile_steps=profile_steps,
         container_registry=VLLM_ECR_URL,
-        container_registry_repo=VLLM_ECR_REPO,
+        container_registry_repo=VLLM_ECR_REPO_NAME,
         commit=os.getenv("BUILDKITE_COMMIT"),
     )
+    pipeline_generator = PipelineGenerator(pipeline_generator_config)
+    write_buildkite_steps(pipeline_generator.generate(test_steps), PIPELINE_FILE_PATH)
+    if pipeline_generator.step_fingerprints:
+        # The step recording their results runs this same copy of the generator
+        from .utils import upload_generator_artifact
+        upload_generator_artifact()
+    if pipeline_generator.critical_path:
+        path, duration = pipeline_generator.critical_path
+        click.echo(f"Critical path ({duration / 60:.0f} min): {' -> '.join(path)}")
+
+
+if __name__ == "__main__":
+    main()
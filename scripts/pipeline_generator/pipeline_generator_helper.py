@@ -1,8 +1,22 @@
+import shlex
 from typing import Dict, List, Optional
 
-from .utils import GPUType, get_agent_queue, get_full_test_command, get_multi_node_test_command
+from .utils import (
+    AGENT_RETRY_RULES,
+    AMD_TEST_SCRIPT,
+    AgentQueue,
+    GPUType,
+    IMAGE_STAGE_TARGETS,
+    ImageStage,
+    get_agent_queue,
+    get_checkpoint_test_command,
+    get_full_test_command,
+    get_multi_node_test_command,
+)
 from .step import TestStep, BuildkiteStep, get_step_key
-from .plugin import get_docker_plugin_config, get_kubernetes_plugin_config
+from .plugin import DOCKER_PLUGIN_NAME, get_docker_plugin_config, get_kubernetes_plugin_config
+from .sharding import ShardPlan, get_sharded_commands
+from .build_cache import BUILDER_NAME, BuildCache, ImageBuild, get_bake_commands, get_builder_command, get_cache_options
 
 def get_plugin_config(
         container_image: str,
@@ -22,13 +36,17 @@ def get_plugin_config(
     )
 
 
-def convert_test_step_to_buildkite_step(step: TestStep, container_image: str) -> BuildkiteStep:
+def convert_test_step_to_buildkite_step(
+        step: TestStep,
+        container_image: str,
+        shard_plan: Optional[ShardPlan] = None
+    ) -> BuildkiteStep:
     """Convert TestStep into BuildkiteStep."""
     buildkite_step = BuildkiteStep(
         label=step.label,
         key=get_step_key(step.label),
-        commands=step.commands,
-        parallelism=step.parallelism,
+        commands=get_sharded_commands(step.commands, shard_plan) if shard_plan else step.commands,
+        parallelism=shard_plan.parallelism if shard_plan else step.parallelism,
         soft_fail=step.soft_fail,
         plugins=[get_plugin_config(container_image, step.no_gpu, step.gpu, step.num_gpus)],
         agents={"queue": get_agent_queue(step.no_gpu, step.gpu, step.num_gpus).value}
@@ -46,29 +64,171 @@ def convert_test_step_to_buildkite_step(step: TestStep, container_image: str) ->
         buildkite_step.plugins = None
     return buildkite_step
 
-def get_build_commands(container_registry: str, buildkite_commit: str, container_image: str) -> List[str]:
-    ecr_login_command = (
-        "aws ecr-public get-login-password --region us-east-1 | "
-        f"docker login --username AWS --password-stdin {container_registry}"
+
+def convert_test_step_to_amd_buildkite_step(step: TestStep) -> BuildkiteStep:
+    """Convert TestStep into a BuildkiteStep running on AMD GPUs, where the test script starts the AMD image of the commit."""
+    full_test_command = get_full_test_command(step.commands, step.working_dir)
+    return BuildkiteStep(
+        label=step.label,
+        key=get_step_key(step.label),
+        commands=[f"bash {AMD_TEST_SCRIPT} {shlex.quote(full_test_command)}"],
+        parallelism=step.parallelism,
+        soft_fail=True,
+        priority=100,
+        agents={"queue": AgentQueue.AMD_GPU.value},
+        env={"DOCKER_BUILDKIT": "1"},
     )
+
+
+def add_checkpoint(buildkite_step: BuildkiteStep, working_dir: Optional[str], profile: bool = False) -> None:
+    """
+    Run the step's commands through the checkpoint wrapper, keeping the checkpoint as an artifact
+    of the step (one per parallel job), and retry the step when its agent is lost.
+    """
+    checkpoint_name = get_artifact_name("checkpoint", buildkite_step)
+    profile_name = get_artifact_name("profile", buildkite_step) if profile else None
+    buildkite_step.commands = [get_checkpoint_test_command(buildkite_step.commands, working_dir, checkpoint_name, profile_name)]
+    mount_buildkite_agent(buildkite_step)
+    if not buildkite_step.retry:
+        buildkite_step.retry = {"automatic": AGENT_RETRY_RULES}
+
+
+def add_profiler(buildkite_step: BuildkiteStep, working_dir: Optional[str]) -> None:
+    """Run the step's commands through the profiler, uploading its summary as an artifact of the step (one per parallel job)."""
+    profile_name = get_artifact_name("profile", buildkite_step)
+    buildkite_step.commands = [get_full_test_command(buildkite_step.commands, working_dir, profile_name)]
+    mount_buildkite_agent(buildkite_step)
+
+
+def get_artifact_name(prefix: str, buildkite_step: BuildkiteStep) -> str:
+    artifact_name = f"{prefix}-{buildkite_step.key}"
+    if buildkite_step.parallelism:
+        artifact_name += "-$$BUILDKITE_PARALLEL_JOB"
+    return artifact_name
+
+
+def mount_buildkite_agent(buildkite_step: BuildkiteStep) -> None:
+    """Wrappers upload and download artifacts with the agent from inside the container."""
+    buildkite_step.plugins = [
+        {name: {**config, "mount-buildkite-agent": True}} if name == DOCKER_PLUGIN_NAME else {name: config}
+        for plugin in buildkite_step.plugins or []
+        for name, config in plugin.items()
+    ] or None
+
+def get_build_commands(
+        container_registry: str,
+        buildkite_commit: str,
+        container_image: str,
+        content_addressed_image: Optional[str] = None,
+        cuda_version: Optional[str] = None,
+        target: str = IMAGE_STAGE_TARGETS[ImageStage.TEST],
+        build_cache: Optional[BuildCache] = None,
+        stage_images: Optional[Dict[str, str]] = None,
+    ) -> List[str]:
+    """
+    Build and push the image unless it exists. With a build cache, the image is built with
+    buildx, importing and exporting its layer cache, and pushed by the build.
+    `stage_images` are images of earlier Dockerfile targets, by target, built and pushed first
+    by the same builder, so the image reuses their layers instead of building them again.
+    """
+    stage_images = stage_images or {}
+    images = [*stage_images.values(), container_image]
+    missing_image_check = " || ".join(f"[[ -z $(docker manifest inspect {image}) ]]" for image in images)
     image_check_command = f"""#!/bin/bash
-if [[ -z $(docker manifest inspect {container_image}) ]]; then
+if {missing_image_check}; then
 echo "Image not found, proceeding with build..."
 else
 echo "Image found"
 exit 0
 fi
 """
-    docker_build_command = (
-        f"docker build "
-        f"--file docker/Dockerfile "
-        f"--build-arg max_jobs=64 "
-        f"--build-arg buildkite_commit={buildkite_commit} "
-        f"--build-arg USE_SCCACHE=1 "
-        f"--tag {container_image} "
-        f"--target test "
-        f"--progress plain ."
-    )
+    if content_addressed_image:
+        # An image built from identical sources only needs a new tag, which is done in the registry
+        image_check_command += f"""if [[ -n $(docker manifest inspect {content_addressed_image}) ]]; then
+echo "Image with the same content found, tagging it..."
+docker buildx imagetools create --tag {container_image} {content_addressed_image}
+exit 0
+fi
+"""
+    build_args = "".join(f"--build-arg {name}={value} " for name, value in get_build_args(buildkite_commit).items())
+    cuda_version_arg = f"--build-arg CUDA_VERSION={cuda_version} " if cuda_version else ""
+    image_build = ImageBuild(name="image", tags=[container_image], target=target, cuda_version=cuda_version)
+    cache_options = get_cache_options(build_cache, image_build)
+
+    def get_docker_build_command(tags: List[str], target: str, cache_options: List[str]) -> str:
+        return (
+            f"{f'docker buildx build --builder {BUILDER_NAME} ' if build_cache else 'docker build '}"
+            f"--file docker/Dockerfile "
+            f"{build_args}"
+            f"{cuda_version_arg}"
+            f"{''.join(f'--tag {tag} ' for tag in tags)}"
+            f"--target {target} "
+            f"{''.join(f'{option} ' for option in cache_options)}"
+            f"{'--push ' if build_cache else ''}"
+            f"--progress plain ."
+        )
+
     # TODO: Stop using . in docker build command
-    docker_push_command = f"docker push {container_image}"
-    return [ecr_login_command, image_check_command, docker_build_command, docker_push_command]
+    build_commands = []
+    for stage_target, stage_image in stage_images.items():
+        # Only the image exports the cache, with the layers of every stage
+        build_commands.append(get_docker_build_command(
+            [stage_image], stage_target, [option for option in cache_options if not option.startswith("--cache-to")]
+        ))
+        if not build_cache:
+            build_commands.append(f"docker push {stage_image}")
+    tags = [container_image, content_addressed_image] if content_addressed_image else [container_image]
+    build_commands.append(get_docker_build_command(tags, target, cache_options))
+    if build_cache:
+        return [get_ecr_login_command(container_registry), image_check_command, get_builder_command(), *build_commands]
+    docker_push_commands = [f"docker push {tag}" for tag in tags]
+    return [get_ecr_login_command(container_registry), image_check_command, *build_commands, *docker_push_commands]
+
+
+def get_bake_build_commands(
+        container_registry: str,
+        buildkite_commit: str,
+        image_builds: List[ImageBuild],
+        build_cache: Optional[BuildCache] = None
+    ) -> List[str]:
+    """Build and push all images in parallel with `docker buildx bake`, unless they all exist."""
+    images = " ".join(image_build.tags[0] for image_build in image_builds)
+    image_check_command = f"""#!/bin/bash
+MISSING_IMAGES=0
+for image in {images}; do
+if [[ -z $(docker manifest inspect $$image) ]]; then
+echo "Image $$image not found, proceeding with build..."
+MISSING_IMAGES=1
+fi
+done
+if [[ $$MISSING_IMAGES == 0 ]]; then
+echo "Images found"
+exit 0
+fi
+"""
+    return [
+        get_ecr_login_command(container_registry),
+        image_check_command,
+        *get_bake_commands(image_builds, get_build_args(buildkite_commit), build_cache),
+    ]
+
+
+def get_build_args(buildkite_commit: str) -> Dict[str, str]:
+    return {"max_jobs": "64", "buildkite_commit": buildkite_commit, "USE_SCCACHE": "1"}
+
+
+def get_ecr_login_command(container_registry: str) -> str:
+    return (
+        "aws ecr-public get-login-password --region us-east-1 | "
+        f"docker login --username AWS --password-stdin {container_registry}"
+    )
+
+
+def get_amd_build_commands(container_image: str) -> List[str]:
+    dockerfile = "docker/Dockerfile.rocm"
+    build_command = f"docker build --build-arg max_jobs=16 --tag {container_image} -f {dockerfile}"
+    return [
+        # Dockerfiles without a test target are built whole
+        f"grep -i 'from base as test' {dockerfile} && {build_command} --target test --progress plain . || {build_command} --progress plain .",
+        f"docker push {container_image}",
+    ]
@@ -1,5 +1,6 @@
+import functools
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 from .utils import HF_HOME
 
@@ -21,8 +22,8 @@ DEFAULT_KUBERNETES_CONTAINER_VOLUME_MOUNTS = [
     {"name": "hf-cache", "mountPath": HF_HOME}
 ]
 DEFAULT_KUBERNETES_CONTAINER_ENVIRONMENT_VARIABLES = [
-    {"name": "HF_HOME", "value": HF_HOME},
     {"name": "VLLM_USAGE_SOURCE", "value": "ci-test"},
+    {"name": "HF_HOME", "value": HF_HOME},
     {
         "name": "HF_TOKEN",
         "valueFrom": {
@@ -51,9 +52,10 @@ class DockerPluginConfig(BaseModel):
     propagate_environment: bool = Field(default=True, alias="propagate-environment")
     gpus: Optional[str] = "all"
     mount_buildkite_agent: Optional[bool] = Field(default=False, alias="mount-buildkite-agent")
+    command: Optional[List[str]] = None
     environment: List[str] = DEFAULT_DOCKER_ENVIRONMENT_VARIBLES
     volumes: List[str] = DEFAULT_DOCKER_VOLUMES
-    shell: List[str] = ["/bin/bash", "-c"]
+    shell: Optional[List[str]] = ["/bin/bash", "-c"]
 
 
 class KubernetesPodContainerConfig(BaseModel):
@@ -61,12 +63,14 @@ class KubernetesPodContainerConfig(BaseModel):
     Configuration for a container running in a Kubernetes pod.
     """
     image: str
+    command: Optional[List[str]] = None
+    args: Optional[List[str]] = None
     resources: Dict[str, Dict[str, int]]
     volume_mounts: List[Dict[str, str]] = Field(
         alias="volumeMounts",
         default=DEFAULT_KUBERNETES_CONTAINER_VOLUME_MOUNTS
     )
-    env: List[Dict[str, str]] = Field(
+    env: List[Dict[str, Any]] = Field(
         default=DEFAULT_KUBERNETES_CONTAINER_ENVIRONMENT_VARIABLES,
     )
 
@@ -93,22 +97,48 @@ class KubernetesPluginConfig(BaseModel):
     pod_spec: KubernetesPodSpec = Field(alias="podSpec")
 
 
-def get_kubernetes_plugin_config(container_image: str, num_gpus: int) -> Dict:
+# Plugin configs only depend on their arguments, so they are built once per argument tuple.
+# The returned dicts are shared between steps and must not be modified.
+@functools.lru_cache(maxsize=None)
+def get_kubernetes_plugin_config(
+        container_image: str,
+        num_gpus: int,
+        command: Optional[Tuple[str, ...]] = None,
+        args: Optional[Tuple[str, ...]] = None,
+    ) -> Dict:
+    """Without a command, the container runs the entrypoint of its image."""
     pod_spec = KubernetesPodSpec(
         containers=[
             KubernetesPodContainerConfig(
                 image=container_image,
+                command=list(command) if command else None,
+                args=list(args) if args else None,
                 resources={"limits": {"nvidia.com/gpu": num_gpus}}
             )
         ]
     )
-    return {KUBERNETES_PLUGIN_NAME: KubernetesPluginConfig(podSpec=pod_spec).dict(by_alias=True)}
+    return {KUBERNETES_PLUGIN_NAME: KubernetesPluginConfig(podSpec=pod_spec).dict(exclude_none=True, by_alias=True)}
 
 
-def get_docker_plugin_config(docker_image_path: str, no_gpu: bool) -> Dict:
+@functools.lru_cache(maxsize=None)
+def get_docker_plugin_config(
+        docker_image_path: str,
+        no_gpu: bool,
+        command: Optional[Tuple[str, ...]] = None,
+        environment: Tuple[str, ...] = tuple(DEFAULT_DOCKER_ENVIRONMENT_VARIBLES),
+        volumes: Tuple[str, ...] = tuple(DEFAULT_DOCKER_VOLUMES),
+        mount_buildkite_agent: Optional[bool] = False,
+    ) -> Dict:
+    """With a command, the container runs it instead of the step's commands, and without a shell as the plugin does."""
     docker_plugin_config = DockerPluginConfig(
         image=docker_image_path,
+        environment=list(environment),
+        volumes=list(volumes),
     )
+    docker_plugin_config.mount_buildkite_agent = mount_buildkite_agent
     if no_gpu:
         docker_plugin_config.gpus = None
+    if command:
+        docker_plugin_config.command = list(command)
+        docker_plugin_config.shell = None
     return {DOCKER_PLUGIN_NAME: docker_plugin_config.dict(exclude_none=True, by_alias=True)}
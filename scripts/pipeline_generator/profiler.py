@@ -0,0 +1,255 @@
+"""
+Resource profiling of a step's command: CPU, memory, GPU memory and utilization sampled at a fixed
+interval, and the wall time of each phase of the command, written as a JSON summary.
+
+This file runs inside the test image, so it only uses the standard library. Without nvidia-smi the
+GPU fields are empty, and without /proc only totals of the command's processes are recorded.
+
+The command marks the start of a phase by appending "<phase> <unix time>" to the file named by
+PROFILE_PHASE_FILE, a command without marks being a single "command" phase.
+
+Usage: python3 profiler.py (--output_dir DIR | --artifact) --name NAME -- COMMAND...
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+PHASE_FILE_ENV = "PROFILE_PHASE_FILE"
+DEFAULT_INTERVAL = 5  # seconds
+FIRST_PHASE = "command"
+# A GPU whose utilization never reaches this percentage is reported as unused
+GPU_USED_UTILIZATION = 10
+NVIDIA_SMI_QUERY = [
+    "nvidia-smi",
+    "--query-gpu=index,utilization.gpu,memory.used",
+    "--format=csv,noheader,nounits",
+]
+
+
+def read_process_tree(root_pid: int) -> Optional[Tuple[float, int]]:
+    """CPU seconds and resident memory in bytes of a process and its descendants, None without /proc."""
+    if not os.path.isdir("/proc"):
+        return None
+    clock_ticks = os.sysconf("SC_CLK_TCK")
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    processes: Dict[int, Tuple[int, float, int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # The command name can contain spaces and parentheses, fields follow the last ")"
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            # The process exited while listing
+            continue
+        ppid, utime, stime, rss_pages = int(fields[1]), int(fields[11]), int(fields[12]), int(fields[21])
+        processes[int(entry)] = (ppid, (utime + stime) / clock_ticks, rss_pages * page_size)
+    children: Dict[int, List[int]] = {}
+    for pid, (ppid, _, _) in processes.items():
+        children.setdefault(ppid, []).append(pid)
+    cpu_seconds, rss = 0.0, 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        if pid in processes:
+            cpu_seconds += processes[pid][1]
+            rss += processes[pid][2]
+        pending.extend(children.get(pid, []))
+    return cpu_seconds, rss
+
+
+def read_gpus() -> Optional[List[Tuple[int, float, float]]]:
+    """Index, utilization in percent and used memory in MiB of each GPU, None without nvidia-smi."""
+    try:
+        output = subprocess.run(NVIDIA_SMI_QUERY, capture_output=True, text=True, timeout=10, check=True).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    gpus = []
+    for line in output.splitlines():
+        try:
+            index, utilization, memory_used = (value.strip() for value in line.split(","))
+            gpus.append((int(index), float(utilization), float(memory_used)))
+        except ValueError:
+            # "[N/A]" on GPUs that do not report a value
+            continue
+    return gpus
+
+
+def read_phases(phase_file: str) -> List[Tuple[str, float]]:
+    if not os.path.exists(phase_file):
+        return []
+    phases = []
+    with open(phase_file, "r") as f:
+        for line in f:
+            name, _, start = line.strip().partition(" ")
+            try:
+                phases.append((name, float(start)))
+            except ValueError:
+                continue
+    return phases
+
+
+def get_phase_durations(phases: List[Tuple[str, float]], start: float, end: float) -> Dict[str, float]:
+    """Wall time of each phase, from its mark to the next one, the first phase starting with the command."""
+    marks = sorted(phases, key=lambda phase: phase[1]) or [(FIRST_PHASE, start)]
+    marks[0] = (marks[0][0], start)
+    durations: Dict[str, float] = {}
+    for (name, phase_start), (_, phase_end) in zip(marks, [*marks[1:], ("", end)]):
+        duration = max(0.0, min(phase_end, end) - max(phase_start, start))
+        durations[name] = round(durations.get(name, 0.0) + duration, 3)
+    return durations
+
+
+class Sampler:
+    """Samples of the command's resources, taken by a thread every `interval` seconds."""
+
+    def __init__(self, pid: int, interval: float, read_gpus=read_gpus, read_process_tree=read_process_tree):
+        self.pid = pid
+        self.interval = interval
+        self.read_gpus = read_gpus
+        self.read_process_tree = read_process_tree
+        self.cpu_cores: List[float] = []
+        self.rss: List[int] = []
+        self.gpus: Dict[int, List[Tuple[float, float]]] = {}
+        self.gpu_available = True
+        self._last_cpu: Optional[Tuple[float, float]] = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            self.sample()
+            if self._stopped.wait(self.interval):
+                return
+
+    def sample(self) -> None:
+        now = time.monotonic()
+        process_tree = self.read_process_tree(self.pid)
+        if process_tree:
+            cpu_seconds, rss = process_tree
+            if self._last_cpu:
+                last_time, last_cpu_seconds = self._last_cpu
+                # Processes exiting between samples take their CPU time with them
+                self.cpu_cores.append(max(0.0, cpu_seconds - last_cpu_seconds) / max(now - last_time, 1e-6))
+            self._last_cpu = (now, cpu_seconds)
+            self.rss.append(rss)
+        if not self.gpu_available:
+            return
+        gpus = self.read_gpus()
+        if gpus is None:
+            self.gpu_available = False
+            return
+        for index, utilization, memory_used in gpus:
+            self.gpus.setdefault(index, []).append((utilization, memory_used))
+
+
+def _mean(values: List[float]) -> Optional[float]:
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def get_summary(
+        name: str,
+        returncode: int,
+        wall_time: float,
+        phases: Dict[str, float],
+        sampler: Sampler,
+        rusage: Optional[resource.struct_rusage] = None,
+    ) -> Dict:
+    """Compact summary of a profiled command, e.g. to check that a step uses the GPUs of its agent."""
+    gpus = []
+    for index, samples in sorted(sampler.gpus.items()):
+        utilizations = [utilization for utilization, _ in samples]
+        gpus.append({
+            "index": index,
+            "mean_utilization": _mean(utilizations),
+            "max_utilization": max(utilizations),
+            "peak_memory_mib": max(memory_used for _, memory_used in samples),
+        })
+    summary = {
+        "name": name,
+        "exit_status": returncode,
+        "wall_time": round(wall_time, 3),
+        "interval": sampler.interval,
+        "samples": max(len(sampler.rss), max((len(samples) for samples in sampler.gpus.values()), default=0)),
+        "phases": phases,
+        "cpu": {
+            "mean_cores": _mean(sampler.cpu_cores),
+            "max_cores": round(max(sampler.cpu_cores), 2) if sampler.cpu_cores else None,
+            "total_seconds": round(rusage.ru_utime + rusage.ru_stime, 3) if rusage else None,
+        },
+        "memory": {
+            "peak_rss_bytes": max(sampler.rss) if sampler.rss else None,
+            # ru_maxrss is in KiB on Linux, and only covers the largest process
+            "max_process_rss_bytes": rusage.ru_maxrss * 1024 if rusage else None,
+        },
+        "gpus": gpus,
+        "gpus_available": len(gpus),
+        "gpus_used": sum(1 for gpu in gpus if gpu["max_utilization"] >= GPU_USED_UTILIZATION),
+    }
+    return summary
+
+
+def run_with_profiler(command: List[str], name: str, interval: float = DEFAULT_INTERVAL, **sampler_kwargs) -> Tuple[int, Dict]:
+    """Run the command while sampling its resources, and return its exit status and the summary."""
+    with tempfile.TemporaryDirectory() as directory:
+        phase_file = os.path.join(directory, "phases")
+        start = time.time()
+        process = subprocess.Popen(command, env={**os.environ, PHASE_FILE_ENV: phase_file})
+        sampler = Sampler(process.pid, interval, **sampler_kwargs)
+        sampler.start()
+        try:
+            returncode = process.wait()
+        finally:
+            sampler.stop()
+        end = time.time()
+        phases = get_phase_durations(read_phases(phase_file), start, end)
+    rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return returncode, get_summary(name, returncode, end - start, phases, sampler, rusage)
+
+
+def write_summary(summary: Dict, output_dir: str, artifact: bool) -> str:
+    output_file = os.path.join(output_dir, f"{summary['name']}.json")
+    with open(output_file, "w") as f:
+        json.dump(summary, f, separators=(",", ":"))
+    if artifact:
+        subprocess.run(["buildkite-agent", "artifact", "upload", os.path.basename(output_file)], cwd=output_dir, capture_output=True)
+    return output_file
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a command, sampling its CPU, memory and GPU usage.")
+    location = parser.add_mutually_exclusive_group(required=True)
+    location.add_argument("--output_dir", type=str, help="Directory to write the summary to")
+    location.add_argument("--artifact", action="store_true", help="Upload the summary as a Buildkite artifact of the step")
+    parser.add_argument("--name", type=str, required=True, help="Summary name, unique per step and parallel job")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="Seconds between samples")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run, after --")
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    returncode, summary = run_with_profiler(command, args.name, args.interval)
+    output_dir = tempfile.mkdtemp() if args.artifact else args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    write_summary(summary, output_dir, args.artifact)
+    print(f"Profile: {json.dumps({key: summary[key] for key in ('wall_time', 'phases', 'cpu', 'memory')})}", file=sys.stderr)
+    if summary["gpus_available"] and summary["gpus_used"] < summary["gpus_available"]:
+        print(f"Profile: only {summary['gpus_used']} of {summary['gpus_available']} GPUs were used", file=sys.stderr)
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
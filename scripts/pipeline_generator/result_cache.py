@@ -0,0 +1,258 @@
+import abc
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import sqlite3
+import subprocess
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Union
+
+import click
+from pydantic import BaseModel
+
+from .dependency_index import DependencyIndex
+from .impact import ImportGraph, get_test_targets
+from .run_all import compile_prefix_patterns
+from .step import BuildkiteStep, TestStep
+from .utils import AgentQueue, RUN_ALL_PATTERNS, RUN_ALL_IGNORE_PATTERNS, get_generator_download_commands
+
+# Bump when the fingerprint inputs change, so old results are not reused
+FINGERPRINT_VERSION = 1
+CACHED_PASS_LABEL_SUFFIX = "(cached pass)"
+CACHED_PASS_ANNOTATION_CONTEXT = "cached-pass"
+RECORD_STEP_KEY = "record-step-results"
+# Where the record step extracts the pipeline_generator package the pipeline was generated with
+RECORD_GENERATOR_DIR = ".result-cache"
+PASSED_OUTCOME = "passed"
+
+
+class StepResult(BaseModel):
+    """A passing run of a step, stored under the fingerprint of its inputs."""
+    commit: str
+    build_url: Optional[str] = None
+
+
+class ResultStore(abc.ABC):
+    """Step results keyed by input fingerprint."""
+
+    @abc.abstractmethod
+    def get(self, fingerprint: str) -> Optional[StepResult]:
+        ...
+
+    @abc.abstractmethod
+    def put(self, fingerprint: str, result: StepResult) -> None:
+        ...
+
+
+class LocalResultStore(ResultStore):
+    """One JSON file per fingerprint in a directory, e.g. on a volume shared by the agents."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _get_path(self, fingerprint: str) -> str:
+        return os.path.join(self.directory, f"{fingerprint}.json")
+
+    def get(self, fingerprint: str) -> Optional[StepResult]:
+        path = self._get_path(fingerprint)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return StepResult.model_validate_json(f.read())
+
+    def put(self, fingerprint: str, result: StepResult) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # Write then rename so a concurrent reader never sees a partial file
+        temp_path = f"{self._get_path(fingerprint)}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(result.model_dump_json())
+        os.replace(temp_path, self._get_path(fingerprint))
+
+
+class SqliteResultStore(ResultStore):
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS step_results (fingerprint TEXT PRIMARY KEY, result TEXT NOT NULL)")
+
+    def get(self, fingerprint: str) -> Optional[StepResult]:
+        row = self.connection.execute("SELECT result FROM step_results WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        return StepResult.model_validate_json(row[0]) if row else None
+
+    def put(self, fingerprint: str, result: StepResult) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO step_results (fingerprint, result) VALUES (?, ?)",
+                (fingerprint, result.model_dump_json()),
+            )
+
+
+class S3ResultStore(ResultStore):
+    """
+    One JSON object per fingerprint in an S3-compatible bucket.
+    `client` is a boto3 S3 client, created from the environment if not given.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", client=None, endpoint_url: Optional[str] = None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _get_key(self, fingerprint: str) -> str:
+        return posixpath.join(self.prefix, f"{fingerprint}.json")
+
+    def get(self, fingerprint: str) -> Optional[StepResult]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._get_key(fingerprint))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return StepResult.model_validate_json(response["Body"].read())
+
+    def put(self, fingerprint: str, result: StepResult) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self._get_key(fingerprint), Body=result.model_dump_json().encode())
+
+
+def get_result_store(url: str) -> ResultStore:
+    """
+    Open a result store from its URL: `sqlite:///path/to/results.db`, `s3://bucket/prefix`
+    (endpoint from AWS_ENDPOINT_URL for S3-compatible services) or a local directory path.
+    """
+    if url.startswith("sqlite://"):
+        return SqliteResultStore(url[len("sqlite://"):])
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3ResultStore(bucket, prefix, endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
+    return LocalResultStore(url[len("file://"):] if url.startswith("file://") else url)
+
+
+class StepFingerprinter:
+    """
+    Hash of everything a step's result depends on: its Buildkite definition (without the
+    per-commit image tag) and the content of its input files.
+
+    Input files are the image build inputs (RUN_ALL_PATTERNS), the files matching the step's
+    source_file_dependencies, its test files with everything they import, and the non-Python
+    files (data, configs) under the top-level directories of those. Steps without
+    source_file_dependencies or recognizable test files, and multi-node steps (which
+    run a script from the repository), depend on every file.
+    """
+
+    def __init__(self, test_steps: List[TestStep], file_blobs: Dict[str, str], graph: ImportGraph):
+        self.file_blobs = file_blobs
+        self.graph = graph
+        run_all_regex = compile_prefix_patterns(RUN_ALL_PATTERNS)
+        run_all_ignore_regex = compile_prefix_patterns(RUN_ALL_IGNORE_PATTERNS)
+        self.image_files = {
+            file for file in file_blobs
+            if run_all_regex.match(file) and not (run_all_ignore_regex and run_all_ignore_regex.match(file))
+        }
+
+        dependency_index = DependencyIndex(test_steps)
+        self.files_by_label: Dict[str, Set[str]] = defaultdict(set)
+        self.data_files_by_top_dir: Dict[str, Set[str]] = defaultdict(set)
+        for file in file_blobs:
+            for label in dependency_index.match([file]):
+                self.files_by_label[label].add(file)
+            if not file.endswith(".py"):
+                self.data_files_by_top_dir[file.split("/", 1)[0]].add(file)
+
+    def get_input_files(self, test_step: TestStep) -> Set[str]:
+        targets = None
+        if test_step.source_file_dependencies and not test_step.num_nodes:
+            targets = get_test_targets(test_step, self.graph.files)
+        if targets is None:
+            return set(self.file_blobs)
+        python_files = self.graph.get_dependencies(targets)
+        data_files = set().union(*(self.data_files_by_top_dir[file.split("/", 1)[0]] for file in python_files))
+        return self.image_files | self.files_by_label[test_step.label] | python_files | data_files
+
+    def get_fingerprint(self, test_step: TestStep, buildkite_step: BuildkiteStep, container_image: str) -> str:
+        fingerprint = hashlib.sha256(f"{FINGERPRINT_VERSION}\0".encode())
+        # The image is tagged with the commit, its content is covered by the input files
+        definition = json.dumps(buildkite_step.model_dump(exclude_none=True), sort_keys=True)
+        fingerprint.update(definition.replace(container_image, "").encode())
+        for file in sorted(self.get_input_files(test_step)):
+            fingerprint.update(f"\0{file}\0{self.file_blobs[file]}".encode())
+        return fingerprint.hexdigest()
+
+
+def get_cached_pass_step(buildkite_step: BuildkiteStep, result: StepResult) -> BuildkiteStep:
+    """A no-op step taking the place of a step whose inputs already passed."""
+    build = result.build_url or result.commit
+    message = f"{buildkite_step.label}: inputs unchanged since a passing run in {build}\n".replace("$", "$$")
+    return BuildkiteStep(
+        label=f"{buildkite_step.label} {CACHED_PASS_LABEL_SUFFIX}",
+        key=buildkite_step.key,
+        agents={"queue": AgentQueue.AWS_SMALL_CPU.value},
+        commands=[
+            f"buildkite-agent annotate --style info --context {CACHED_PASS_ANNOTATION_CONTEXT} --append {shlex.quote(message)}",
+        ],
+        depends_on=None,
+    )
+
+
+def get_record_steps(
+        fingerprints: Dict[str, str],
+        result_store_url: str,
+        coalesced_keys: Optional[Dict[str, str]] = None,
+    ) -> List[BuildkiteStep]:
+    """
+    Step recording the results of the fingerprinted steps once they have all finished, passed or not.
+    It depends on them explicitly: a wait step would also wait for the blocked steps nobody unblocks.
+    A step merged into a combined job (`coalesced_keys`) passed if that job passed.
+    The step runs the copy of this package uploaded by the generator, see upload_generator_artifact.
+    """
+    coalesced_keys = coalesced_keys or {}
+    fingerprint_options = " ".join(
+        f"--fingerprint {coalesced_keys.get(key, key)}={fingerprint}" for key, fingerprint in fingerprints.items()
+    )
+    step_keys = list(dict.fromkeys(coalesced_keys.get(key, key) for key in fingerprints))
+    return [
+        BuildkiteStep(
+            label="Record step results",
+            key=RECORD_STEP_KEY,
+            agents={"queue": AgentQueue.AWS_SMALL_CPU.value},
+            commands=[
+                'python -c "import click, pydantic, yaml" 2>/dev/null || python -m pip install click pydantic pyyaml',
+                *get_generator_download_commands(RECORD_GENERATOR_DIR),
+                f"PYTHONPATH={RECORD_GENERATOR_DIR} python -m pipeline_generator.result_cache "
+                f"--result_store {result_store_url} {fingerprint_options}",
+            ],
+            depends_on=[{"step": step_key, "allow_failure": True} for step_key in step_keys],
+        ),
+    ]
+
+
+def get_step_outcome(step_key: str) -> str:
+    return subprocess.run(
+        ["buildkite-agent", "step", "get", "outcome", "--step", step_key],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+
+
+@click.command()
+@click.option("--result_store", type=str, required=True, help="URL of the result store")
+@click.option("--fingerprint", type=str, multiple=True, help="Input fingerprint of a step, as step_key=fingerprint")
+def main(result_store: str, fingerprint: List[str]):
+    """Record the steps of the current build that passed."""
+    store = get_result_store(result_store)
+    result = StepResult(commit=os.getenv("BUILDKITE_COMMIT", ""), build_url=os.getenv("BUILDKITE_BUILD_URL"))
+    # Steps of a combined job share its outcome
+    outcomes: Dict[str, str] = {}
+    for step_fingerprint in fingerprint:
+        step_key, step_fingerprint = step_fingerprint.split("=", 1)
+        if step_key not in outcomes:
+            outcomes[step_key] = get_step_outcome(step_key)
+            click.echo(f"{step_key}: {outcomes[step_key]}")
+        if outcomes[step_key] == PASSED_OUTCOME:
+            store.put(step_fingerprint, result)
+
+
+if __name__ == "__main__":
+    main()
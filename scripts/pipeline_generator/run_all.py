@@ -0,0 +1,46 @@
+import fnmatch
+import re
+from typing import Iterable, List, Optional, Tuple
+
+from .utils import RUN_ALL_PATTERNS, RUN_ALL_IGNORE_PATTERNS
+
+
+def compile_prefix_patterns(patterns: List[str]) -> Optional[re.Pattern]:
+    """
+    Compile shell glob patterns into one regex with a named group per pattern.
+    Like `[[ $file == $pattern* ]]` in bash, a pattern matches as a prefix and `*` also matches `/`.
+    """
+    if not patterns:
+        return None
+    alternatives = [
+        f"(?P<p{i}>{fnmatch.translate(pattern + '*')})"
+        for i, pattern in enumerate(patterns)
+    ]
+    return re.compile("|".join(alternatives))
+
+
+class RunAllMatcher:
+    """Decide whether a file diff should trigger running all tests."""
+
+    def __init__(
+        self,
+        patterns: List[str] = RUN_ALL_PATTERNS,
+        ignore_patterns: List[str] = RUN_ALL_IGNORE_PATTERNS,
+    ):
+        self.patterns = patterns
+        self.ignore_patterns = ignore_patterns
+        self._pattern_regex = compile_prefix_patterns(patterns)
+        self._ignore_regex = compile_prefix_patterns(ignore_patterns)
+
+    def find_trigger(self, list_file_diff: Iterable[str]) -> Optional[Tuple[str, str]]:
+        """Return the first (file, pattern) that triggers running all tests, if any."""
+        if self._pattern_regex is None:
+            return None
+        for file in list_file_diff:
+            match = self._pattern_regex.match(file)
+            if not match:
+                continue
+            if self._ignore_regex is not None and self._ignore_regex.match(file):
+                continue
+            return file, self.patterns[int(match.lastgroup[1:])]
+        return None
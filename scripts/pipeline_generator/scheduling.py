@@ -0,0 +1,142 @@
+import heapq
+import json
+from collections import defaultdict
+from typing import Dict, List, Optional, Union
+
+import click
+from pydantic import BaseModel
+
+from .sharding import TimingDatabase
+from .step import BuildkiteStep, BuildkiteBlockStep
+from .utils import AgentQueue
+
+DEFAULT_STEP_DURATION = 10 * 60  # seconds
+# Higher is scarcer. Long jobs on scarce queues are dispatched first.
+QUEUE_SCARCITY = {
+    AgentQueue.A100.value: 2,
+    AgentQueue.AWS_4xL4.value: 1,
+}
+
+
+class SimulatedJob(BaseModel):
+    """A step of a recorded or generated build, as seen by the simulator."""
+    key: str
+    queue: str
+    duration: float
+    parallelism: int = 1
+    priority: int = 0
+
+
+def get_dispatch_order(jobs: List[SimulatedJob]) -> List[SimulatedJob]:
+    """Order jobs by queue scarcity, then longest per-job duration first."""
+    return sorted(
+        jobs,
+        key=lambda job: (-QUEUE_SCARCITY.get(job.queue, 0), -job.duration / job.parallelism),
+    )
+
+
+def assign_priorities(jobs: List[SimulatedJob]) -> None:
+    """Within each queue, give longer jobs a higher Buildkite priority."""
+    jobs_by_queue: Dict[str, List[SimulatedJob]] = defaultdict(list)
+    for job in jobs:
+        jobs_by_queue[job.queue].append(job)
+    for queue_jobs in jobs_by_queue.values():
+        queue_jobs.sort(key=lambda job: job.duration / job.parallelism)
+        for rank, job in enumerate(queue_jobs, start=1):
+            job.priority = rank
+
+
+def simulate_build(jobs: List[SimulatedJob], agents_per_queue: Dict[str, int]) -> Dict[str, float]:
+    """
+    Replay jobs against a fixed number of agents per queue, all jobs ready at the start.
+    Agents pick the highest priority job first, ties broken by upload order.
+    Return the time at which each queue finishes its last job.
+    """
+    jobs_by_queue: Dict[str, List[SimulatedJob]] = defaultdict(list)
+    for job in sorted(jobs, key=lambda job: -job.priority):
+        jobs_by_queue[job.queue].append(job)
+
+    finish_times = {}
+    for queue, queue_jobs in jobs_by_queue.items():
+        agents = [0.0] * agents_per_queue.get(queue, 1)
+        for job in queue_jobs:
+            for _ in range(job.parallelism):
+                start = heapq.heappop(agents)
+                heapq.heappush(agents, start + job.duration / job.parallelism)
+        finish_times[queue] = max(agents)
+    return finish_times
+
+
+def get_estimated_duration(step: BuildkiteStep, timing_database: TimingDatabase) -> Optional[float]:
+    """Total recorded duration of a step summed over its shards, if any."""
+    if step.key in timing_database.tests:
+        return sum(timing_database.tests[step.key].values())
+    return timing_database.steps.get(step.key)
+
+
+def get_wall_time(step: BuildkiteStep, timing_database: TimingDatabase) -> float:
+    """Estimated time from the start to the end of a step, its parallel jobs running at the same time."""
+    duration = get_estimated_duration(step, timing_database)
+    return (DEFAULT_STEP_DURATION if duration is None else duration) / (step.parallelism or 1)
+
+
+def schedule_steps(
+        steps: List[Union[BuildkiteStep, BuildkiteBlockStep]],
+        timing_database: TimingDatabase,
+    ) -> List[Union[BuildkiteStep, BuildkiteBlockStep]]:
+    """
+    Reorder test steps for dispatch and set their priority, steps without recorded durations
+    ranked at DEFAULT_STEP_DURATION. Block steps stay right before the step they gate.
+    """
+    block_steps = {step.key: step for step in steps if isinstance(step, BuildkiteBlockStep)}
+    buildkite_steps = [step for step in steps if isinstance(step, BuildkiteStep)]
+
+    jobs = []
+    for index, step in enumerate(buildkite_steps):
+        duration = get_estimated_duration(step, timing_database)
+        jobs.append(SimulatedJob(
+            key=str(index),
+            queue=step.agents["queue"],
+            duration=DEFAULT_STEP_DURATION if duration is None else duration,
+            parallelism=step.parallelism or 1,
+        ))
+    assign_priorities(jobs)
+
+    scheduled_steps = []
+    for job in get_dispatch_order(jobs):
+        step = buildkite_steps[int(job.key)]
+        step.priority = job.priority
+        scheduled_steps.extend(block_steps[key] for key in step.depends_on or [] if key in block_steps)
+        scheduled_steps.append(step)
+    return scheduled_steps
+
+
+def _parse_agents(agents: List[str]) -> Dict[str, int]:
+    agents_per_queue = {}
+    for agent in agents:
+        queue, count = agent.split("=")
+        agents_per_queue[queue] = int(count)
+    return agents_per_queue
+
+
+@click.command()
+@click.option("--recorded_build", type=str, required=True, help="Path to a JSON list of jobs with key, queue, duration and parallelism")
+@click.option("--agents", type=str, multiple=True, help="Number of agents for a queue, as queue=count")
+def main(recorded_build: str, agents: List[str]):
+    """Compare the makespan of a recorded build in its original order with the scheduled order."""
+    with open(recorded_build, "r") as f:
+        jobs = [SimulatedJob(**job) for job in json.load(f)]
+    agents_per_queue = _parse_agents(agents)
+
+    recorded_finish_times = simulate_build(jobs, agents_per_queue)
+    scheduled_jobs = [job.model_copy() for job in get_dispatch_order(jobs)]
+    assign_priorities(scheduled_jobs)
+    scheduled_finish_times = simulate_build(scheduled_jobs, agents_per_queue)
+
+    for queue in sorted(recorded_finish_times):
+        click.echo(f"{queue}: {recorded_finish_times[queue]:.0f}s -> {scheduled_finish_times[queue]:.0f}s")
+    click.echo(f"makespan: {max(recorded_finish_times.values()):.0f}s -> {max(scheduled_finish_times.values()):.0f}s")
+
+
+if __name__ == "__main__":
+    main()
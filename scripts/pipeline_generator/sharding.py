@@ -0,0 +1,115 @@
+import heapq
+import math
+import re
+import shlex
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+
+from .step import TestStep
+
+DEFAULT_SHARD_TARGET_DURATION = 20 * 60  # seconds
+DEFAULT_MAX_PARALLELISM = 8
+SHARD_DESELECT_VARIABLE = "SHARD_DESELECT"
+# pytest-shard flags used by steps that opt into Buildkite parallelism
+SHARD_FLAGS_REGEX = re.compile(
+    r"--shard-id[= ]\$\$BUILDKITE_PARALLEL_JOB\s+--num-shards[= ]\$\$BUILDKITE_PARALLEL_JOB_COUNT"
+)
+
+
+class TimingDatabase(BaseModel):
+    """
+    Historical durations in seconds, keyed by step key.
+    `steps` holds the total duration of a step summed over its shards,
+    `tests` holds per-test durations keyed by pytest node id (or test file) relative to the pytest rootdir,
+    the vLLM checkout at /vllm-workspace, as in JUnit reports (see flaky.get_node_id), e.g.
+    "tests/kernels/test_a.py::test_x". `--deselect` only matches those ids, whatever the step working dir.
+    """
+    steps: Dict[str, float] = {}
+    tests: Dict[str, Dict[str, float]] = {}
+
+
+class ShardPlan(BaseModel):
+    """Parallelism for a step and, if per-test timings are known, the tests each shard runs."""
+    parallelism: int
+    shards: List[List[str]] = []
+
+
+def read_timing_database(file_path: str) -> TimingDatabase:
+    with open(file_path, "r") as f:
+        return TimingDatabase.model_validate_json(f.read())
+
+
+def is_shardable(step: TestStep) -> bool:
+    """A step can be sharded only if its commands already split work by Buildkite parallel job."""
+    return any(SHARD_FLAGS_REGEX.search(command) for command in step.commands)
+
+
+def partition_tests(test_durations: Dict[str, float], num_shards: int) -> List[List[str]]:
+    """Assign tests to shards with the longest-processing-time-first heuristic."""
+    shards: List[List[str]] = [[] for _ in range(num_shards)]
+    loads = [(0.0, shard_index) for shard_index in range(num_shards)]
+    for test_id, duration in sorted(test_durations.items(), key=lambda item: (-item[1], item[0])):
+        load, shard_index = heapq.heappop(loads)
+        shards[shard_index].append(test_id)
+        heapq.heappush(loads, (load + duration, shard_index))
+    return shards
+
+
+def get_shard_plan(
+        step: TestStep,
+        step_key: str,
+        timing_database: TimingDatabase,
+        target_duration: float = DEFAULT_SHARD_TARGET_DURATION,
+        max_parallelism: int = DEFAULT_MAX_PARALLELISM,
+    ) -> Optional[ShardPlan]:
+    """Return the shard plan for a step, or None to keep the parallelism from the test pipeline."""
+    if not is_shardable(step):
+        return None
+    test_durations = timing_database.tests.get(step_key)
+    if test_durations:
+        total_duration = sum(test_durations.values())
+        max_parallelism = min(max_parallelism, len(test_durations))
+    elif step_key in timing_database.steps:
+        total_duration = timing_database.steps[step_key]
+    else:
+        return None
+
+    parallelism = min(max(math.ceil(total_duration / target_duration), 1), max_parallelism)
+    if not test_durations or parallelism == 1:
+        return ShardPlan(parallelism=parallelism)
+    return ShardPlan(parallelism=parallelism, shards=partition_tests(test_durations, parallelism))
+
+
+def _get_deselect_args(test_ids: List[str]) -> str:
+    """`--deselect` arguments for rootdir-relative node ids or test files."""
+    args = []
+    for test_id in test_ids:
+        # Match the whole file rather than every file sharing its name as prefix
+        if "::" not in test_id:
+            test_id += "::"
+        args.append(f"--deselect {shlex.quote(test_id)}")
+    return " ".join(args).replace("$", "$$")
+
+
+def get_sharded_commands(commands: List[str], shard_plan: ShardPlan) -> List[str]:
+    """
+    Replace pytest-shard flags with the planned assignment.
+    Each shard deselects the tests planned for other shards, so tests without
+    recorded timings still run (in every shard) until they show up in the history.
+    """
+    if not shard_plan.shards:
+        return commands
+    cases = []
+    for shard_index in range(len(shard_plan.shards)):
+        other_tests = [
+            test_id
+            for other_index, shard in enumerate(shard_plan.shards) if other_index != shard_index
+            for test_id in shard
+        ]
+        cases.append(f"{shard_index}) {SHARD_DESELECT_VARIABLE}=({_get_deselect_args(other_tests)}) ;;")
+    select_command = f"case $$BUILDKITE_PARALLEL_JOB in {' '.join(cases)} esac"
+    sharded_commands = [
+        SHARD_FLAGS_REGEX.sub(f'"$${{{SHARD_DESELECT_VARIABLE}[@]}}"', command)
+        for command in commands
+    ]
+    return [select_command, *sharded_commands]
@@ -1,12 +1,28 @@
-from pydantic import BaseModel, Field, root_validator, model_validator
-from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, Field, field_serializer, field_validator, root_validator, model_validator
+from typing import List, Dict, Any, Optional, Union
 from typing_extensions import Self
 
-from .utils import AgentQueue, GPUType
+from .matrix import Matrix
+from .utils import IMAGE_STAGE_WORKING_DIRS, AgentQueue, GPUType, ImageStage
 
 BUILD_STEP_KEY = "build"
+# Test commands run from the source tree copied into the test stage of the image at this path
+IMAGE_WORKSPACE_DIR = "/vllm-workspace"
 DEFAULT_TEST_WORKING_DIR = "/vllm-workspace/tests"
 
+# A dependency is a step key, or a mapping such as {"step": key, "allow_failure": True}
+Dependency = Union[str, Dict[str, Any]]
+
+
+def _serialize_depends_on(depends_on: Optional[List[Dependency]]) -> Union[str, List[Dependency], None]:
+    """A single dependency on a key is written as a string, as in hand-written pipelines."""
+    return depends_on[0] if depends_on and len(depends_on) == 1 and isinstance(depends_on[0], str) else depends_on
+
+
+def get_dependency_key(dependency: Dependency) -> str:
+    return dependency if isinstance(dependency, str) else dependency["step"]
+
+
 class TestStep(BaseModel):
     """This class represents a test step defined in the test configuration file."""
     label: str
@@ -21,6 +37,8 @@ class TestStep(BaseModel):
     source_file_dependencies: Optional[List[str]] = None
     soft_fail: Optional[bool] = None
     parallelism: Optional[int] = None
+    matrix: Optional[Matrix] = None
+    image_stage: Optional[ImageStage] = None
     command: Optional[str] = None
     commands: Optional[List[str]] = None
 
@@ -54,6 +72,22 @@ class TestStep(BaseModel):
             raise ValueError("Number of commands must match the number of nodes.")
         return self
 
+    @model_validator(mode="after")
+    def validate_image_stage(self) -> Self:
+        """Only the test stage of the image has the source tree, an earlier stage cannot run from it."""
+        if not self.image_stage or self.image_stage == ImageStage.TEST or "working_dir" not in self.model_fields_set:
+            return self
+        if self.working_dir and (self.working_dir + "/").startswith(IMAGE_WORKSPACE_DIR + "/"):
+            raise ValueError(f"'working_dir' {self.working_dir} does not exist in the {self.image_stage.value} image stage.")
+        return self
+
+
+def get_working_dir(test_step: TestStep, stage: ImageStage) -> Optional[str]:
+    """Working directory of the step in the image of a stage, the stage's WORKDIR unless set explicitly."""
+    if stage != ImageStage.TEST and "working_dir" not in test_step.model_fields_set:
+        return IMAGE_STAGE_WORKING_DIRS[stage]
+    return test_step.working_dir
+
 
 class BuildkiteStep(BaseModel):
     """This class represents a step in Buildkite format."""
@@ -64,29 +98,56 @@ class BuildkiteStep(BaseModel):
     plugins: Optional[List[Dict]] = None
     parallelism: Optional[int] = None
     soft_fail: Optional[bool] = None
-    depends_on: Optional[str] = "build"
+    priority: Optional[int] = None
+    depends_on: Optional[List[Dependency]] = [BUILD_STEP_KEY]
     env: Optional[Dict[str, str]] = None
     retry: Optional[Dict[str, Any]] = None
 
+    @field_validator("depends_on", mode="before")
+    @classmethod
+    def validate_depends_on(cls, depends_on: Any) -> Any:
+        return [depends_on] if isinstance(depends_on, str) else depends_on
+
+    @field_serializer("depends_on")
+    def serialize_depends_on(self, depends_on: Optional[List[Dependency]]) -> Union[str, List[Dependency], None]:
+        return _serialize_depends_on(depends_on)
+
     @model_validator(mode="after")
     def validate_agent_queue(self) -> Self:
         queue = self.agents.get("queue")
         if not AgentQueue(queue):
             raise ValueError(f"Invalid agent queue: {queue}")
+        return self
 
 
 class BuildkiteBlockStep(BaseModel):
     """This class represents a block step in Buildkite format."""
     block: str
     key: str
-    depends_on: Optional[str] = BUILD_STEP_KEY
+    depends_on: Optional[List[str]] = [BUILD_STEP_KEY]
+
+    @field_validator("depends_on", mode="before")
+    @classmethod
+    def validate_depends_on(cls, depends_on: Any) -> Any:
+        return [depends_on] if isinstance(depends_on, str) else depends_on
+
+    @field_serializer("depends_on")
+    def serialize_depends_on(self, depends_on: Optional[List[str]]) -> Union[str, List[str], None]:
+        return _serialize_depends_on(depends_on)
+
+
+class BuildkiteWaitStep(BaseModel):
+    """This class represents a wait step in Buildkite format, steps after it start once all steps before it finish."""
+    wait: str = ""
+    continue_on_failure: Optional[bool] = None
 
 
-def get_step_key(step_label: str) -> str:
+def get_step_key(step_label: str, collapse_dashes: bool = True) -> str:
+    """Without collapse_dashes, every space and comma is a dash, as in the keys of the former Jinja templates."""
     step_key = ""
     skip_chars = "()% "
     for char in step_label.lower():
-        if char in ", " and step_key[-1] != "-":
+        if char in ", " and (not collapse_dashes or step_key[-1] != "-"):
             step_key += "-"
         elif char not in skip_chars:
             step_key += char
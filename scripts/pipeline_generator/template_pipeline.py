@@ -0,0 +1,436 @@
+"""
+The CI and fastcheck pipelines, as formerly rendered from the test-template-ci.j2 and test-template-fastcheck.j2
+Jinja templates, without downloading minijinja and the templates on every build. The golden files of the
+tests are the output of the templates.
+
+Test steps are the raw mappings of the test pipeline yaml, as the templates saw them.
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import click
+import yaml
+
+from .plugin import get_docker_plugin_config, get_kubernetes_plugin_config
+from .step import get_step_key
+from .utils import (
+    AMD_REPO,
+    AMD_TEST_SCRIPT,
+    DEFAULT_WORKING_DIR,
+    MULTI_NODE_TEST_SCRIPT,
+    PIPELINE_FILE_PATH,
+    TEST_DEFAULT_COMMANDS,
+    TEST_PATH,
+    VLLM_ECR_URL,
+    AgentQueue,
+    get_agent_queue,
+    get_multi_node_test_command,
+)
+
+CI_PIPELINE = "ci"
+FASTCHECK_PIPELINE = "fastcheck"
+MAIN_BRANCH = "main"
+IMAGE_BUILD_KEY = "image-build"
+AMD_BUILD_KEY = "amd-build"
+TEST_REPO = f"{VLLM_ECR_URL}/vllm-ci-test-repo"
+POSTMERGE_REPO = f"{VLLM_ECR_URL}/vllm-ci-postmerge-repo"
+AMD_IMAGE = f"{AMD_REPO}:$BUILDKITE_COMMIT"
+HF_HOME_FSX = "/fsx/hf_cache"
+HARDWARE_CI_SCRIPTS = ".buildkite/scripts/hardware_ci"
+DOCKER_VOLUMES = ("/dev/shm:/dev/shm", f"{HF_HOME_FSX}:{HF_HOME_FSX}")
+# Queues of the template pipelines, which are not the ones of the generator yet
+TEMPLATE_AGENT_QUEUES = {
+    AgentQueue.AWS_SMALL_CPU: "cpu_queue_premerge",
+    AgentQueue.A100: "a100_queue",
+    AgentQueue.AWS_1xL4: "gpu_1_queue",
+    AgentQueue.AWS_4xL4: "gpu_4_queue",
+}
+# AMD mirrors of these steps need a machine with several GPUs
+AMD_MULTI_GPU_LABELS = {
+    "Benchmarks",
+    "LoRA Test %N",
+    "Kernels Test %N",
+    "Distributed Tests (4 GPUs)",
+    "Distributed Comm Ops Test",
+    "2 Node Tests (4 GPUs in total)",
+    "Distributed Tests (2 GPUs)",
+    "Plugin Tests (2 GPUs)",
+    "Multi-step Tests (4 GPUs)",
+    "Pipeline Parallelism Test",
+    "LoRA TP Test (Distributed)",
+    "Weight Loading Multiple GPU Test",
+}
+
+
+def _quoted(text: str) -> str:
+    """
+    Value of text placed in a double-quoted yaml string by a template: escapes such as \\" in
+    commands, written for this, are resolved. Text that is not valid there is kept as it is.
+    """
+    try:
+        return yaml.safe_load(f'"{text}"')
+    except yaml.YAMLError:
+        return text
+
+
+def get_retry(limit: int) -> Dict[str, Any]:
+    return {"automatic": [{"exit_status": -1, "limit": limit}, {"exit_status": -10, "limit": limit}]}
+
+
+def get_docker_image(pipeline: str, branch: Optional[str], cuda_tag: str = "") -> str:
+    """Images of builds on main go to the postmerge repository in CI."""
+    repo = POSTMERGE_REPO if pipeline == CI_PIPELINE and branch == MAIN_BRANCH else TEST_REPO
+    return f"{repo}:$BUILDKITE_COMMIT{f'-{cuda_tag}' if cuda_tag else ''}"
+
+
+def _get_test_command(step: Dict, setup_commands: List[str] = TEST_DEFAULT_COMMANDS, separator: str = "&&") -> str:
+    working_dir = step.get("working_dir") or DEFAULT_WORKING_DIR
+    commands = step.get("command") or " && ".join(step.get("commands") or [])
+    return f"{' && '.join(setup_commands)} && cd {working_dir} {separator} {commands}"
+
+
+def get_image_build_step(
+        pipeline: str,
+        branch: Optional[str],
+        cuda_version: Optional[str] = None,
+        cuda_tag: str = "",
+    ) -> Dict[str, Any]:
+    image = get_docker_image(pipeline, branch, cuda_tag)
+    cuda_version_arg = f"--build-arg CUDA_VERSION={cuda_version} " if cuda_version else ""
+    step: Dict[str, Any] = {
+        "label": f":docker: build image CUDA {cuda_version[:-2]}" if cuda_version else ":docker: build image",
+        "key": f"{IMAGE_BUILD_KEY}-{cuda_tag}" if cuda_tag else IMAGE_BUILD_KEY,
+    }
+    if pipeline == CI_PIPELINE:
+        step["depends_on"] = f"block-build-{cuda_tag}" if cuda_tag else None
+    step["agents"] = {"queue": "cpu_queue_postmerge" if pipeline == CI_PIPELINE and branch == MAIN_BRANCH else "cpu_queue_premerge"}
+    step["commands"] = [
+        f"aws ecr-public get-login-password --region us-east-1 | docker login --username AWS --password-stdin {VLLM_ECR_URL}",
+        "#!/bin/bash\n"
+        f"if [[ -z $(docker manifest inspect {image}) ]]; then\n"
+        '  echo "Image not found, proceeding with build..."\n'
+        "else\n"
+        '  echo "Image found"\n'
+        "  exit 0\n"
+        "fi\n",
+        "docker build --file docker/Dockerfile --build-arg max_jobs=16 --build-arg buildkite_commit=$BUILDKITE_COMMIT "
+        f"--build-arg USE_SCCACHE=1 {cuda_version_arg}--tag {image} --target test --progress plain .",
+        f"docker push {image}",
+    ]
+    step["env"] = {"DOCKER_BUILDKIT": "1"}
+    step["retry"] = get_retry(2 if pipeline == CI_PIPELINE else 5)
+    return step
+
+
+def get_test_queue(step: Dict) -> str:
+    if step.get("label") == "Documentation Build":
+        return "small_cpu_queue_premerge"
+    return TEMPLATE_AGENT_QUEUES[get_agent_queue(step.get("no_gpu"), step.get("gpu"), step.get("num_gpus"))]
+
+
+def get_docker_plugin(step: Dict, image: str, analytics: bool = False) -> Dict[str, Any]:
+    """The docker plugin runs the test command itself, with the HF cache of the agents' shared file system."""
+    environment = ["VLLM_USAGE_SOURCE=ci-test", f"HF_HOME={HF_HOME_FSX}", "HF_TOKEN"]
+    if analytics:
+        environment.append("BUILDKITE_ANALYTICS_TOKEN")
+    if step.get("label") == "Speculative decoding tests":
+        environment.append("VLLM_ATTENTION_BACKEND=XFORMERS")
+    return get_docker_plugin_config(
+        image,
+        bool(step.get("no_gpu")),
+        ("bash", "-xc", _quoted(_get_test_command(step))),
+        tuple(environment),
+        DOCKER_VOLUMES,
+        True if step.get("label") == "Benchmarks" else None,
+    )
+
+
+def get_kubernetes_plugin(step: Dict, image: str, pipeline: str) -> Dict[str, Any]:
+    num_gpus = step.get("num_gpus") or 1
+    if pipeline == CI_PIPELINE:
+        return get_kubernetes_plugin_config(image, num_gpus, (f"bash -c '{_get_test_command(step)}'",))
+    return get_kubernetes_plugin_config(image, num_gpus, ("bash",), ("-c", _quoted(f"'{_get_test_command(step)}'")))
+
+
+def get_multi_node_command(step: Dict, image: str) -> str:
+    return get_multi_node_test_command(
+        [" && ".join(commands) for commands in step.get("commands") or []],
+        step.get("working_dir"),
+        step.get("num_nodes"),
+        step.get("num_gpus"),
+        image,
+        script=MULTI_NODE_TEST_SCRIPT,
+    )
+
+
+def _is_multi_node(step: Dict) -> bool:
+    return (step.get("num_nodes") or 0) >= 2
+
+
+def _get_block_step(step: Dict) -> Dict[str, Any]:
+    return {"block": _quoted(f"Run {step['label']}"), "depends_on": IMAGE_BUILD_KEY, "key": f"block-{get_step_key(step['label'], collapse_dashes=False)}"}
+
+
+def _get_command_step(label: str, queue: str, commands: Any, depends_on: Optional[str] = None, **fields) -> Dict[str, Any]:
+    step = {"label": label, "depends_on": depends_on, "soft_fail": True, **fields, "agents": {"queue": queue}}
+    step["commands" if isinstance(commands, list) else "command"] = commands
+    return step
+
+
+def is_blocked(step: Dict, list_file_diff: List[str], run_all: bool, nightly: bool) -> bool:
+    """Whether a CI step waits to be unblocked: nothing it depends on changed, or it is optional outside nightly builds."""
+    if step.get("optional") and not nightly:
+        return True
+    if run_all or nightly or not step.get("source_file_dependencies"):
+        return False
+    return not any(source_file in file for source_file in step["source_file_dependencies"] for file in list_file_diff)
+
+
+def get_ci_test_steps(step: Dict, branch: Optional[str], list_file_diff: List[str], run_all: bool, nightly: bool) -> List[Dict[str, Any]]:
+    image = get_docker_image(CI_PIPELINE, branch)
+    steps = []
+    test_step: Dict[str, Any] = {"label": _quoted(step["label"]), "depends_on": IMAGE_BUILD_KEY}
+    if is_blocked(step, list_file_diff, run_all, nightly):
+        block_step = _get_block_step(step)
+        steps.append(block_step)
+        test_step["depends_on"] = block_step["key"]
+    test_step["agents"] = {"queue": get_test_queue(step)}
+    if _is_multi_node(step):
+        test_step["commands"] = [get_multi_node_command(step, image)]
+    test_step["soft_fail"] = step.get("soft_fail") or False
+    if step.get("parallelism"):
+        test_step["parallelism"] = step["parallelism"]
+    test_step["retry"] = get_retry(1)
+    if not _is_multi_node(step):
+        if step.get("gpu") == "a100":
+            test_step["plugins"] = [get_kubernetes_plugin(step, image, CI_PIPELINE)]
+        else:
+            test_step["plugins"] = [get_docker_plugin(step, image, analytics=branch == MAIN_BRANCH)]
+    steps.append(test_step)
+    return steps
+
+
+def get_fastcheck_test_step(step: Dict, depends_on: str) -> Dict[str, Any]:
+    test_step: Dict[str, Any] = {
+        "label": _quoted(step["label"]),
+        "depends_on": depends_on,
+        "agents": {"queue": get_test_queue(step)},
+        "soft_fail": step.get("soft_fail") or False,
+    }
+    if step.get("parallelism"):
+        test_step["parallelism"] = step["parallelism"]
+    test_step["retry"] = get_retry(5)
+    test_step["plugins"] = [get_docker_plugin(step, get_docker_image(FASTCHECK_PIPELINE, None))]
+    return test_step
+
+
+def get_amd_steps(steps: List[Dict]) -> Dict[str, Any]:
+    """Group of the AMD image build and the AMD mirrors of the steps."""
+    amd_build_step = {
+        "label": "AMD: :docker: build image",
+        "depends_on": None,
+        "soft_fail": True,
+        "commands": [
+            f"grep -i 'from base as test' docker/Dockerfile.rocm && docker build --build-arg max_jobs=16 --tag {AMD_IMAGE} "
+            f"-f docker/Dockerfile.rocm --target test --progress plain . || docker build --build-arg max_jobs=16 --tag {AMD_IMAGE} "
+            "-f docker/Dockerfile.rocm --progress plain .",
+            f"docker push {AMD_IMAGE}",
+        ],
+        "key": AMD_BUILD_KEY,
+        "env": {"DOCKER_BUILDKIT": "1"},
+        "retry": {"automatic": [*get_retry(1)["automatic"], {"exit_status": 1, "limit": 1}]},
+        "agents": {"queue": "amd-cpu"},
+    }
+    amd_setup_commands = ["(command rocm-smi || true)", *TEST_DEFAULT_COMMANDS[1:]]
+    amd_steps = [
+        {
+            "label": _quoted(f"AMD: {step['label']}"),
+            "depends_on": AMD_BUILD_KEY,
+            "agents": {"queue": "amd_mi300" if step["label"] in AMD_MULTI_GPU_LABELS else "amd_mi300_1"},
+            "command": f'bash {AMD_TEST_SCRIPT} "{_get_test_command(step, amd_setup_commands, separator=";")}"',
+            "env": {"DOCKER_BUILDKIT": "1"},
+            "priority": 100,
+            "soft_fail": True,
+        }
+        for step in steps
+        if "amd" in (step.get("mirror_hardwares") or [])
+    ]
+    return {"group": "AMD Tests", "depends_on": None, "steps": [amd_build_step, *amd_steps]}
+
+
+def _get_tpu_notification_command(version: str, step_key: str) -> str:
+    return (
+        f'if [ $$(buildkite-agent step get "outcome" --step "{step_key}") != "passed" ]; then\n'
+        "   cat <<- YAML | buildkite-agent pipeline upload\n"
+        "   steps:\n"
+        '     - label: "Notify owners about failing test"\n'
+        "       agents:\n"
+        "         queue: tpu_v5_queue\n"
+        f'       command: echo "TPU {version} Test failed"\n'
+        "       notify:\n"
+        "         - slack:\n"
+        "             channels:\n"
+        '               - "#collab-google-ci"\n'
+        "YAML\n"
+        "fi\n"
+    )
+
+
+def get_ci_pipeline(steps: List[Dict], branch: Optional[str], list_file_diff: List[str], run_all: bool, nightly: bool) -> List[Dict[str, Any]]:
+    pipeline_steps = [get_image_build_step(CI_PIPELINE, branch)]
+    for cuda_version, cuda_tag in [("12.1.0", "cu121"), ("11.8.0", "cu118")]:
+        pipeline_steps.append({"block": f"Build CUDA {cuda_version[:-2]} image", "key": f"block-build-{cuda_tag}", "depends_on": None})
+        pipeline_steps.append(get_image_build_step(CI_PIPELINE, branch, cuda_version, cuda_tag))
+    for step in steps:
+        if not step.get("fast_check_only"):
+            pipeline_steps.extend(get_ci_test_steps(step, branch, list_file_diff, run_all, nightly))
+    pipeline_steps.append(get_amd_steps(steps))
+    pipeline_steps.extend([
+        _get_command_step("Neuron Test", "neuron", f"bash {HARDWARE_CI_SCRIPTS}/run-neuron-test.sh"),
+        {"block": "Run Intel CPU test", "depends_on": None, "key": "block-intel-cpu"},
+        _get_command_step("Intel CPU Test", "intel-cpu", f"bash {HARDWARE_CI_SCRIPTS}/run-cpu-test.sh", depends_on="block-intel-cpu"),
+        _get_command_step("Intel HPU Test", "intel-hpu", f"bash {HARDWARE_CI_SCRIPTS}/run-hpu-test.sh"),
+        _get_command_step("Intel GPU Test", "intel-gpu", f"bash {HARDWARE_CI_SCRIPTS}/run-xpu-test.sh"),
+    ])
+    ppc64le_command = f"bash {HARDWARE_CI_SCRIPTS}/run-cpu-test-ppc64le.sh"
+    if branch == MAIN_BRANCH:
+        pipeline_steps.append(_get_command_step("IBM Power(ppc64le) CPU Test", "ibm-ppc64le", ppc64le_command))
+    else:
+        pipeline_steps.extend([
+            {"block": "Run IBM Power(ppc64le) CPU Test", "depends_on": None, "key": "block-ibm-ppc64-test"},
+            _get_command_step("IBM Power(ppc64le) CPU Test", "ibm-ppc64le", ppc64le_command, depends_on="block-ibm-ppc64-test"),
+        ])
+    if branch == MAIN_BRANCH or "s390x" in (branch or ""):
+        pipeline_steps.append(_get_command_step("IBM Z (s390x) CPU Test", "ibm_s390x", f"bash {HARDWARE_CI_SCRIPTS}/run-cpu-test-s390x.sh"))
+    if nightly:
+        pipeline_steps.append(_get_command_step("GH200 Test", "gh200_queue", f"nvidia-smi && bash {HARDWARE_CI_SCRIPTS}/run-gh200-test.sh"))
+    pipeline_steps.extend([
+        _get_command_step("TPU V0 Test", "tpu_v5_queue", [
+            "yes | docker system prune -a",
+            f'if [[ -f "{HARDWARE_CI_SCRIPTS}/run-tpu-test.sh" ]]; then bash {HARDWARE_CI_SCRIPTS}/run-tpu-test.sh; fi',
+        ]),
+        _get_command_step("TPU V1 Test", "tpu_v6e_queue", [
+            f'if [[ -f "{HARDWARE_CI_SCRIPTS}/run-tpu-v1-test.sh" ]]; then bash {HARDWARE_CI_SCRIPTS}/run-tpu-v1-test.sh; fi',
+            "yes | docker system prune -a",
+        ]),
+    ])
+    return pipeline_steps
+
+
+def get_fastcheck_pipeline(steps: List[Dict]) -> List[Dict[str, Any]]:
+    image = get_docker_image(FASTCHECK_PIPELINE, None)
+    single_node_steps = [step for step in steps if step.get("gpu") != "a100" and not _is_multi_node(step)]
+    pipeline_steps = [
+        get_image_build_step(FASTCHECK_PIPELINE, None),
+        {"block": "Run Neuron Test", "depends_on": None, "key": "run-neuron-test"},
+        _get_command_step("Neuron Test", "neuron", f"bash {HARDWARE_CI_SCRIPTS}/run-neuron-test.sh", depends_on="run-neuron-test", soft_fail=False),
+    ]
+    for step in single_node_steps:
+        if step.get("fast_check") is True:
+            pipeline_steps.append(get_fastcheck_test_step(step, IMAGE_BUILD_KEY))
+    for step in single_node_steps:
+        if step.get("fast_check") is not True:
+            block_step = _get_block_step(step)
+            pipeline_steps.extend([block_step, get_fastcheck_test_step(step, block_step["key"])])
+    for step in steps:
+        if _is_multi_node(step):
+            block_step = _get_block_step(step)
+            pipeline_steps.extend([
+                block_step,
+                {
+                    "label": _quoted(step["label"]),
+                    "depends_on": block_step["key"],
+                    "agents": {"queue": "gpu_4_queue"},
+                    "commands": [get_multi_node_command(step, image)],
+                },
+            ])
+    pipeline_steps.append({"block": "Run A100 tests", "depends_on": IMAGE_BUILD_KEY})
+    for step in steps:
+        if step.get("gpu") == "a100":
+            a100_step: Dict[str, Any] = {
+                "label": _quoted(step["label"]),
+                "priority": 10000,
+                "agents": {"queue": "a100_queue"},
+                "soft_fail": step.get("soft_fail") or False,
+            }
+            if step.get("parallelism"):
+                a100_step["parallelism"] = step["parallelism"]
+            a100_step["retry"] = get_retry(5)
+            a100_step["plugins"] = [get_kubernetes_plugin(step, image, FASTCHECK_PIPELINE)]
+            pipeline_steps.append(a100_step)
+    for version, script in [("V0", "run-tpu-test.sh"), ("V1", "run-tpu-v1-test.sh")]:
+        block_key = f"block-tpu-{version.lower()}"
+        step_key = f"run-tpu-{version.lower()}-test"
+        pipeline_steps.extend([
+            {"block": f"Run TPU {version} Test", "key": block_key, "depends_on": None},
+            _get_command_step(f"TPU {version} Test", "tpu_v5_queue", [
+                f'if [[ -f "{HARDWARE_CI_SCRIPTS}/{script}" ]]; then bash {HARDWARE_CI_SCRIPTS}/{script}; fi',
+                "yes | docker system prune -a",
+            ], depends_on=block_key, key=step_key),
+            {
+                "label": f"TPU {version} Test Notification",
+                "depends_on": step_key,
+                "agents": {"queue": "tpu_v5_queue"},
+                "commands": _get_tpu_notification_command(version, step_key),
+            },
+        ])
+    pipeline_steps.extend([
+        {"block": "Run GH200 Test", "depends_on": None, "key": "block-gh200"},
+        _get_command_step("GH200 Test", "gh200_queue", f"nvidia-smi && bash {HARDWARE_CI_SCRIPTS}/run-gh200-test.sh", depends_on="block-gh200"),
+        get_amd_steps(steps),
+    ])
+    return pipeline_steps
+
+
+class _Dumper(yaml.SafeDumper):
+    """Write the plugin configs shared by several steps in full, not as yaml aliases."""
+
+    def ignore_aliases(self, data: Any) -> bool:
+        return True
+
+
+def read_template_steps(file_path: str) -> List[Dict]:
+    with open(file_path, "r") as f:
+        return yaml.safe_load(f)["steps"]
+
+
+def write_pipeline(steps: List[Dict[str, Any]], file_path: str) -> None:
+    with open(file_path, "w") as f:
+        yaml.dump({"steps": steps}, f, sort_keys=False, width=float("inf"), Dumper=_Dumper)
+
+
+@click.command()
+@click.option("--pipeline", type=click.Choice([CI_PIPELINE, FASTCHECK_PIPELINE]), required=True, help="Buildkite pipeline to render")
+@click.option("--test_path", type=str, default=TEST_PATH, help="Path to the test pipeline yaml file")
+@click.option("--run_all", type=str, help="If set to 1, run all tests")
+@click.option("--nightly", type=str, help="If set to 1, run all tests including optional ones")
+@click.option("--main_ref", type=str, help="Git ref of main, the diff of a branch starts at its merge-base with it")
+def main(pipeline: str, test_path: str, run_all: Optional[str], nightly: Optional[str], main_ref: Optional[str]):
+    steps = read_template_steps(test_path)
+    branch = os.getenv("BUILDKITE_BRANCH")
+    if pipeline == FASTCHECK_PIPELINE:
+        write_pipeline(get_fastcheck_pipeline(steps), PIPELINE_FILE_PATH)
+        return
+    import subprocess
+    from .diff import MAIN_REF, get_file_diff
+    from .run_all import RunAllMatcher
+    main_ref = main_ref or MAIN_REF
+    run_all = run_all == "1"
+    try:
+        list_file_diff = get_file_diff(branch=branch, main_ref=main_ref).files
+    except subprocess.CalledProcessError as e:
+        # E.g. a shallow clone without main
+        click.echo(f"Could not diff against {main_ref}: {e.stderr.decode().strip()}. Run all tests")
+        list_file_diff = []
+        run_all = True
+    if not run_all:
+        trigger = RunAllMatcher().find_trigger(list_file_diff)
+        if trigger:
+            file, pattern = trigger
+            click.echo(f"Found changes: {file} (matches {pattern}). Run all tests")
+            run_all = True
+    write_pipeline(get_ci_pipeline(steps, branch, list_file_diff, run_all, nightly == "1"), PIPELINE_FILE_PATH)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,26 @@
 import enum
+import shlex
 from typing import Optional, List
 
 # Constants
 HF_HOME = "/root/.cache/huggingface"
 DEFAULT_WORKING_DIR = "/vllm-workspace/tests"
 VLLM_ECR_URL = "public.ecr.aws/q9t5s3a7"
-VLLM_ECR_REPO = f"{VLLM_ECR_URL}/vllm-ci-test-repo"
+VLLM_ECR_REPO_NAME = "vllm-ci-test-repo"
+VLLM_ECR_REPO = f"{VLLM_ECR_URL}/{VLLM_ECR_REPO_NAME}"
 AMD_REPO = "rocm/vllm-ci"
 
 # File paths
 TEST_PATH = ".buildkite/test-pipeline.yaml"
 EXTERNAL_HARDWARE_TEST_PATH = ".buildkite/external-tests.yaml"
 PIPELINE_FILE_PATH = ".buildkite/pipeline.yaml"
-MULTI_NODE_TEST_SCRIPT = ".buildkite/run-multi-node-test.sh"
+MULTI_NODE_LAUNCHER = ".buildkite/pipeline_generator/multi_node.py"
+CHECKPOINT_SCRIPT = ".buildkite/pipeline_generator/checkpoint.py"
+PROFILER_SCRIPT = ".buildkite/pipeline_generator/profiler.py"
+# Archive of the pipeline_generator package a pipeline was generated with, for the steps running its modules
+GENERATOR_ARTIFACT = "pipeline_generator.tar.gz"
+AMD_TEST_SCRIPT = ".buildkite/scripts/hardware_ci/run-amd-test.sh"
+MULTI_NODE_TEST_SCRIPT = "./.buildkite/scripts/run-multi-node-test.sh"
 
 TEST_DEFAULT_COMMANDS = [
     "(command nvidia-smi || true)", # Sanity check for Nvidia GPU setup
@@ -22,9 +30,61 @@ TEST_DEFAULT_COMMANDS = [
 
 STEPS_TO_BLOCK = []
 
+# Retry when the agent is lost or stopped, e.g. a preempted instance
+AGENT_RETRY_RULES = [
+    {"exit_status": -1, "limit": 2},
+    {"exit_status": -10, "limit": 2},
+]
+
+# Changes to files matching these patterns (shell globs, matched as prefixes) run all tests
+RUN_ALL_PATTERNS = [
+    ".buildkite/test-pipeline",
+    "docker/Dockerfile",
+    "CMakeLists.txt",
+    "requirements/common.txt",
+    "requirements/cuda.txt",
+    "requirements/build.txt",
+    "requirements/test.txt",
+    "setup.py",
+    "csrc/",
+]
+RUN_ALL_IGNORE_PATTERNS = [
+    "docker/Dockerfile.",
+]
+
+# Files matching these patterns (same syntax as above) are not used by anything running in the test image.
+# The image contains the whole source tree (tests, docs and .buildkite scripts run from it), so keep this short.
+IMAGE_INPUT_IGNORE_PATTERNS = [
+    ".github/",
+]
+
 class GPUType(str, enum.Enum):
     A100 = "a100"
 
+class ImageStage(str, enum.Enum):
+    """Stages of the test image, a step using the base stage starts before the kernels are compiled."""
+    BASE = "base"
+    WHEEL = "wheel"
+    TEST = "test"
+
+# Dockerfile target of each stage
+IMAGE_STAGE_TARGETS = {
+    ImageStage.BASE: "base",
+    ImageStage.WHEEL: "build",
+    ImageStage.TEST: "test",
+}
+
+# Stages built by a step of their own, ahead of the full image. Later stages compile the kernels,
+# so they are pushed by the build of the full image rather than compiled again on another agent.
+SEPARATE_IMAGE_STAGES = {ImageStage.BASE}
+
+# WORKDIR of the Dockerfile target of each stage, only the test stage has the tests under /vllm-workspace
+IMAGE_STAGE_WORKING_DIRS = {
+    ImageStage.BASE: "/workspace",
+    ImageStage.WHEEL: "/workspace",
+    ImageStage.TEST: DEFAULT_WORKING_DIR,
+}
+
 class AgentQueue(str, enum.Enum):
     AWS_CPU = "cpu_queue"
     AWS_SMALL_CPU = "small_cpu_queue"
@@ -43,8 +103,11 @@ def get_agent_queue(no_gpu: Optional[bool], gpu_type: Optional[str], num_gpus: O
     return AgentQueue.AWS_1xL4 if not num_gpus or num_gpus == 1 else AgentQueue.AWS_4xL4
 
 
-def get_full_test_command(test_commands: List[str], step_working_dir: str) -> str:
-    """Convert test commands into one-line command with the right directory."""
+def get_full_test_command(test_commands: List[str], step_working_dir: str, profile_name: Optional[str] = None) -> str:
+    """
+    Convert test commands into one-line command with the right directory.
+    With a profile name, the command runs through the profiler, which times the setup and test phases.
+    """
     working_dir = step_working_dir or DEFAULT_WORKING_DIR
     test_commands_str = ";\n".join(test_commands)
     full_test_commands = [
@@ -52,7 +115,17 @@ def get_full_test_command(test_commands: List[str], step_working_dir: str) -> st
         f"cd {working_dir}",
         test_commands_str
     ]
-    return ";\n".join(full_test_commands)
+    if not profile_name:
+        return ";\n".join(full_test_commands)
+    full_test_commands.insert(0, get_profile_phase_command("setup"))
+    full_test_commands.insert(-1, get_profile_phase_command("test"))
+    full_test_command = ";\n".join(full_test_commands)
+    return f"python3 {PROFILER_SCRIPT} --artifact --name {profile_name} -- bash -c {shlex.quote(full_test_command)}"
+
+
+def get_profile_phase_command(phase: str) -> str:
+    """Mark the start of a phase for the profiler ($$ escapes Buildkite interpolation)."""
+    return f'echo "{phase} $(date +%s.%N)" >> "$$PROFILE_PHASE_FILE"'
 
 
 def get_multi_node_test_command(
@@ -60,15 +133,59 @@ def get_multi_node_test_command(
         working_dir: str,
         num_nodes: int,
         num_gpus: int,
-        docker_image_path: str
+        docker_image_path: str,
+        script: Optional[str] = None
+        ) -> str:
+    """
+    Run the multi-node launcher with the step's spec, quoted as a whole so that commands can contain quotes.
+    With a script, such as MULTI_NODE_TEST_SCRIPT of the vLLM repository, the spec is passed to it
+    as positional arguments, the commands of each node double-quoted.
+    """
+    if script:
+        node_commands = "".join(f' "{commands}"' for commands in test_commands)
+        return f"{script} {working_dir or DEFAULT_WORKING_DIR} {num_nodes} {num_gpus} {docker_image_path}{node_commands}"
+    from .multi_node import MultiNodeSpec
+    spec = MultiNodeSpec(
+        num_nodes=num_nodes,
+        num_gpus=num_gpus,
+        commands=test_commands,
+        working_dir=working_dir or DEFAULT_WORKING_DIR,
+        image=docker_image_path,
+    )
+    return f"python3 {MULTI_NODE_LAUNCHER} --spec {shlex.quote(spec.to_json())}"
+
+
+def get_checkpoint_test_command(
+        test_commands: List[str],
+        step_working_dir: str,
+        checkpoint_name: str,
+        profile_name: Optional[str] = None
         ) -> str:
-    quoted_commands = [f"'{command}'" for command in test_commands]
-    multi_node_command = [
-        MULTI_NODE_TEST_SCRIPT,
-        working_dir or DEFAULT_WORKING_DIR,
-        str(num_nodes),
-        str(num_gpus),
-        docker_image_path,
-        *quoted_commands
+    """Run the full test command through the checkpoint wrapper, which skips tests completed by a preempted attempt."""
+    full_test_command = get_full_test_command(test_commands, step_working_dir, profile_name)
+    return f"python3 {CHECKPOINT_SCRIPT} --artifact --name {checkpoint_name} -- bash -c {shlex.quote(full_test_command)}"
+
+
+def get_generator_download_commands(directory: str) -> List[str]:
+    """Commands extracting the pipeline_generator package the pipeline was generated with into a directory."""
+    return [
+        f"mkdir -p {directory} && buildkite-agent artifact download {GENERATOR_ARTIFACT} {directory}",
+        f"tar xzf {directory}/{GENERATOR_ARTIFACT} -C {directory}",
     ]
-    return " ".join(map(str, multi_node_command))
+
+
+def upload_generator_artifact() -> None:
+    """Upload this copy of the pipeline_generator package, for get_generator_download_commands."""
+    import os
+    import subprocess
+    import tarfile
+    import tempfile
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with tarfile.open(os.path.join(temp_dir, GENERATOR_ARTIFACT), "w:gz") as tar:
+            tar.add(
+                package_dir,
+                arcname="pipeline_generator",
+                filter=lambda info: None if "__pycache__" in info.name else info,
+            )
+        subprocess.run(["buildkite-agent", "artifact", "upload", GENERATOR_ARTIFACT], cwd=temp_dir, check=True)
@@ -0,0 +1,242 @@
+import json
+import os
+import pytest
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import yaml
+
+from scripts.pipeline_generator.benchmark_pipeline import (
+    BENCHMARK_STORE_STEP_KEY,
+    NIGHTLY_PIPELINE,
+    PERF_PIPELINE,
+    fetch_labels,
+    get_benchmark_step_keys,
+    get_selected_pipelines,
+    main,
+    merge_append,
+    merge_pipelines,
+    parse_labels,
+)
+
+NIGHTLY_PIPELINE_CONTENT = """\
+common: &common
+  agents:
+    queue: A100
+  plugins:
+    - docker#v5.2.0:
+        image: vllm
+steps:
+  - label: "Wait for container to be ready"
+    agents:
+      queue: A100
+    command: ["sleep", "60"]
+  - block: "Run nightly benchmarks"
+  - label: "A100 vllm"
+    <<: *common
+    command: ["bash", "nightly.sh"]
+"""
+PERF_PIPELINE_CONTENT = """\
+steps:
+  - label: "A100"
+    agents: &agents
+      queue: A100
+    command: ["bash", "benchmark.sh"]
+  - label: "H100"
+    agents: *agents
+    env:
+      GPU: H100
+"""
+
+
+def _write_pipelines(root):
+    for path, content in ((NIGHTLY_PIPELINE, NIGHTLY_PIPELINE_CONTENT), (PERF_PIPELINE, PERF_PIPELINE_CONTENT)):
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), "w") as f:
+            f.write(content)
+
+
+@pytest.fixture
+def vllm_root():
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _write_pipelines(temp_dir)
+        os.chdir(temp_dir)
+        try:
+            yield temp_dir
+        finally:
+            os.chdir(cwd)
+
+
+@pytest.fixture
+def github_api():
+    """Local stub of the GitHub pulls API, PR 1 having both benchmark labels and PR 2 none."""
+    labels = {"1": ["nightly-benchmarks", "perf-benchmarks", "ready"], "2": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            pull_request = self.path.rsplit("/", 1)[-1]
+            if not self.path.startswith("/repos/vllm-project/vllm/pulls/") or pull_request not in labels:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = json.dumps({"number": int(pull_request), "labels": [{"name": name} for name in labels[pull_request]]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_merge_append():
+    left = {"steps": [{"label": "a"}], "env": {"A": "1", "B": "1"}, "agents": {"queue": "cpu"}}
+    right = {"steps": [{"label": "b"}], "env": {"B": "2", "C": "2"}, "agents": "gpu"}
+    merged = merge_append(left, right)
+    assert merged == {
+        "steps": [{"label": "a"}, {"label": "b"}],
+        "env": {"A": "1", "B": "2", "C": "2"},
+        "agents": "gpu",
+    }
+    # Neither side is modified
+    assert left["steps"] == [{"label": "a"}]
+    assert left["env"] == {"A": "1", "B": "1"}
+
+
+def test_merge_append_empty():
+    assert merge_append(None, {"steps": []}) == {"steps": []}
+    assert merge_append({"steps": [1]}, None) is None
+
+
+def test_merge_pipelines(vllm_root):
+    pipeline = merge_pipelines([NIGHTLY_PIPELINE, PERF_PIPELINE])
+    assert [step.get("label", step.get("block")) for step in pipeline["steps"]] == [
+        "Wait for container to be ready",
+        "Run nightly benchmarks",
+        "A100 vllm",
+        "A100",
+        "H100",
+    ]
+    # Merge keys and aliases are resolved
+    assert pipeline["steps"][2]["agents"] == {"queue": "A100"}
+    assert pipeline["steps"][2]["plugins"] == [{"docker#v5.2.0": {"image": "vllm"}}]
+    assert pipeline["steps"][4]["agents"] == {"queue": "A100"}
+    assert pipeline["common"]["agents"] == {"queue": "A100"}
+
+
+def test_merge_pipelines_none():
+    assert merge_pipelines([]) is None
+
+
+def test_get_selected_pipelines():
+    assert get_selected_pipelines("1", "feature", ["perf-benchmarks", "nightly-benchmarks"]) == [NIGHTLY_PIPELINE, PERF_PIPELINE]
+    assert get_selected_pipelines("1", "feature", ["perf-benchmarks"]) == [PERF_PIPELINE]
+    assert get_selected_pipelines("1", "main", []) == []
+    # Labels match exactly
+    assert get_selected_pipelines("1", "feature", ["no-perf-benchmarks"]) == []
+    assert get_selected_pipelines("false", "main", ["nightly-benchmarks"]) == [PERF_PIPELINE]
+    assert get_selected_pipelines("false", "feature", ["nightly-benchmarks"]) == []
+
+
+def test_parse_labels():
+    assert parse_labels(json.dumps({"labels": [{"name": "perf-benchmarks"}, {"name": "ready"}]})) == ["perf-benchmarks", "ready"]
+    assert parse_labels(json.dumps({"labels": None})) == []
+    assert parse_labels(json.dumps(["perf-benchmarks", "ready"])) == ["perf-benchmarks", "ready"]
+    assert parse_labels("perf-benchmarks\n\n  ready \n") == ["perf-benchmarks", "ready"]
+    assert parse_labels("") == []
+    with pytest.raises(ValueError):
+        parse_labels("42")
+
+
+def test_fetch_labels(github_api):
+    assert fetch_labels("1", github_api) == ["nightly-benchmarks", "perf-benchmarks", "ready"]
+    assert fetch_labels("2", github_api + "/") == []
+
+
+def test_main_skips(vllm_root, capsys):
+    assert main(["--pull_request", "false", "--branch", "feature"]) == 0
+    assert not os.path.exists("final.yaml")
+    assert "Skipping performance benchmark." in capsys.readouterr().out
+
+
+def test_main_with_labels_file(vllm_root):
+    with open("labels.txt", "w") as f:
+        f.write("perf-benchmarks\n")
+    assert main(["--pull_request", "1", "--labels_file", "labels.txt", "--output", "final.yaml"]) == 0
+    with open("final.yaml", "r") as f:
+        content = f.read()
+    assert "*agents" not in content and "&agents" not in content
+    assert yaml.safe_load(content) == yaml.safe_load(PERF_PIPELINE_CONTENT)
+
+
+def test_main_without_selected_labels(vllm_root, github_api):
+    assert main(["--pull_request", "2", "--github_api", github_api]) == 0
+    assert not os.path.exists("final.yaml")
+
+
+def test_main_with_github_api_error(vllm_root, github_api, capsys):
+    # The stub answers 404 for unknown PRs
+    assert main(["--pull_request", "3", "--github_api", github_api]) == 0
+    assert not os.path.exists("final.yaml")
+    output = capsys.readouterr()
+    assert "Could not get the labels of PR 3" in output.err
+    assert "Skipping performance benchmark." in output.out
+
+
+def test_main_with_github_api(vllm_root, github_api):
+    assert main(["--pull_request", "1", "--github_api", github_api, "--output", "final.yaml"]) == 0
+    with open("final.yaml", "r") as f:
+        content = f.read()
+    assert "&" not in content and "<<" not in content
+    pipeline = yaml.safe_load(content)
+    assert pipeline == merge_pipelines([NIGHTLY_PIPELINE, PERF_PIPELINE])
+    assert len(pipeline["steps"]) == 5
+
+
+def test_get_benchmark_step_keys():
+    pipeline = {"steps": [
+        {"label": "A100", "plugins": [{"docker#v5.2.0": {"command": ["a"]}}]},
+        {"block": "Run"},
+        {"label": "A100", "commands": ["b"]},
+        {"group": "H100", "steps": [{"label": "H100 (TP 2)", "command": "c"}, {"label": "Custom", "key": "a100-2", "command": "d"}]},
+        {"wait": None},
+    ]}
+    assert get_benchmark_step_keys(pipeline) == ["a100", "a100-3", "h100-tp-2", "a100-2"]
+    assert pipeline["steps"][2]["key"] == "a100-3"
+
+
+def test_main_with_benchmark_store(vllm_root):
+    with open("labels.txt", "w") as f:
+        f.write("perf-benchmarks\n")
+    assert main(["--pull_request", "1", "--labels_file", "labels.txt", "--benchmark_store", "/mnt/benchmarks.db"]) == 0
+    with open("final.yaml", "r") as f:
+        steps = yaml.safe_load(f)["steps"]
+    assert [step.get("label", "wait") for step in steps] == ["A100", "H100", "wait", "Store benchmark results"]
+    assert steps[2] == {"wait": None, "continue_on_failure": True}
+    assert steps[3]["key"] == BENCHMARK_STORE_STEP_KEY
+    # The same benchmarks run on each GPU, their results are downloaded per step
+    assert [step["key"] for step in steps[:2]] == ["a100", "h100"]
+    assert steps[3]["commands"][1:] == [
+        "mkdir -p .benchmark-store && buildkite-agent artifact download pipeline_generator.tar.gz .benchmark-store",
+        "tar xzf .benchmark-store/pipeline_generator.tar.gz -C .benchmark-store",
+        'buildkite-agent artifact download "results/*.json" results/a100 --step a100 || echo "No benchmark results of a100"',
+        'buildkite-agent artifact download "results/*.json" results/h100 --step h100 || echo "No benchmark results of h100"',
+        "PYTHONPATH=.benchmark-store python -m pipeline_generator.benchmark_store ingest --store /mnt/benchmarks.db --results_dir results",
+        "PYTHONPATH=.benchmark-store python -m pipeline_generator.benchmark_store detect --store /mnt/benchmarks.db --annotate",
+    ]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,215 @@
+import json
+import os
+import pytest
+import sys
+import tempfile
+from unittest import mock
+
+from click.testing import CliRunner
+
+from scripts.pipeline_generator import benchmark_store
+from scripts.pipeline_generator.benchmark_store import (
+    BenchmarkResult,
+    BenchmarkStore,
+    detect_regression,
+    find_regressions,
+    get_regression_annotation,
+    main,
+    mann_whitney_u,
+    read_benchmark_metrics,
+    read_benchmark_results,
+)
+
+SERVING_RESULT = {
+    "date": "20240801-120000",
+    "backend": "vllm",
+    "model_id": "meta-llama/Meta-Llama-3-8B",
+    "request_rate": 1.0,
+    "completed": 200,
+    "request_throughput": 0.98,
+    "output_throughput": 180.5,
+    "mean_ttft_ms": 25.3,
+    "p99_ttft_ms": 60.1,
+    "ttfts": [0.02, 0.03],
+}
+LATENCY_RESULT = {"avg_latency": 1.5, "latencies": [1.4, 1.6], "percentiles": {"50": 1.5, "90": 1.58, "99": 1.6}}
+THROUGHPUT_RESULT = {"elapsed_time": 100.0, "num_requests": 1000, "requests_per_second": 10.0, "tokens_per_second": 4000.0}
+
+
+def _result(commit, timestamp, value, metric="request_throughput", benchmark="serving_llama8B_tp1", branch="main", build=0):
+    return BenchmarkResult(
+        commit=commit,
+        branch=branch,
+        build=build,
+        timestamp=timestamp,
+        benchmark=benchmark,
+        metric=metric,
+        value=value,
+    )
+
+
+@pytest.fixture
+def store():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield BenchmarkStore(os.path.join(temp_dir, "benchmarks.db"))
+
+
+def _write_results(results_dir, results):
+    os.makedirs(results_dir, exist_ok=True)
+    for name, content in results.items():
+        with open(os.path.join(results_dir, name), "w") as f:
+            f.write(content if isinstance(content, str) else json.dumps(content))
+
+
+def test_read_benchmark_metrics():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _write_results(temp_dir, {"serving.json": SERVING_RESULT, "latency.json": LATENCY_RESULT, "list.json": [1, 2]})
+        assert read_benchmark_metrics(os.path.join(temp_dir, "serving.json")) == {
+            "request_throughput": 0.98,
+            "output_throughput": 180.5,
+            "mean_ttft_ms": 25.3,
+            "p99_ttft_ms": 60.1,
+        }
+        assert read_benchmark_metrics(os.path.join(temp_dir, "latency.json")) == {
+            "avg_latency": 1.5,
+            "latency_p50": 1.5,
+            "latency_p90": 1.58,
+            "latency_p99": 1.6,
+        }
+        assert read_benchmark_metrics(os.path.join(temp_dir, "list.json")) == {}
+
+
+def test_read_benchmark_results():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _write_results(temp_dir, {
+            "throughput_llama8B_tp1.json": THROUGHPUT_RESULT,
+            "serving_llama8B_tp1.json": SERVING_RESULT,
+            "serving_llama70B_tp4.json": "{",
+            "serving_llama8B_tp1.commands": "vllm serve",
+        })
+        results = read_benchmark_results(temp_dir, "abc", "main", 12, 1722513600.0)
+    assert {(result.benchmark, result.metric) for result in results} == {
+        ("serving_llama8B_tp1", "request_throughput"),
+        ("serving_llama8B_tp1", "output_throughput"),
+        ("serving_llama8B_tp1", "mean_ttft_ms"),
+        ("serving_llama8B_tp1", "p99_ttft_ms"),
+        ("throughput_llama8B_tp1", "requests_per_second"),
+        ("throughput_llama8B_tp1", "tokens_per_second"),
+    }
+    assert all(result.commit == "abc" and result.build == 12 and result.date == "2024-08-01" for result in results)
+
+
+def test_read_benchmark_results_per_step(store):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # As downloaded by the store step, the same benchmark from the A100 and H100 steps
+        _write_results(os.path.join(temp_dir, "a100", "results"), {"serving_llama8B_tp1.json": SERVING_RESULT})
+        _write_results(os.path.join(temp_dir, "h100", "results"), {"serving_llama8B_tp1.json": {**SERVING_RESULT, "request_throughput": 2.1}})
+        results = read_benchmark_results(temp_dir, "abc", "main", 12, 1722513600.0)
+    assert store.put(results) == 8
+    assert store.get_series()[:2] == [("a100/serving_llama8B_tp1", "mean_ttft_ms"), ("a100/serving_llama8B_tp1", "output_throughput")]
+    assert store.get_history("main", "a100/serving_llama8B_tp1", "request_throughput", 1) == [("abc", [0.98])]
+    assert store.get_history("main", "h100/serving_llama8B_tp1", "request_throughput", 1) == [("abc", [2.1])]
+
+
+def test_store_history(store):
+    assert store.put([
+        _result("c1", 100, 10.0),
+        _result("c2", 200, 11.0),
+        _result("c2", 250, 11.5, build=1),
+        _result("c3", 300, 12.0),
+        _result("c3", 300, 1.0, metric="mean_ttft_ms"),
+        _result("p1", 400, 5.0, branch="feature"),
+    ]) == 6
+    assert store.get_series() == [("serving_llama8B_tp1", "mean_ttft_ms"), ("serving_llama8B_tp1", "request_throughput")]
+    assert store.get_history("main", "serving_llama8B_tp1", "request_throughput", 10) == [
+        ("c1", [10.0]),
+        ("c2", [11.0, 11.5]),
+        ("c3", [12.0]),
+    ]
+    assert store.get_history("main", "serving_llama8B_tp1", "request_throughput", 2) == [("c2", [11.0, 11.5]), ("c3", [12.0])]
+    # Re-ingesting a build replaces its results
+    store.put([_result("c3", 300, 13.0)])
+    assert store.get_history("main", "serving_llama8B_tp1", "request_throughput", 1) == [("c3", [13.0])]
+
+
+def test_mann_whitney_u():
+    # Every value of the sample is greater: 1 ordering out of C(6, 3)
+    assert mann_whitney_u([4, 5, 6], [1, 2, 3]) == pytest.approx(1 / 20)
+    assert mann_whitney_u([1, 2, 3], [4, 5, 6]) == pytest.approx(1.0)
+    assert mann_whitney_u([1, 3, 5], [2, 4, 6]) == pytest.approx(16 / 20)
+    # Ties use the normal approximation
+    assert mann_whitney_u([2, 2, 2], [2, 2, 2]) == 1.0
+    assert mann_whitney_u([3, 3, 4, 5, 6] * 4, [1, 1, 2, 2, 3] * 4) < 0.001
+    assert mann_whitney_u([], [1]) == 1.0
+
+
+def test_detect_regression():
+    stable = [(f"c{i}", [100.0 + i % 3]) for i in range(10)]
+    assert detect_regression(stable, higher_is_better=True) is None
+    # Throughput drop of 20%
+    dropped = [*stable, *((f"d{i}", [80.0 + i]) for i in range(3))]
+    baseline_median, recent_median, p_value = detect_regression(dropped, higher_is_better=True)
+    assert baseline_median == 101.0
+    assert recent_median == 81.0
+    assert p_value < 0.01
+    # The same values are an improvement of a latency
+    assert detect_regression(dropped, higher_is_better=False) is None
+    # A significant change within the noise threshold is not a regression
+    assert detect_regression([*stable, *((f"d{i}", [99.0]) for i in range(3))], higher_is_better=True) is None
+    # Not enough history
+    assert detect_regression(dropped[-3:], higher_is_better=True) is None
+
+
+def test_find_regressions(store):
+    results = []
+    for i in range(10):
+        results.append(_result(f"c{i}", i, 100.0 + i % 3))
+        results.append(_result(f"c{i}", i, 25.0 + i % 2, metric="mean_ttft_ms"))
+    for i in range(10, 13):
+        results.append(_result(f"c{i}", i, 70.0 + i))
+        results.append(_result(f"c{i}", i, 25.0, metric="mean_ttft_ms"))
+    store.put(results)
+    regressions = find_regressions(store, "c12")
+    assert len(regressions) == 1
+    regression = regressions[0]
+    assert (regression.benchmark, regression.metric, regression.since_commit) == ("serving_llama8B_tp1", "request_throughput", "c10")
+    assert regression.relative_change == pytest.approx(-0.198, abs=1e-3)
+    # An older commit is not checked again
+    assert find_regressions(store, "c11") == []
+    assert find_regressions(store, "c12", branch="feature") == []
+
+    annotation = get_regression_annotation(regressions)
+    assert "### Benchmark regressions at c12" in annotation
+    assert "| serving_llama8B_tp1 | request_throughput | c10 | 101 | 81 | -19.8% |" in annotation
+
+
+def test_main_ingest_and_detect():
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store_path = os.path.join(temp_dir, "benchmarks.db")
+        results_dir = os.path.join(temp_dir, "results")
+        for i, throughput in enumerate([10.0, 10.1, 9.9, 10.0, 10.2, 10.1, 9.9, 10.0, 7.0, 7.1, 6.9]):
+            _write_results(results_dir, {"serving_llama8B_tp1.json": {**SERVING_RESULT, "request_throughput": throughput}})
+            result = runner.invoke(main, [
+                "ingest", "--store", store_path, "--results_dir", results_dir,
+                "--commit", f"commit{i}", "--branch", "main", "--build", str(i), "--timestamp", str(1722513600 + i),
+            ])
+            assert result.exit_code == 0, result.output
+            assert "Stored 4 results of 1 benchmarks" in result.output
+
+        with mock.patch.object(benchmark_store.subprocess, "run") as run:
+            result = runner.invoke(main, ["detect", "--store", store_path, "--commit", "commit10", "--branch", "main", "--annotate"])
+        assert result.exit_code == 0, result.output
+        assert "request_throughput" in result.output
+        command = run.call_args.args[0]
+        assert command[:5] == ["buildkite-agent", "annotate", "--style", "error", "--context"]
+        assert "request_throughput" in command[-1]
+
+        result = runner.invoke(main, ["detect", "--store", store_path, "--commit", "commit7", "--branch", "main"])
+        assert "No regression at commit7" in result.output
+        result = runner.invoke(main, ["detect", "--store", store_path, "--commit", "commit10", "--branch", "feature"])
+        assert "Skipping regression detection on branch feature" in result.output
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
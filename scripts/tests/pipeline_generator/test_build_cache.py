@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+
+import pytest
+import sys
+
+from scripts.pipeline_generator.build_cache import (
+    BuildCache,
+    ImageBuild,
+    get_bake_commands,
+    get_bake_file,
+    get_build_cache,
+    get_cache_from,
+    get_cache_key,
+    get_cache_options,
+    get_cache_to,
+    get_variant,
+)
+
+CU121_IMAGE = ImageBuild(name="image-cu121", tags=["registry/repo:abc-cu121"], cuda_version="12.1.0")
+
+
+@pytest.mark.parametrize(
+    ("url", "expected_result"),
+    [
+        ("registry/cache", BuildCache(ref="registry/cache", branch="feature/x")),
+        ("registry://registry/cache", BuildCache(ref="registry/cache", branch="feature/x")),
+        ("file:///var/cache/buildkit", BuildCache(type="local", ref="/var/cache/buildkit", branch="feature/x")),
+    ],
+)
+def test_get_build_cache(url, expected_result):
+    assert get_build_cache(url, "feature/x") == expected_result
+    assert get_build_cache(url).branch == "main"
+
+
+def test_get_cache_key():
+    assert get_variant(CU121_IMAGE) == "cu121-test"
+    assert get_variant(ImageBuild(name="image", tags=[], target="base")) == "default-base"
+    assert get_cache_key("feature/x", "cu121-test") == "feature-x-cu121-test"
+    assert get_cache_key("..", "default-test") == "main-default-test"
+    assert len(get_cache_key("a" * 200, "cu121-test")) == 128
+
+
+def test_get_cache_from_falls_back_to_main():
+    build_cache = BuildCache(ref="registry/cache", branch="feature/x")
+    assert get_cache_from(build_cache, "cu121-test") == [
+        "type=registry,ref=registry/cache:feature-x-cu121-test",
+        "type=registry,ref=registry/cache:main-cu121-test",
+    ]
+    assert get_cache_from(BuildCache(ref="registry/cache"), "cu121-test") == ["type=registry,ref=registry/cache:main-cu121-test"]
+
+
+def test_get_cache_to():
+    assert get_cache_to(BuildCache(ref="registry/cache", branch="feature/x"), "cu121-test") == (
+        "type=registry,ref=registry/cache:feature-x-cu121-test,mode=max,image-manifest=true,oci-mediatypes=true"
+    )
+    assert get_cache_to(BuildCache(type="local", ref="/cache"), "cu121-test") == "type=local,dest=/cache/main-cu121-test,mode=max"
+    assert get_cache_options(None, CU121_IMAGE) == []
+
+
+def test_get_bake_file():
+    build_cache = BuildCache(ref="registry/cache", branch="feature/x")
+    image_builds = [ImageBuild(name="image", tags=["registry/repo:abc", "registry/repo:content-123"]), CU121_IMAGE]
+    bake_file = get_bake_file(image_builds, {"max_jobs": "64"}, build_cache)
+    assert bake_file["group"]["default"]["targets"] == ["image", "image-cu121"]
+    assert bake_file["target"]["image"]["args"] == {"max_jobs": "64"}
+    assert bake_file["target"]["image"]["tags"] == ["registry/repo:abc", "registry/repo:content-123"]
+    assert bake_file["target"]["image-cu121"]["args"] == {"max_jobs": "64", "CUDA_VERSION": "12.1.0"}
+    assert bake_file["target"]["image-cu121"]["cache-from"] == get_cache_from(build_cache, "cu121-test")
+    assert bake_file["target"]["image-cu121"]["cache-to"] == [get_cache_to(build_cache, "cu121-test")]
+    assert "cache-from" not in get_bake_file(image_builds, {})["target"]["image"]
+
+
+def test_get_bake_commands():
+    commands = get_bake_commands([CU121_IMAGE], {}, BuildCache(ref="registry/cache"))
+    assert "docker buildx create --name vllm-builder --driver docker-container" in commands[0]
+    assert commands[-1] == "docker buildx bake --builder vllm-builder --file docker-bake.json --push --progress plain"
+    assert json.loads(commands[1].split("\n", 1)[1].rsplit("\nEOF", 1)[0]) == get_bake_file([CU121_IMAGE], {}, BuildCache(ref="registry/cache"))
+    assert get_bake_commands([CU121_IMAGE], {})[-1] == "docker buildx bake --file docker-bake.json --push --progress plain"
+
+
+def _has_buildx():
+    if not shutil.which("docker"):
+        return False
+    return subprocess.run(["docker", "buildx", "version"], capture_output=True).returncode == 0
+
+
+@pytest.mark.skipif(not _has_buildx(), reason="docker buildx is not available")
+def test_registry_cache_round_trip():
+    """Export the cache of a build to a local registry, and import it in a build from a clean builder."""
+    registry = f"registry-{uuid.uuid4().hex[:8]}"
+    builder = f"builder-{uuid.uuid4().hex[:8]}"
+    subprocess.run(["docker", "run", "-d", "--name", registry, "-p", "5000", "registry:2"], check=True)
+    try:
+        port = subprocess.run(["docker", "port", registry, "5000"], capture_output=True, text=True, check=True).stdout.split(":")[-1].strip()
+        build_cache = BuildCache(ref=f"localhost:{port}/cache", branch="feature/x")
+        image_build = ImageBuild(name="image", tags=[f"localhost:{port}/image:test"], target="test")
+        with tempfile.TemporaryDirectory() as context:
+            with open(os.path.join(context, "Dockerfile"), "w") as f:
+                f.write("FROM busybox AS test\nRUN echo cached > /cached\n")
+
+            def build():
+                return subprocess.run(
+                    ["docker", "buildx", "build", "--builder", builder, "--target", "test", "--progress", "plain",
+                     *" ".join(get_cache_options(build_cache, image_build)).split(), context],
+                    capture_output=True, text=True, check=True,
+                ).stderr
+
+            for _ in range(2):
+                subprocess.run(["docker", "buildx", "create", "--name", builder, "--driver", "docker-container",
+                                "--driver-opt", "network=host"], check=True, capture_output=True)
+                try:
+                    output = build()
+                finally:
+                    subprocess.run(["docker", "buildx", "rm", builder], capture_output=True)
+        assert "importing cache manifest" in output
+        assert "CACHED" in output
+    finally:
+        subprocess.run(["docker", "rm", "-f", registry], capture_output=True)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
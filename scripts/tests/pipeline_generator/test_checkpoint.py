@@ -0,0 +1,103 @@
+import os
+import pytest
+import sys
+import tempfile
+
+from scripts.pipeline_generator.checkpoint import PREEMPTED_EXIT_STATUS, main, read_completed_tests
+
+# Each test logs its runs, test_c is slow on its first run only, test_d fails
+TEST_FILE = """
+import os
+import time
+
+LOG = os.path.join(os.path.dirname(__file__), "runs.log")
+
+
+def _log(name):
+    with open(LOG, "a") as f:
+        f.write(name + "\\n")
+
+
+def test_a():
+    _log("a")
+
+
+def test_b():
+    _log("b")
+
+
+def test_c():
+    _log("c")
+    marker = os.path.join(os.path.dirname(__file__), "slow")
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        time.sleep(30)
+
+
+def test_d():
+    _log("d")
+    assert os.environ.get("TEST_D_PASSES")
+"""
+
+
+def _run(temp_dir, *options):
+    pytest_command = [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", "--rootdir", temp_dir, temp_dir]
+    return main(["--checkpoint_dir", os.path.join(temp_dir, "checkpoints"), "--name", "step", *options, "--", *pytest_command])
+
+
+def _read_runs(temp_dir):
+    with open(os.path.join(temp_dir, "runs.log"), "r") as f:
+        return f.read().split()
+
+
+def test_read_completed_tests():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        checkpoint_file = os.path.join(temp_dir, "checkpoint")
+        assert read_completed_tests(checkpoint_file, "0") == set()
+        with open(checkpoint_file, "w") as f:
+            f.write("0\ttest_a.py::test_a\n1\ttest_a.py::test_a[1]\n10\ttest_a.py::test_b\n0\ttest_a.py::test_c")
+        assert read_completed_tests(checkpoint_file, "0") == {"test_a.py::test_a"}
+        assert read_completed_tests(checkpoint_file, "1") == {"test_a.py::test_a[1]"}
+
+
+def test_resume_after_preemption(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with open(os.path.join(temp_dir, "test_demo.py"), "w") as f:
+            f.write(TEST_FILE)
+        checkpoint_file = os.path.join(temp_dir, "checkpoints", "step")
+
+        # Preempted while test_c runs
+        assert _run(temp_dir, "--preempt_after", "2") == PREEMPTED_EXIT_STATUS
+        assert _read_runs(temp_dir) == ["a", "b", "c"]
+        assert read_completed_tests(checkpoint_file, "0") == {"test_demo.py::test_a", "test_demo.py::test_b"}
+
+        # Retry resumes from test_c, the failed test_d is not recorded
+        assert _run(temp_dir) == 1
+        assert _read_runs(temp_dir) == ["a", "b", "c", "c", "d"]
+        assert "test_demo.py::test_d" not in read_completed_tests(checkpoint_file, "0")
+
+        # Another retry only runs the failed test, and passes once it does
+        monkeypatch.setenv("TEST_D_PASSES", "1")
+        assert _run(temp_dir) == 0
+        assert _read_runs(temp_dir) == ["a", "b", "c", "c", "d", "d"]
+
+        # Nothing left to run
+        assert _run(temp_dir) == 0
+        assert _read_runs(temp_dir) == ["a", "b", "c", "c", "d", "d"]
+
+
+def test_invocations_are_checkpointed_separately():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with open(os.path.join(temp_dir, "test_demo.py"), "w") as f:
+            f.write(TEST_FILE)
+        open(os.path.join(temp_dir, "slow"), "w").close()
+        pytest_command = f"{sys.executable} -m pytest -q -p no:cacheprovider --rootdir {temp_dir} {temp_dir}"
+        command = ["bash", "-c", f"{pytest_command} -k a; {pytest_command} -k 'a or b'"]
+        arguments = ["--checkpoint_dir", os.path.join(temp_dir, "checkpoints"), "--name", "step", "--"]
+        assert main([*arguments, *command]) == 0
+        assert main([*arguments, *command]) == 0
+        assert _read_runs(temp_dir) == ["a", "a", "b"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
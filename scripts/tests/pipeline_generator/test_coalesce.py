@@ -0,0 +1,108 @@
+import pytest
+import subprocess
+import sys
+
+from scripts.pipeline_generator.coalesce import coalesce_steps, get_coalesced_commands
+from scripts.pipeline_generator.sharding import TimingDatabase
+from scripts.pipeline_generator.step import BuildkiteStep, BuildkiteBlockStep
+from scripts.pipeline_generator.utils import AgentQueue
+
+GPU_PLUGINS = [{"docker#v5.2.0": {"image": "image:latest", "gpus": "all"}}]
+CPU_PLUGINS = [{"docker#v5.2.0": {"image": "image:latest"}}]
+
+
+def _get_step(key, plugins=GPU_PLUGINS, queue=AgentQueue.AWS_1xL4.value, **kwargs):
+    return BuildkiteStep(label=key.title(), key=key, commands=[f"echo {key}"], plugins=plugins, agents={"queue": queue}, **kwargs)
+
+
+def _run_commands(commands, shell=("bash", "-c")):
+    # Buildkite turns $$ into $ when the pipeline is uploaded
+    script = "\n".join(commands).replace("$$", "$")
+    return subprocess.run([*shell, script], capture_output=True, text=True)
+
+
+def test_get_coalesced_commands():
+    steps = [
+        BuildkiteStep(label="First", commands=["echo first", "true"]),
+        BuildkiteStep(label="Second", commands=["echo second", "false"]),
+        BuildkiteStep(label="Third", commands=["echo third"]),
+    ]
+    result = _run_commands(get_coalesced_commands(steps))
+    assert result.returncode == 1
+    assert result.stdout.split("\n") == [
+        "--- First", "first",
+        "--- Second", "second", "^^^ +++",
+        "--- Third", "third",
+        "Failed: Second", "",
+    ]
+
+
+@pytest.mark.parametrize("shell", [("bash", "-c"), ("bash", "-e", "-c")])
+def test_get_coalesced_commands_shell_syntax(shell):
+    steps = [
+        BuildkiteStep(label="Syntax", commands=[
+            "echo one;",
+            "# a comment",
+            "echo two # and another",
+            "cat <<EOF\nthree\nEOF",
+            "for i in 4 5; do\n  echo $$i\ndone",
+        ]),
+        # Stops at the first failing command
+        BuildkiteStep(label="Failing", commands=["echo six", "false", "echo seven"]),
+        BuildkiteStep(label="Last", commands=["echo eight"]),
+    ]
+    result = _run_commands(get_coalesced_commands(steps), shell)
+    assert result.returncode == 1
+    assert result.stdout.split("\n") == [
+        "--- Syntax", "one", "two", "three", "4", "5",
+        "--- Failing", "six", "^^^ +++",
+        "--- Last", "eight",
+        "Failed: Failing", "",
+    ]
+
+
+def test_get_coalesced_commands_all_passed():
+    steps = [BuildkiteStep(label="First", commands=["true"]), BuildkiteStep(label="Second", commands=["true"])]
+    assert _run_commands(get_coalesced_commands(steps)).returncode == 0
+
+
+def test_coalesce_steps():
+    steps = [
+        _get_step("a"),
+        _get_step("b"),
+        _get_step("long"),
+        _get_step("cpu", plugins=CPU_PLUGINS, queue=AgentQueue.AWS_SMALL_CPU.value),
+        BuildkiteBlockStep(block="Run Blocked", key="block-blocked"),
+        _get_step("blocked", depends_on="block-blocked"),
+        _get_step("c"),
+        _get_step("d"),
+        _get_step("unknown"),
+        _get_step("cpu-2", plugins=CPU_PLUGINS, queue=AgentQueue.AWS_SMALL_CPU.value),
+    ]
+    timing_database = TimingDatabase(steps={
+        "a": 200, "b": 250, "c": 100, "d": 60, "long": 1000, "cpu": 30, "cpu-2": 40, "blocked": 10,
+    })
+    coalesced_keys = {}
+    coalesced_steps = coalesce_steps(steps, timing_database, budget=500, coalesced_keys=coalesced_keys)
+    assert [step.key for step in coalesced_steps] == [
+        "coalesced-a", "long", "coalesced-cpu", "block-blocked", "blocked", "coalesced-c", "unknown",
+    ]
+    assert coalesced_steps[0].label == "Coalesced: A, B"
+    assert coalesced_steps[5].label == "Coalesced: C, D"
+    assert coalesced_steps[2].label == "Coalesced: Cpu, Cpu-2"
+    assert coalesced_steps[2].plugins == CPU_PLUGINS
+    assert coalesced_steps[2].agents == {"queue": AgentQueue.AWS_SMALL_CPU.value}
+    assert coalesced_keys == {
+        "a": "coalesced-a", "b": "coalesced-a", "c": "coalesced-c", "d": "coalesced-c",
+        "cpu": "coalesced-cpu", "cpu-2": "coalesced-cpu",
+    }
+
+
+def test_coalesce_steps_nothing_to_merge():
+    steps = [_get_step("a"), _get_step("b", soft_fail=True)]
+    timing_database = TimingDatabase(steps={"a": 10, "b": 10})
+    assert coalesce_steps(steps, timing_database) == steps
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,61 @@
+import pytest
+import sys
+
+from scripts.pipeline_generator.dag import get_critical_path, get_step_graph, validate_dag
+from scripts.pipeline_generator.step import BuildkiteBlockStep, BuildkiteStep, BuildkiteWaitStep
+
+
+def _get_step(key, depends_on=None):
+    return BuildkiteStep(label=key, key=key, commands=["true"], depends_on=depends_on)
+
+
+def _get_steps():
+    return [
+        _get_step("build-base"),
+        _get_step("build"),
+        _get_step("lint", depends_on="build-base"),
+        _get_step("kernels", depends_on="build"),
+        BuildkiteBlockStep(block="Run LoRA", key="block-lora", depends_on="build"),
+        _get_step("lora", depends_on="block-lora"),
+        _get_step("docs", depends_on=["build-base", "lint"]),
+    ]
+
+
+def test_get_step_graph():
+    steps = [*_get_steps(), BuildkiteWaitStep(), _get_step("record")]
+    graph = get_step_graph(steps)
+    assert graph["docs"] == ["build-base", "lint"]
+    assert graph["wait-7"] == ["build-base", "build", "lint", "kernels", "block-lora", "lora", "docs"]
+    assert graph["record"] == ["wait-7"]
+
+
+def test_validate_dag():
+    order = validate_dag(_get_steps())
+    assert order.index("build-base") < order.index("lint") < order.index("docs")
+    assert order.index("build") < order.index("block-lora") < order.index("lora")
+
+
+@pytest.mark.parametrize(
+    ("steps", "expected_error"),
+    [
+        ([_get_step("a", depends_on="b"), _get_step("b", depends_on="a")], "cycle"),
+        ([_get_step("a", depends_on="missing")], "unknown steps"),
+        ([_get_step("a"), _get_step("a")], "Duplicate"),
+    ],
+)
+def test_validate_dag_invalid(steps, expected_error):
+    with pytest.raises(ValueError, match=expected_error):
+        validate_dag(steps)
+
+
+def test_get_critical_path():
+    durations = {"build-base": 300, "build": 1800, "lint": 600, "kernels": 1200, "lora": 900, "docs": 600}
+    assert get_critical_path(_get_steps(), durations) == (["build", "kernels"], 3000)
+    # Lint only waits for the base image, so a slower lint moves the critical path
+    durations["lint"] = 2700
+    assert get_critical_path(_get_steps(), durations) == (["build-base", "lint", "docs"], 3600)
+    assert get_critical_path([], {}) == ([], 0.0)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,62 @@
+import pytest
+import sys
+
+from scripts.pipeline_generator.dependency_index import DependencyIndex
+from scripts.pipeline_generator.step import TestStep
+
+
+def _get_test_steps():
+    return [
+        TestStep(label="Test 1", command="echo 1", source_file_dependencies=["vllm/", "tests/basic_correctness"]),
+        TestStep(label="Test 2", command="echo 2", source_file_dependencies=["vllm/lora", "tests/lora"]),
+        TestStep(label="Test 3", command="echo 3", source_file_dependencies=["csrc/"]),
+        TestStep(label="Test 4", command="echo 4"),
+    ]
+
+
+def _naive_match(test_steps, list_file_diff):
+    return {
+        step.label for step in test_steps
+        if any(source_file in file for source_file in step.source_file_dependencies or [] for file in list_file_diff)
+    }
+
+
+@pytest.mark.parametrize(
+    ("list_file_diff", "expected_result"),
+    [
+        ([], set()),
+        (["README.md"], set()),
+        (["vllm/engine/llm_engine.py"], {"Test 1"}),
+        (["vllm/lora/layers.py"], {"Test 1", "Test 2"}),
+        (["tests/lora/test_layers.py"], {"Test 2"}),
+        # Dependencies match anywhere in the path, not only as a prefix
+        (["tools/csrc/build.sh"], {"Test 3"}),
+        (["csrc", "docs/vllm"], set()),
+        (["csrc/ops.h", "tests/basic_correctness/test_basic.py"], {"Test 1", "Test 3"}),
+    ],
+)
+def test_dependency_index_match(list_file_diff, expected_result):
+    test_steps = _get_test_steps()
+    index = DependencyIndex(test_steps)
+    assert index.match(list_file_diff) == expected_result
+    assert index.match(list_file_diff) == _naive_match(test_steps, list_file_diff)
+
+
+def test_dependency_index_overlapping_dependencies():
+    test_steps = [
+        TestStep(label="Outer", command="echo", source_file_dependencies=["abcd"]),
+        TestStep(label="Inner", command="echo", source_file_dependencies=["bc"]),
+        TestStep(label="Suffix", command="echo", source_file_dependencies=["cde"]),
+    ]
+    index = DependencyIndex(test_steps)
+    assert index.match(["xabcdex"]) == {"Outer", "Inner", "Suffix"}
+    assert index.match(["abce"]) == {"Inner"}
+
+
+def test_dependency_index_indexed_labels():
+    index = DependencyIndex(_get_test_steps())
+    assert index.indexed_labels == {"Test 1", "Test 2", "Test 3"}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
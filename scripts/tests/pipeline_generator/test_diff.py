@@ -0,0 +1,101 @@
+import os
+import pytest
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from scripts.pipeline_generator import diff
+from scripts.pipeline_generator.diff import FileDiff, get_file_diff, get_merge_base, parse_name_status
+
+
+def _git(repo_root, *args):
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=repo_root,
+        check=True,
+        capture_output=True,
+    ).stdout.decode().strip()
+
+
+def _write_and_commit(repo_root, files, removed=()):
+    for path, content in files.items():
+        os.makedirs(os.path.join(repo_root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(repo_root, path), "w") as f:
+            f.write(content)
+    for path in removed:
+        os.remove(os.path.join(repo_root, path))
+    _git(repo_root, "add", "-A")
+    _git(repo_root, "commit", "-q", "--allow-empty", "-m", "commit")
+
+
+@pytest.fixture
+def repo_root():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _git(temp_dir, "init", "-q", "-b", "main")
+        _write_and_commit(temp_dir, {
+            "vllm/lora/layers.py": "".join(f"line {i}\n" for i in range(20)),
+            "vllm/config.py": "config",
+            "docs/old.md": "old",
+        })
+        _git(temp_dir, "checkout", "-q", "-b", "feature")
+        yield temp_dir
+
+
+def test_parse_name_status():
+    output = b"M\0vllm/config.py\0R095\0vllm/lora/layers.py\0vllm/lora/my layers.py\0C100\0a.py\0b.py\0D\0docs/old.md\0"
+    assert parse_name_status(output) == FileDiff(
+        files=["vllm/config.py", "vllm/lora/layers.py", "vllm/lora/my layers.py", "b.py", "docs/old.md"],
+        renames=[("vllm/lora/layers.py", "vllm/lora/my layers.py")],
+    )
+    assert parse_name_status(b"") == FileDiff()
+
+
+def test_get_file_diff(repo_root):
+    _git(repo_root, "mv", "vllm/lora/layers.py", "vllm/lora/my layers.py")
+    _write_and_commit(repo_root, {"vllm/config.py": "new config", "tests/test a|b.py": "test"}, removed=["docs/old.md"])
+    # Main moves on after the branch forked, its changes are not part of the diff
+    _git(repo_root, "checkout", "-q", "main")
+    _write_and_commit(repo_root, {"setup.py": "setup()"})
+    _git(repo_root, "checkout", "-q", "feature")
+
+    file_diff = get_file_diff(repo_root, "feature", main_ref="main")
+    assert sorted(file_diff.files) == ["docs/old.md", "tests/test a|b.py", "vllm/config.py", "vllm/lora/layers.py", "vllm/lora/my layers.py"]
+    assert file_diff.renames == [("vllm/lora/layers.py", "vllm/lora/my layers.py")]
+
+
+def test_get_file_diff_main(repo_root):
+    _git(repo_root, "checkout", "-q", "main")
+    _write_and_commit(repo_root, {"setup.py": "setup()"})
+    _write_and_commit(repo_root, {"vllm/config.py": "new config"})
+    # On main, only the last commit
+    assert get_file_diff(repo_root, "main", main_ref="main").files == ["vllm/config.py"]
+
+
+def test_get_merge_base(repo_root):
+    fork_point = _git(repo_root, "rev-parse", "HEAD")
+    _write_and_commit(repo_root, {"vllm/config.py": "new config"})
+    assert get_merge_base(repo_root, "main") == fork_point
+    # Follows HEAD once main is merged into the branch
+    _git(repo_root, "checkout", "-q", "main")
+    _write_and_commit(repo_root, {"setup.py": "setup()"})
+    main_commit = _git(repo_root, "rev-parse", "HEAD")
+    _git(repo_root, "checkout", "-q", "feature")
+    _git(repo_root, "-c", "user.name=test", "merge", "-q", "--no-edit", "main")
+    assert get_merge_base(repo_root, "main") == main_commit
+
+
+def test_get_merge_base_cached(repo_root):
+    fork_point = _git(repo_root, "rev-parse", "HEAD")
+    _write_and_commit(repo_root, {"vllm/config.py": "new config"})
+    with mock.patch.object(diff, "_git", wraps=diff._git) as mock_git:
+        assert get_merge_base(repo_root, "main") == fork_point
+        assert get_merge_base(repo_root, "main") == fork_point
+        # Recomputed once HEAD moves
+        _write_and_commit(repo_root, {"setup.py": "setup()"})
+        assert get_merge_base(repo_root, "main") == fork_point
+    assert [call.args[1] for call in mock_git.call_args_list] == ["rev-parse", "merge-base", "rev-parse", "rev-parse", "merge-base"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
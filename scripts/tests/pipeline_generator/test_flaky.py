@@ -0,0 +1,188 @@
+import json
+import os
+import pytest
+import sys
+import tempfile
+from click.testing import CliRunner
+
+from scripts.pipeline_generator.flaky import (
+    FlakeHistory,
+    FlakePolicy,
+    StepRun,
+    apply_flake_policy,
+    get_flake_policy,
+    get_node_id,
+    get_step_runs,
+    main,
+    read_junit_outcomes,
+    update_flake_history,
+)
+from scripts.pipeline_generator.step import BuildkiteStep
+
+JUNIT_XML = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite name="pytest">
+<testcase classname="tests.lora.test_layers" name="test_passed" />
+<testcase classname="tests.lora.test_layers.TestLoRA" name="test_failed[a b]"><failure message="boom" /></testcase>
+<testcase classname="tests.lora.test_layers" name="test_rerun"><rerunFailure message="boom" /></testcase>
+<testcase classname="tests.lora.test_layers" name="test_skipped"><skipped /></testcase>
+</testsuite></testsuites>
+"""
+RETRIED_JUNIT_XML = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite name="pytest">
+<testcase classname="tests.lora.test_layers.TestLoRA" name="test_failed[a b]" />
+</testsuite></testsuites>
+"""
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+@pytest.mark.parametrize(
+    ("classname", "name", "expected_result"),
+    [
+        ("tests.lora.test_layers", "test_a", "tests/lora/test_layers.py::test_a"),
+        ("lora.test_layers.TestLoRA", "test_a[1.5]", "lora/test_layers.py::TestLoRA::test_a[1.5]"),
+        ("kernels.moe_test.TestMoE.TestInner", "test_a", "kernels/moe_test.py::TestMoE::TestInner::test_a"),
+        ("", "test_a", "test_a"),
+    ],
+)
+def test_get_node_id(classname, name, expected_result):
+    assert get_node_id(classname, name) == expected_result
+
+
+def test_read_junit_outcomes():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "junit.xml")
+        _write(file_path, JUNIT_XML)
+        assert read_junit_outcomes(file_path) == {
+            "tests/lora/test_layers.py::test_passed": "passed",
+            "tests/lora/test_layers.py::TestLoRA::test_failed[a b]": "failed",
+            "tests/lora/test_layers.py::test_rerun": "flaky",
+        }
+
+
+def test_get_step_runs():
+    builds = [
+        {"number": 2, "jobs": [
+            {"step_key": "lora", "state": "failed"},
+            {"step_key": "lora", "state": "passed"},
+            {"step_key": "core", "state": "passed"},
+            {"step_key": "block", "state": "blocked"},
+            {"type": "waiter"},
+        ]},
+        {"number": 1, "jobs": [{"step_key": "lora", "state": "passed"}]},
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _write(os.path.join(temp_dir, "2", "lora", "attempt-1.xml"), JUNIT_XML)
+        _write(os.path.join(temp_dir, "2", "lora", "attempt-2.xml"), RETRIED_JUNIT_XML)
+        step_runs = get_step_runs(builds, temp_dir)
+    assert step_runs["core"] == [StepRun(build=2, passed=True)]
+    assert step_runs["lora"] == [
+        StepRun(build=1, passed=True),
+        StepRun(
+            build=2,
+            passed=True,
+            failed=True,
+            failed_tests=["tests/lora/test_layers.py::TestLoRA::test_failed[a b]"],
+            flaky_tests=["tests/lora/test_layers.py::TestLoRA::test_failed[a b]", "tests/lora/test_layers.py::test_rerun"],
+        ),
+    ]
+    assert step_runs["lora"][1].flaky
+
+
+def test_update_flake_history():
+    flake_history = FlakeHistory(steps={"lora": [StepRun(build=index, passed=True) for index in range(49)]})
+    update_flake_history(flake_history, {"lora": [StepRun(build=48, failed=True), StepRun(build=49, passed=True)]})
+    runs = flake_history.steps["lora"]
+    assert [run.build for run in runs] == list(range(50))
+    assert runs[48].failed
+    update_flake_history(flake_history, {"lora": [StepRun(build=50, passed=True)]})
+    assert [run.build for run in flake_history.steps["lora"]] == list(range(1, 51))
+
+
+def _get_runs(num_runs, flaky_runs):
+    runs = [StepRun(build=index, passed=True) for index in range(num_runs)]
+    for index, failed_tests in flaky_runs.items():
+        runs[index] = StepRun(build=index, passed=True, failed=True, failed_tests=failed_tests, flaky_tests=failed_tests)
+    return runs
+
+
+@pytest.mark.parametrize(
+    ("runs", "expected_result"),
+    [
+        ([], FlakePolicy()),
+        (_get_runs(20, {}), FlakePolicy()),
+        # Flaky test seen twice: quarantined, runs it explains need no retry
+        (_get_runs(20, {3: ["t1"], 7: ["t1"]}), FlakePolicy(quarantined_tests=["t1"])),
+        # Flaky test seen once is not quarantined yet
+        (_get_runs(20, {3: ["t1"]}), FlakePolicy(retry_limit=1)),
+        # Flaky without test results: retry, more often, then soft fail
+        (_get_runs(20, {3: [], 7: []}), FlakePolicy(retry_limit=1)),
+        (_get_runs(10, {3: [], 7: []}), FlakePolicy(retry_limit=2)),
+        (_get_runs(10, {1: [], 3: [], 7: []}), FlakePolicy(retry_limit=2, soft_fail=True)),
+        # Quarantined test and another failure in the same run
+        (_get_runs(20, {3: ["t1"], 7: ["t1", "t2"]}), FlakePolicy(quarantined_tests=["t1"], retry_limit=1)),
+    ],
+)
+def test_get_flake_policy(runs, expected_result):
+    assert get_flake_policy(runs) == expected_result
+
+
+def test_apply_flake_policy():
+    buildkite_step = BuildkiteStep(
+        label="LoRA",
+        commands=["pip install x", "pytest -v -s lora", "pytest -v -s lora/test_a.py && echo done"],
+    )
+    policy = FlakePolicy(quarantined_tests=["tests/lora/test_a.py::test[a b]", "tests/lora/test_b.py::test"], retry_limit=1, soft_fail=True)
+    apply_flake_policy(buildkite_step, policy)
+    assert buildkite_step.commands == [
+        "pip install x",
+        "pytest -v -s lora --deselect 'tests/lora/test_a.py::test[a b]' --deselect tests/lora/test_b.py::test",
+        "pytest -v -s lora/test_a.py && echo done",
+    ]
+    assert buildkite_step.retry == {
+        "automatic": [{"exit_status": -1, "limit": 2}, {"exit_status": -10, "limit": 2}, {"exit_status": "*", "limit": 1}],
+    }
+    assert buildkite_step.soft_fail
+
+
+def test_apply_flake_policy_no_flakes():
+    buildkite_step = BuildkiteStep(label="LoRA", commands=["pytest -v -s lora"])
+    apply_flake_policy(buildkite_step, FlakePolicy())
+    assert buildkite_step == BuildkiteStep(label="LoRA", commands=["pytest -v -s lora"])
+
+
+def test_flaky_cli():
+    builds = [
+        {"number": number, "jobs": [{"step_key": "lora", "state": "failed"}, {"step_key": "lora", "state": "passed"}]}
+        for number in (1, 2)
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        builds_path = os.path.join(temp_dir, "builds.json")
+        _write(builds_path, json.dumps(builds))
+        for number in (1, 2):
+            _write(os.path.join(temp_dir, "junit", str(number), "lora", "junit.xml"), JUNIT_XML)
+            _write(os.path.join(temp_dir, "junit", str(number), "lora", "junit-retry.xml"), RETRIED_JUNIT_XML)
+        history_path = os.path.join(temp_dir, "flake_history.json")
+        deselect_path = os.path.join(temp_dir, "deselect.json")
+        result = CliRunner().invoke(main, [
+            "--flake_history", history_path,
+            "--builds", builds_path,
+            "--junit_dir", os.path.join(temp_dir, "junit"),
+            "--deselect_list", deselect_path,
+        ])
+        assert result.exit_code == 0
+        with open(deselect_path, "r") as f:
+            assert json.load(f) == {
+                "lora": ["tests/lora/test_layers.py::TestLoRA::test_failed[a b]", "tests/lora/test_layers.py::test_rerun"],
+            }
+        assert "lora: retry 0, soft_fail False" in result.output
+        with open(history_path, "r") as f:
+            assert len(FlakeHistory.model_validate_json(f.read()).steps["lora"]) == 2
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,71 @@
+import os
+import pytest
+import subprocess
+import sys
+import tempfile
+
+from scripts.pipeline_generator.image import get_content_addressed_image, get_image_content_hash
+
+
+def _git(repo_root, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=repo_root,
+        check=True,
+        capture_output=True,
+    )
+
+
+def _write_and_commit(repo_root, files):
+    for path, content in files.items():
+        os.makedirs(os.path.join(repo_root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(repo_root, path), "w") as f:
+            f.write(content)
+    _git(repo_root, "add", ".")
+    _git(repo_root, "commit", "-q", "--allow-empty", "-m", "commit")
+
+
+@pytest.fixture
+def repo_root():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _git(temp_dir, "init", "-q")
+        _write_and_commit(temp_dir, {"csrc/ops.h": "ops", "vllm/__init__.py": "", "setup.py": "setup()"})
+        yield temp_dir
+
+
+def test_get_image_content_hash_same_content(repo_root):
+    content_hash = get_image_content_hash(repo_root)
+    # A new commit with the same sources keeps the hash
+    _write_and_commit(repo_root, {})
+    assert get_image_content_hash(repo_root) == content_hash
+    assert len(content_hash) == 64
+
+
+def test_get_image_content_hash_ignored_files(repo_root):
+    content_hash = get_image_content_hash(repo_root)
+    _write_and_commit(repo_root, {".github/workflows/lint.yml": "lint"})
+    assert get_image_content_hash(repo_root) == content_hash
+
+
+@pytest.mark.parametrize(
+    "files",
+    [
+        {"vllm/__init__.py": "changed"},
+        {"csrc/new.cu": "kernel"},
+        {"docs/index.md": "docs"},
+    ],
+)
+def test_get_image_content_hash_changed(repo_root, files):
+    content_hash = get_image_content_hash(repo_root)
+    _write_and_commit(repo_root, files)
+    assert get_image_content_hash(repo_root) != content_hash
+    # Hash is computed at a revision, not from the working tree
+    assert get_image_content_hash(repo_root, revision="HEAD~1") == content_hash
+
+
+def test_get_content_addressed_image():
+    assert get_content_addressed_image("registry", "repo", "abc") == "registry/repo:content-abc"
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,247 @@
+import os
+import pytest
+import subprocess
+import sys
+import tempfile
+
+from scripts.pipeline_generator.impact import (
+    CachedImports,
+    ImportCache,
+    ImportGraph,
+    get_import_graph,
+    get_imports,
+    get_impacted_step_labels,
+    get_selected_test_step,
+    get_test_targets,
+    read_import_cache,
+    update_import_cache,
+)
+from scripts.pipeline_generator.step import TestStep
+
+REPO_FILES = {
+    "vllm/__init__.py": "",
+    "vllm/core/__init__.py": "",
+    "vllm/core/block.py": "import os\n",
+    "vllm/core/scheduler.py": "from .block import Block\n",
+    "vllm/lora/__init__.py": "",
+    "vllm/lora/layers.py": "from vllm.core import scheduler\n",
+    # Models are loaded by name by the model registry, even when another model imports them
+    "vllm/model_executor/models/llama.py": "import torch\n",
+    "vllm/model_executor/models/mistral.py": "from vllm.model_executor.models import llama\n",
+    "vllm/config.json": "{}",
+    "tests/conftest.py": "",
+    "tests/core/test_scheduler.py": "from vllm.core.scheduler import Scheduler\n",
+    "tests/lora/test_layers.py": "def test():\n    from vllm.lora.layers import Layer\n",
+    "tests/basic/test_basic.py": "import vllm\n",
+}
+
+
+def _git(repo_root, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=repo_root,
+        check=True,
+        capture_output=True,
+    )
+
+
+def _write_and_commit(repo_root, files):
+    for path, content in files.items():
+        os.makedirs(os.path.join(repo_root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(repo_root, path), "w") as f:
+            f.write(content)
+    _git(repo_root, "add", ".")
+    _git(repo_root, "commit", "-q", "--allow-empty", "-m", "commit")
+
+
+@pytest.fixture
+def repo_root():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _git(temp_dir, "init", "-q")
+        _write_and_commit(temp_dir, REPO_FILES)
+        yield temp_dir
+
+
+def _get_test_steps():
+    return [
+        TestStep(label="Core", source_file_dependencies=["vllm/"], commands=["pytest -v -s core"]),
+        TestStep(label="LoRA", source_file_dependencies=["vllm/lora"], commands=["pytest -v -s lora/test_layers.py::test"]),
+        TestStep(label="Basic", source_file_dependencies=["vllm/"], commands=["cd basic && pytest -v -s test_basic.py"]),
+        TestStep(label="Script", source_file_dependencies=["vllm/core"], commands=["bash run-benchmarks.sh"]),
+        TestStep(label="Models", source_file_dependencies=["vllm/model_executor/models"], commands=["pytest -v -s models"]),
+    ]
+
+
+@pytest.mark.parametrize(
+    ("source", "path", "expected_result"),
+    [
+        ("import a.b, c", "x.py", ["a.b", "c"]),
+        ("from a import b", "x.py", ["a", "a.b"]),
+        ("from .b import c", "pkg/sub/x.py", ["pkg.sub.b", "pkg.sub.b.c"]),
+        ("from .. import c", "pkg/sub/x.py", ["pkg", "pkg.c"]),
+        ("from . import c", "pkg/__init__.py", ["pkg", "pkg.c"]),
+        ("from a import *", "x.py", ["a"]),
+        ("def f(:", "x.py", []),
+    ],
+)
+def test_get_imports(source, path, expected_result):
+    assert get_imports(source.encode(), path) == expected_result
+
+
+def test_import_graph_get_dependents(repo_root):
+    graph = get_import_graph(repo_root)
+    assert graph.get_dependents(["vllm/core/block.py"]) == {
+        "vllm/core/block.py",
+        "vllm/core/scheduler.py",
+        "vllm/lora/layers.py",
+        "tests/core/test_scheduler.py",
+        "tests/lora/test_layers.py",
+    }
+    # Every import of a vllm module runs vllm/__init__.py
+    assert "tests/basic/test_basic.py" in graph.get_dependents(["vllm/__init__.py"])
+    assert graph.get_dependents(["vllm/config.json"]) == set()
+
+
+def test_get_test_targets(repo_root):
+    files = get_import_graph(repo_root).files
+    core, lora, basic, script, _ = _get_test_steps()
+    assert get_test_targets(core, files) == {"tests/core/test_scheduler.py", "tests/conftest.py"}
+    assert get_test_targets(lora, files) == {"tests/lora/test_layers.py", "tests/conftest.py"}
+    assert get_test_targets(basic, files) == {"tests/basic/test_basic.py", "tests/conftest.py"}
+    assert get_test_targets(script, files) is None
+
+
+@pytest.mark.parametrize(
+    ("list_file_diff", "expected_result"),
+    [
+        # Core and Basic depend on vllm/ but none of their tests imports the change
+        (["vllm/lora/layers.py"], {"LoRA"}),
+        (["vllm/__init__.py"], {"Core", "LoRA", "Basic"}),
+        (["tests/conftest.py"], {"Core", "LoRA", "Basic"}),
+        (["tests/basic/test_basic.py"], {"Basic"}),
+        # Script has no test targets and keeps using its source_file_dependencies
+        (["vllm/core/block.py"], {"Core", "LoRA", "Script"}),
+        (["vllm/core/__init__.py"], {"Core", "LoRA", "Script"}),
+        # Not Python: source_file_dependencies
+        (["vllm/config.json"], {"Core", "Basic"}),
+        # Loaded by name at runtime, imported by another model or not: source_file_dependencies
+        (["vllm/model_executor/models/llama.py"], {"Core", "Basic", "Models"}),
+        (["vllm/model_executor/models/mistral.py"], {"Core", "Basic", "Models"}),
+        (["docs/index.md"], set()),
+    ],
+)
+def test_get_impacted_step_labels(repo_root, list_file_diff, expected_result):
+    graph = get_import_graph(repo_root)
+    assert get_impacted_step_labels(_get_test_steps(), list_file_diff, graph) == expected_result
+
+
+def test_import_cache_incremental_update(repo_root):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_path = os.path.join(temp_dir, "import_graph.json")
+        get_import_graph(repo_root, cache_path=cache_path)
+        cache = read_import_cache(cache_path)
+    assert len(cache.files) == len([path for path in REPO_FILES if path.endswith(".py")])
+
+    _write_and_commit(repo_root, {"vllm/models/llama.py": "from vllm.core import block\n"})
+    _git(repo_root, "rm", "-q", "tests/basic/test_basic.py")
+    _git(repo_root, "commit", "-q", "-m", "remove")
+    assert update_import_cache(cache, repo_root) == 1
+    assert cache.files["vllm/models/llama.py"].imports == ["vllm.core", "vllm.core.block"]
+    assert "tests/basic/test_basic.py" not in cache.files
+    assert "vllm/models/llama.py" in ImportGraph(cache).get_dependents(["vllm/core/block.py"])
+    assert update_import_cache(cache, repo_root) == 0
+
+
+def test_read_import_cache_missing_or_outdated():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_path = os.path.join(temp_dir, "import_graph.json")
+        assert read_import_cache(cache_path) == ImportCache()
+        with open(cache_path, "w") as f:
+            f.write('{"version": 0, "files": {"a.py": {"blob": "abc", "imports": []}}}')
+        assert read_import_cache(cache_path) == ImportCache()
+
+
+def _get_lora_import_graph():
+    imports = {
+        "vllm/lora/layers.py": [],
+        "vllm/lora/utils.py": [],
+        "vllm/lora/registry.py": [],
+        "vllm/lora/models.py": ["vllm.lora.registry"],
+        "tests/conftest.py": [],
+        "tests/lora/conftest.py": ["vllm.lora.layers"],
+        "tests/lora/helpers.py": ["vllm.lora.utils"],
+        "tests/lora/test_layers.py": ["vllm.lora.layers"],
+        "tests/lora/test_utils.py": ["tests.lora.helpers"],
+        "tests/lora/test_punica.py": [],
+    }
+    return ImportGraph(ImportCache(files={
+        path: CachedImports(blob=str(index), imports=file_imports)
+        for index, (path, file_imports) in enumerate(imports.items())
+    }))
+
+
+@pytest.mark.parametrize(
+    ("commands", "expected_commands"),
+    [
+        (["pytest -v -s lora"], ["pytest -v -s lora/test_utils.py"]),
+        (["pytest -v -s lora/test_utils.py::test_a lora/test_punica.py"], ["pytest -v -s lora/test_utils.py::test_a"]),
+        (["pytest -k lora -v lora"], ["pytest -k lora -v lora/test_utils.py"]),
+        (["pip install x", "pytest -v -s lora/test_punica.py", "pytest -v -s lora/test_utils.py"], ["pip install x", "pytest -v -s lora/test_utils.py"]),
+        # Quoted arguments are kept as written
+        (['pytest -v -s -k "not slow and gpu" lora'], ['pytest -v -s -k "not slow and gpu" lora/test_utils.py']),
+        (["pytest -v -s 'lora/test_utils.py::test_a[a b]' lora/test_punica.py"], ["pytest -v -s 'lora/test_utils.py::test_a[a b]'"]),
+    ],
+)
+def test_get_selected_test_step(commands, expected_commands):
+    step = TestStep(label="LoRA", source_file_dependencies=["vllm/lora"], commands=commands)
+    selected_step = get_selected_test_step(step, ["vllm/lora/utils.py"], _get_lora_import_graph())
+    assert selected_step.commands == expected_commands
+    assert step.commands == commands
+
+
+def test_get_selected_test_step_runtime_loaded():
+    step = TestStep(label="LoRA", source_file_dependencies=["vllm/lora"], commands=["pytest -v -s lora"])
+    list_file_diff = ["vllm/lora/utils.py", "vllm/lora/registry.py"]
+    # No test imports vllm/lora/registry.py, only vllm/lora/utils.py matters
+    selected_step = get_selected_test_step(step, list_file_diff, _get_lora_import_graph())
+    assert selected_step.commands == ["pytest -v -s lora/test_utils.py"]
+    # Unless it is loaded by name at runtime
+    assert get_selected_test_step(step, list_file_diff, _get_lora_import_graph(), runtime_loaded_paths=["vllm/lora/registry.py"]) is None
+
+
+def test_get_selected_test_step_sharded():
+    step = TestStep(
+        label="LoRA %N",
+        source_file_dependencies=["vllm/lora"],
+        parallelism=4,
+        command="pytest -v -s lora --shard-id=$$BUILDKITE_PARALLEL_JOB --num-shards=$$BUILDKITE_PARALLEL_JOB_COUNT",
+    )
+    selected_step = get_selected_test_step(step, ["vllm/lora/utils.py"], _get_lora_import_graph())
+    assert selected_step.commands == ["pytest -v -s lora/test_utils.py"]
+    assert selected_step.parallelism is None
+
+
+@pytest.mark.parametrize(
+    ("commands", "list_file_diff"),
+    [
+        # A change the graph cannot follow
+        (["pytest -v -s lora"], ["vllm/lora/utils.py", "vllm/lora/config.json"]),
+        # A conftest.py of the step is affected
+        (["pytest -v -s lora"], ["vllm/lora/layers.py"]),
+        # Not a plain pytest command
+        (["cd lora", "pytest -v -s test_utils.py"], ["vllm/lora/utils.py"]),
+        (["pytest -v -s lora && echo done"], ["vllm/lora/utils.py"]),
+        (["pytest -v -s 'lora"], ["vllm/lora/utils.py"]),
+        # pytest collects from its rootdir
+        (["pytest -v -s"], ["vllm/lora/utils.py"]),
+        # Nothing to narrow
+        (["pytest -v -s lora/test_utils.py"], ["vllm/lora/utils.py"]),
+    ],
+)
+def test_get_selected_test_step_full_step(commands, list_file_diff):
+    step = TestStep(label="LoRA", source_file_dependencies=["vllm/lora"], commands=commands)
+    assert get_selected_test_step(step, list_file_diff, _get_lora_import_graph()) is None
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
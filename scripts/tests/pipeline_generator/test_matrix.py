@@ -0,0 +1,88 @@
+import pytest
+import sys
+
+from scripts.pipeline_generator.matrix import (
+    DEFAULT_CUDA_VERSION,
+    NIGHTLY_MATRIX_FILTER,
+    PR_MATRIX_FILTER,
+    Hardware,
+    Matrix,
+    MatrixCell,
+    MatrixFilter,
+    get_cell_image,
+    get_cell_test_step,
+    iter_matrix_cells,
+    parse_matrix_filter,
+)
+from scripts.pipeline_generator.step import TestStep
+
+CONTAINER_IMAGE = "registry/repo:abc"
+CU121 = MatrixCell(cuda_version="12.1.0")
+CU118 = MatrixCell(cuda_version="11.8.0")
+AMD = MatrixCell(hardware=Hardware.AMD)
+
+
+def _get_test_step(**kwargs):
+    return TestStep(label="LoRA", commands=["pytest -v -s lora"], **kwargs)
+
+
+@pytest.mark.parametrize(
+    ("cell", "expected_name", "expected_build_step_key", "expected_image"),
+    [
+        (MatrixCell(), "", "build", CONTAINER_IMAGE),
+        (CU121, "cu121", "build-cu121", f"{CONTAINER_IMAGE}-cu121"),
+        (AMD, "amd", "amd-build", "rocm/vllm-ci:abc"),
+    ],
+)
+def test_matrix_cell(cell, expected_name, expected_build_step_key, expected_image):
+    assert cell.name == expected_name
+    assert cell.build_step_key == expected_build_step_key
+    assert get_cell_image(cell, CONTAINER_IMAGE, "abc") == expected_image
+
+
+@pytest.mark.parametrize(
+    ("test_step", "matrix_filter", "expected_result"),
+    [
+        (_get_test_step(), NIGHTLY_MATRIX_FILTER, [MatrixCell()]),
+        (_get_test_step(mirror_hardwares=["amd"]), NIGHTLY_MATRIX_FILTER, [MatrixCell(), AMD]),
+        (_get_test_step(mirror_hardwares=["amd"]), PR_MATRIX_FILTER, [MatrixCell(), AMD]),
+        (
+            _get_test_step(matrix=Matrix(cuda_version=[DEFAULT_CUDA_VERSION, "12.1.0", "11.8.0"], hardware=["cuda", "amd"])),
+            NIGHTLY_MATRIX_FILTER,
+            [MatrixCell(), CU121, CU118, AMD],
+        ),
+        (
+            _get_test_step(matrix=Matrix(cuda_version=[DEFAULT_CUDA_VERSION, "12.1.0", "11.8.0"])),
+            MatrixFilter(cuda_version=["11.8.0"]),
+            [CU118],
+        ),
+        # Multi-node steps only run on CUDA hardware
+        (
+            TestStep(label="2 Nodes", commands=["a", "b"], num_nodes=2, num_gpus=2, mirror_hardwares=["amd"]),
+            NIGHTLY_MATRIX_FILTER,
+            [MatrixCell()],
+        ),
+    ],
+)
+def test_iter_matrix_cells(test_step, matrix_filter, expected_result):
+    assert list(iter_matrix_cells(test_step, matrix_filter)) == expected_result
+
+
+def test_get_cell_test_step():
+    test_step = _get_test_step()
+    assert get_cell_test_step(test_step, MatrixCell()) is test_step
+    assert get_cell_test_step(test_step, CU118).label == "LoRA (cu118)"
+    assert test_step.label == "LoRA"
+
+
+def test_parse_matrix_filter():
+    assert parse_matrix_filter(["cuda_version=default,12.1.0", "hardware=amd"]) == MatrixFilter(
+        cuda_version=[DEFAULT_CUDA_VERSION, "12.1.0"],
+        hardware=[Hardware.AMD],
+    )
+    with pytest.raises(ValueError):
+        parse_matrix_filter(["gpu=a100"])
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,135 @@
+import io
+import pytest
+import subprocess
+import sys
+import threading
+import time
+
+from scripts.pipeline_generator.multi_node import (
+    NETWORK_NAME,
+    NOT_READY_EXIT_STATUS,
+    MultiNodeLauncher,
+    MultiNodeSpec,
+    get_cluster_size_check_command,
+    get_gpu_devices,
+)
+
+
+class FakeRuntime:
+    """
+    Containers are plain host processes: commands run with bash, Ray commands only record that
+    the node joined. Starting a container takes `start_delay` seconds.
+    """
+
+    def __init__(self, start_delay=0.0, cluster_ready=True):
+        self.start_delay = start_delay
+        self.cluster_ready = cluster_ready
+        self.events = []
+        self.lock = threading.Lock()
+        self.ray_nodes = set()
+
+    def _record(self, *event):
+        with self.lock:
+            self.events.append(event)
+
+    def create_network(self, network, subnet):
+        self._record("create_network", network)
+
+    def remove_network(self, network):
+        self._record("remove_network", network)
+
+    def start_container(self, name, image, gpu_devices, network, ip):
+        time.sleep(self.start_delay)
+        self._record("start_container", name, gpu_devices, ip)
+
+    def stop_container(self, name):
+        self._record("stop_container", name)
+
+    def exec(self, name, command, detach=False):
+        if command.startswith("ray start"):
+            self.ray_nodes.add(name)
+            command = "true"
+        elif command == "ray status":
+            command = "true" if "node0" in self.ray_nodes else "false"
+        elif "ray.nodes()" in command:
+            command = "true" if self.cluster_ready and len(self.ray_nodes) == 2 else "false"
+        else:
+            self._record("exec", name, command)
+        return subprocess.Popen(["bash", "-c", command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+def _get_spec(commands, num_nodes=2):
+    return MultiNodeSpec(num_nodes=num_nodes, num_gpus=2, commands=commands, working_dir="/tmp", image="image:latest")
+
+
+def _launch(spec, runtime, **kwargs):
+    output = io.StringIO()
+    returncode = MultiNodeLauncher(spec, runtime, output=output, **kwargs).run()
+    return returncode, output.getvalue()
+
+
+def test_spec_json_roundtrip():
+    spec = _get_spec(["echo \"it's\"", "echo '$HOME'"])
+    assert MultiNodeSpec.from_json(spec.to_json()) == spec
+
+
+def test_spec_invalid():
+    with pytest.raises(ValueError):
+        _get_spec(["echo a"])
+
+
+def test_get_gpu_devices():
+    assert get_gpu_devices(0, 2) == '"device=0,1"'
+    assert get_gpu_devices(1, 2) == '"device=2,3"'
+    assert get_gpu_devices(3, 1) == '"device=3"'
+
+
+def test_get_cluster_size_check_command():
+    assert ">= 2 else 1" in get_cluster_size_check_command(2)
+
+
+def test_run():
+    runtime = FakeRuntime()
+    returncode, output = _launch(_get_spec(["echo \"head's output\"", "echo worker; echo done"]), runtime)
+    assert returncode == 0
+    assert "[node0] head's output\n" in output
+    assert "[node1] worker\n[node1] done\n" in output
+    assert ("start_container", "node1", '"device=2,3"', "192.168.10.11") in runtime.events
+    assert ("exec", "node0", "cd /tmp ; echo \"head's output\"") in runtime.events
+    assert runtime.events[0] == ("create_network", NETWORK_NAME)
+    assert runtime.events[-1] == ("remove_network", NETWORK_NAME)
+    assert {event for event in runtime.events if event[0] == "stop_container"} == {
+        ("stop_container", "node0"),
+        ("stop_container", "node1"),
+    }
+
+
+def test_nodes_start_concurrently():
+    runtime = FakeRuntime(start_delay=0.5)
+    start = time.monotonic()
+    returncode, _ = _launch(_get_spec(["true", "true"]), runtime)
+    assert returncode == 0
+    assert time.monotonic() - start < 1
+
+
+def test_fail_fast():
+    runtime = FakeRuntime()
+    start = time.monotonic()
+    returncode, output = _launch(_get_spec(["sleep 30", "echo failing; exit 3"]), runtime)
+    assert returncode == 3
+    assert time.monotonic() - start < 10
+    assert "node1 exited with status 3" in output
+    assert runtime.events[-1] == ("remove_network", NETWORK_NAME)
+
+
+def test_cluster_not_ready():
+    runtime = FakeRuntime(cluster_ready=False)
+    returncode, output = _launch(_get_spec(["true", "true"]), runtime, ready_timeout=0)
+    assert returncode == NOT_READY_EXIT_STATUS
+    assert "Ray cluster: not ready after 0s" in output
+    assert not [event for event in runtime.events if event[0] == "exec"]
+    assert runtime.events[-1] == ("remove_network", NETWORK_NAME)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -5,7 +5,12 @@ import tempfile
 import yaml
 
 from scripts.pipeline_generator.pipeline_generator import PipelineGeneratorConfig, PipelineGenerator, read_test_steps, write_buildkite_steps
-from scripts.pipeline_generator.step import BuildkiteStep, BuildkiteBlockStep, DEFAULT_TEST_WORKING_DIR
+from scripts.pipeline_generator.step import BuildkiteStep, BuildkiteBlockStep, BuildkiteWaitStep, TestStep, DEFAULT_TEST_WORKING_DIR
+from scripts.pipeline_generator.flaky import FlakeHistory, StepRun
+from scripts.pipeline_generator.impact import CachedImports, ImportCache, ImportGraph
+from scripts.pipeline_generator.matrix import Matrix, MatrixFilter
+from scripts.pipeline_generator.result_cache import LocalResultStore, StepResult
+from scripts.pipeline_generator.sharding import TimingDatabase
 from scripts.pipeline_generator.utils import AgentQueue
 
 TEST_COMMIT = "abcdef0123456789abcdef0123456789abcdef01"
@@ -13,21 +18,39 @@ TEST_CONTAINER_REGISTRY = "container.registry"
 TEST_CONTAINER_REGISTRY_REPO = "test"
 
 
-def _get_pipeline_generator_config():
+def _get_pipeline_generator_config(list_file_diff=None, run_all=False, nightly=False):
     return PipelineGeneratorConfig(
         container_registry=TEST_CONTAINER_REGISTRY,
         container_registry_repo=TEST_CONTAINER_REGISTRY_REPO,
         commit=TEST_COMMIT,
-        list_file_diff=[],
+        list_file_diff=list_file_diff or [],
+        run_all=run_all,
+        nightly=nightly,
     )
 
 
+def _get_test_steps():
+    return [
+        TestStep(label="Test 1", command="echo 1"),
+        TestStep(label="Test 2", command="echo 2", source_file_dependencies=["vllm/lora"]),
+        TestStep(label="Test 3", command="echo 3", source_file_dependencies=["csrc/"]),
+        TestStep(label="Test 4", command="echo 4", optional=True),
+    ]
+
+
 def test_pipeline_generator_config_get_container_image():
     config = _get_pipeline_generator_config()
     config.validate()
     assert config.container_image == "container.registry/test:abcdef0123456789abcdef0123456789abcdef01"
 
 
+def test_pipeline_generator_config_get_content_addressed_image():
+    config = _get_pipeline_generator_config()
+    assert config.content_addressed_image is None
+    config.image_content_hash = "0123"
+    assert config.content_addressed_image == "container.registry/test:content-0123"
+
+
 @pytest.mark.parametrize(
     "commit",
     [
@@ -42,6 +65,336 @@ def test_get_pipeline_generator_config_invalid_commit(commit):
         config.validate()
 
 
+@pytest.mark.parametrize(
+    ("list_file_diff", "run_all", "nightly", "expected_result"),
+    [
+        ([], False, False, {"Test 1", "Test 4"}),
+        (["vllm/lora/layers.py"], False, False, {"Test 1", "Test 2", "Test 4"}),
+        (["docs/csrc/README.md"], False, False, {"Test 1", "Test 3", "Test 4"}),
+        ([], True, False, {"Test 1", "Test 2", "Test 3", "Test 4"}),
+        ([], False, True, {"Test 1", "Test 2", "Test 3", "Test 4"}),
+    ]
+)
+def test_get_unblocked_step_labels(list_file_diff, run_all, nightly, expected_result):
+    config = _get_pipeline_generator_config(list_file_diff, run_all, nightly)
+    pipeline_generator = PipelineGenerator(config)
+    assert pipeline_generator.get_unblocked_step_labels(_get_test_steps()) == expected_result
+
+
+def test_get_unblocked_step_labels_with_import_graph():
+    import_graph = ImportGraph(ImportCache(files={
+        "vllm/lora/layers.py": CachedImports(blob="1", imports=[]),
+        "vllm/lora/utils.py": CachedImports(blob="2", imports=["vllm.lora.layers"]),
+        "tests/lora/test_layers.py": CachedImports(blob="3", imports=["vllm.lora.layers"]),
+        "tests/lora/test_utils.py": CachedImports(blob="4", imports=["vllm.lora.utils"]),
+    }))
+    test_steps = [
+        TestStep(label="LoRA Layers", command="pytest -v -s lora/test_layers.py", source_file_dependencies=["vllm/lora/layers.py"]),
+        TestStep(label="LoRA Utils", command="pytest -v -s lora/test_utils.py", source_file_dependencies=["vllm/lora/utils.py"]),
+    ]
+    config = _get_pipeline_generator_config(["vllm/lora/layers.py"])
+    assert PipelineGenerator(config).get_unblocked_step_labels(test_steps) == {"LoRA Layers"}
+    # test_utils.py imports vllm/lora/layers.py through vllm/lora/utils.py
+    config.import_graph = import_graph
+    assert PipelineGenerator(config).get_unblocked_step_labels(test_steps) == {"LoRA Layers", "LoRA Utils"}
+    config.list_file_diff = ["vllm/lora/utils.py"]
+    assert PipelineGenerator(config).get_unblocked_step_labels(test_steps) == {"LoRA Utils"}
+
+
+def test_generate_test_steps_with_import_graph():
+    import_graph = ImportGraph(ImportCache(files={
+        "vllm/lora/utils.py": CachedImports(blob="1", imports=[]),
+        "tests/lora/test_layers.py": CachedImports(blob="2", imports=[]),
+        "tests/lora/test_utils.py": CachedImports(blob="3", imports=["vllm.lora.utils"]),
+    }))
+    test_steps = [TestStep(label="LoRA", command="pytest -v -s lora", source_file_dependencies=["vllm/lora"])]
+    config = _get_pipeline_generator_config(["vllm/lora/utils.py"])
+    config.import_graph = import_graph
+    buildkite_steps = PipelineGenerator(config).generate_test_steps(test_steps)
+    assert buildkite_steps[0].commands == ["pytest -v -s lora/test_utils.py"]
+    # Full step on nightly builds
+    config.nightly = True
+    buildkite_steps = PipelineGenerator(config).generate_test_steps(test_steps)
+    assert buildkite_steps[0].commands == ["pytest -v -s lora"]
+
+
+def test_generate_test_steps():
+    config = _get_pipeline_generator_config(["vllm/lora/layers.py"])
+    pipeline_generator = PipelineGenerator(config)
+    buildkite_steps = pipeline_generator.generate_test_steps(_get_test_steps())
+    assert [step.key for step in buildkite_steps] == [
+        "test-1",
+        "test-2",
+        "block-test-3",
+        "test-3",
+        "block-test-4",
+        "test-4",
+    ]
+    assert buildkite_steps[0].depends_on == ["build"]
+    assert buildkite_steps[1].depends_on == ["build"]
+    assert buildkite_steps[3].depends_on == ["block-test-3"]
+    assert buildkite_steps[5].depends_on == ["block-test-4"]
+
+
+def test_generate_nightly_unblocks_optional_steps():
+    config = _get_pipeline_generator_config(nightly=True)
+    pipeline_generator = PipelineGenerator(config)
+    buildkite_steps = pipeline_generator.generate(_get_test_steps())
+    assert [step.key for step in buildkite_steps] == ["build", "test-1", "test-2", "test-3", "test-4"]
+
+
+def test_generate_matrix():
+    test_steps = [
+        TestStep(label="Test 1", command="echo 1", matrix=Matrix(cuda_version=["default", "12.1.0"]), mirror_hardwares=["amd"]),
+        TestStep(label="Test 2", command="echo 2", matrix=Matrix(cuda_version=["default", "11.8.0"]), optional=True),
+        TestStep(label="Test 3", command="echo 3", matrix=Matrix(cuda_version=["default", "12.1.0"])),
+    ]
+    buildkite_steps = PipelineGenerator(_get_pipeline_generator_config()).generate(test_steps)
+    # PRs run the default CUDA version and the AMD mirrors
+    assert [step.key for step in buildkite_steps] == ["build", "amd-build", "test-1", "test-1-amd", "block-test-2", "test-2", "test-3"]
+
+    config = _get_pipeline_generator_config()
+    config.matrix_filter = MatrixFilter()
+    buildkite_steps = PipelineGenerator(config).generate(test_steps)
+    # Each image is built once, an image only used by blocked steps is built once unblocked
+    assert [step.key for step in buildkite_steps] == [
+        "build",
+        "build-cu121",
+        "amd-build",
+        "block-build-image-cu118",
+        "build-cu118",
+        "test-1",
+        "test-1-cu121",
+        "test-1-amd",
+        "block-test-2",
+        "test-2",
+        "block-test-2-cu118",
+        "test-2-cu118",
+        "test-3",
+        "test-3-cu121",
+    ]
+    steps = {step.key: step for step in buildkite_steps}
+    assert "--build-arg CUDA_VERSION=12.1.0 --tag container.registry/test:" + TEST_COMMIT + "-cu121" in steps["build-cu121"].commands[2]
+    assert steps["build-cu118"].depends_on == ["block-build-image-cu118"]
+    assert steps["test-1-cu121"].depends_on == ["build-cu121"]
+    assert steps["test-1-cu121"].plugins[0]["docker#v5.2.0"]["image"].endswith("-cu121")
+    assert steps["test-1-amd"].depends_on == ["amd-build"]
+    assert steps["test-1-amd"].agents == {"queue": AgentQueue.AMD_GPU.value}
+    assert steps["block-test-2-cu118"].depends_on == ["build-cu118"]
+
+
+def test_generate_matrix_without_default_cell():
+    test_steps = [
+        TestStep(label="Test 1", command="echo 1"),
+        TestStep(label="Test 2", command="echo 2", matrix=Matrix(cuda_version=["11.8.0"])),
+    ]
+    buildkite_steps = PipelineGenerator(_get_pipeline_generator_config()).generate(test_steps)
+    # A step with none of the cells of PRs is blocked rather than dropped
+    assert [step.key for step in buildkite_steps] == [
+        "build",
+        "block-build-image-cu118",
+        "build-cu118",
+        "test-1",
+        "block-test-2-cu118",
+        "test-2-cu118",
+    ]
+
+    config = _get_pipeline_generator_config()
+    config.matrix_filter = MatrixFilter(cuda_version=["default"])
+    buildkite_steps = PipelineGenerator(config).generate(test_steps)
+    assert [step.key for step in buildkite_steps] == ["build", "test-1"]
+
+
+def test_generate_matrix_with_bake():
+    test_steps = [
+        TestStep(label="Test 1", command="echo 1", matrix=Matrix(cuda_version=["default", "12.1.0"]), mirror_hardwares=["amd"]),
+        TestStep(label="Test 2", command="echo 2", matrix=Matrix(cuda_version=["default", "11.8.0"]), image_stage="base"),
+    ]
+    config = _get_pipeline_generator_config()
+    config.matrix_filter = MatrixFilter()
+    config.bake = True
+    buildkite_steps = PipelineGenerator(config).generate(test_steps)
+    steps = {step.key: step for step in buildkite_steps}
+    # The full CUDA images are all built by the build step, other images separately
+    assert list(steps)[:4] == ["build", "amd-build", "build-base", "build-cu118-base"]
+    assert "for image in container.registry/test:" + TEST_COMMIT + " container.registry/test:" + TEST_COMMIT + "-cu121; do" in steps["build"].commands[1]
+    assert '"image-cu121"' in steps["build"].commands[2]
+    assert steps["test-1-cu121"].depends_on == ["build"]
+    assert steps["test-2-cu118"].depends_on == ["build-cu118-base"]
+
+
+def test_generate_image_stages_with_bake():
+    test_steps = [
+        TestStep(label="Test 1", command="echo 1", matrix=Matrix(cuda_version=["default", "12.1.0"])),
+        TestStep(label="Test 2", command="echo 2", matrix=Matrix(cuda_version=["12.1.0"]), image_stage="wheel"),
+    ]
+    config = _get_pipeline_generator_config()
+    config.matrix_filter = MatrixFilter()
+    config.bake = True
+    steps = {step.key: step for step in PipelineGenerator(config).generate(test_steps)}
+    # The wheel is a target of the same bake as the full image
+    assert list(steps)[0] == "build" and "build-cu121" not in steps
+    assert '"image-cu121-wheel"' in steps["build"].commands[2]
+    assert '"target": "build"' in steps["build"].commands[2]
+    assert steps["test-2-cu121"].depends_on == ["build"]
+
+
+def test_generate_image_stages():
+    test_steps = [
+        TestStep(label="Lint", command="echo lint", no_gpu=True, image_stage="base"),
+        TestStep(label="Test 1", command="echo 1"),
+        TestStep(label="Test 2", command="echo 2", image_stage="wheel", source_file_dependencies=["vllm/lora"]),
+    ]
+    config = _get_pipeline_generator_config()
+    config.timing_database = TimingDatabase(steps={"build": 3600, "build-base": 600, "lint": 300, "test-1": 600})
+    pipeline_generator = PipelineGenerator(config)
+    buildkite_steps = pipeline_generator.generate(test_steps)
+    steps = {step.key: step for step in buildkite_steps}
+    assert list(steps)[:2] == ["build", "build-base"]
+    assert set(list(steps)[2:]) == {"lint", "test-1", "block-test-2", "test-2"}
+    assert "--target base" in steps["build-base"].commands[2]
+    # The wheel is pushed by the build of the full image, which reuses its layers, rather than compiled twice
+    assert f"--tag container.registry/test:{TEST_COMMIT}-wheel --target build" in steps["build"].commands[2]
+    assert steps["build"].commands[3] == f"docker push container.registry/test:{TEST_COMMIT}-wheel"
+    assert f"--tag container.registry/test:{TEST_COMMIT} --target test" in steps["build"].commands[4]
+    assert steps["lint"].depends_on == ["build-base"]
+    assert steps["lint"].plugins[0]["docker#v5.2.0"]["image"].endswith(f"{TEST_COMMIT}-base")
+    assert steps["block-test-2"].depends_on == ["build"]
+    assert steps["test-2"].plugins[0]["docker#v5.2.0"]["image"].endswith(f"{TEST_COMMIT}-wheel")
+    assert pipeline_generator.critical_path == (["build", "test-1"], 4200)
+
+
+def test_generate_image_stages_working_dir():
+    test_steps = [
+        TestStep(label="Lint", command="echo lint", no_gpu=True, image_stage="base"),
+        TestStep(label="Test 1", command="echo 1"),
+        TestStep(label="Test 2", command="echo 2", image_stage="wheel", working_dir="/workspace/tests"),
+    ]
+    config = _get_pipeline_generator_config()
+    config.profile_steps = True
+    steps = {step.key: step for step in PipelineGenerator(config).generate(test_steps)}
+    # Only the test stage has /vllm-workspace, earlier stages run from the WORKDIR of their target
+    assert "cd /workspace;" in steps["lint"].commands[0]
+    assert "cd /vllm-workspace/tests;" in steps["test-1"].commands[0]
+    assert "cd /workspace/tests;" in steps["test-2"].commands[0]
+
+
+def test_generate_test_steps_with_timing_database():
+    config = _get_pipeline_generator_config(run_all=True)
+    config.timing_database = TimingDatabase(steps={"kernels-test-n": 3 * 3600})
+    test_steps = [
+        TestStep(
+            label="Kernels Test %N",
+            parallelism=4,
+            command="pytest -v -s kernels --shard-id=$$BUILDKITE_PARALLEL_JOB --num-shards=$$BUILDKITE_PARALLEL_JOB_COUNT",
+        ),
+        TestStep(label="Test 1", parallelism=2, command="echo 1"),
+    ]
+    buildkite_steps = PipelineGenerator(config).generate_test_steps(test_steps)
+    assert buildkite_steps[0].parallelism == 8
+    assert buildkite_steps[1].parallelism == 2
+
+
+def test_generate_test_steps_with_flake_history():
+    flaky_run = StepRun(build=1, passed=True, failed=True, failed_tests=["lora/test_a.py::test"], flaky_tests=["lora/test_a.py::test"])
+    config = _get_pipeline_generator_config(run_all=True)
+    config.flake_history = FlakeHistory(steps={
+        "lora": [flaky_run, flaky_run.model_copy(update={"build": 2}), StepRun(build=3, passed=True)],
+        "core": [StepRun(build=1, passed=True, failed=True), StepRun(build=2, passed=True)],
+    })
+    test_steps = [
+        TestStep(label="LoRA", command="pytest -v -s lora"),
+        TestStep(label="Core", command="pytest -v -s core"),
+    ]
+    lora_step, core_step = PipelineGenerator(config).generate_test_steps(test_steps)
+    assert lora_step.commands == ["pytest -v -s lora --deselect lora/test_a.py::test"]
+    assert lora_step.retry is None
+    assert core_step.commands == ["pytest -v -s core"]
+    assert core_step.retry["automatic"][-1] == {"exit_status": "*", "limit": 2}
+    assert core_step.soft_fail
+
+
+def test_generate_test_steps_with_checkpoint():
+    config = _get_pipeline_generator_config(run_all=True)
+    config.checkpoint_tests = True
+    test_steps = [
+        TestStep(label="LoRA", command="pytest -v -s lora"),
+        TestStep(label="Multi-node", commands=["pytest -v -s a", "pytest -v -s b"], num_nodes=2, num_gpus=2),
+    ]
+    lora_step, multi_node_step = PipelineGenerator(config).generate_test_steps(test_steps)
+    assert lora_step.commands[0].startswith("python3 .buildkite/pipeline_generator/checkpoint.py --artifact --name checkpoint-lora -- ")
+    assert lora_step.retry["automatic"][0] == {"exit_status": -1, "limit": 2}
+    assert multi_node_step.commands[0].startswith("python3 .buildkite/pipeline_generator/multi_node.py --spec")
+
+
+def test_generate_test_steps_with_profiler():
+    config = _get_pipeline_generator_config(run_all=True)
+    config.profile_steps = True
+    test_steps = [
+        TestStep(label="LoRA", command="pytest -v -s lora", mirror_hardwares=["amd"]),
+        TestStep(label="Multi-node", commands=["pytest -v -s a", "pytest -v -s b"], num_nodes=2, num_gpus=2),
+    ]
+    config.matrix_filter = MatrixFilter()
+    lora_step, amd_lora_step, multi_node_step = PipelineGenerator(config).generate_test_steps(test_steps)
+    assert lora_step.commands[0].startswith("python3 .buildkite/pipeline_generator/profiler.py --artifact --name profile-lora -- ")
+    assert "profiler.py" not in amd_lora_step.commands[0]
+    assert multi_node_step.commands[0].startswith("python3 .buildkite/pipeline_generator/multi_node.py --spec")
+
+
+def test_generate_with_result_store():
+    import_graph = ImportGraph(ImportCache(files={"tests/lora/test_layers.py": CachedImports(blob="1", imports=[])}))
+    test_steps = [
+        TestStep(label="LoRA", command="pytest -v -s lora", source_file_dependencies=["vllm/lora"]),
+        TestStep(label="Core", command="pytest -v -s core", source_file_dependencies=["vllm/core"]),
+        TestStep(label="Blocked", command="pytest -v -s blocked", source_file_dependencies=["vllm/blocked"]),
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = _get_pipeline_generator_config(["vllm/lora/layers.py", "vllm/core/block.py"])
+        config.import_graph = import_graph
+        config.file_blobs = {"tests/lora/test_layers.py": "1", "vllm/lora/layers.py": "2"}
+        config.result_store_url = temp_dir
+        pipeline_generator = PipelineGenerator(config)
+        steps = pipeline_generator.generate(test_steps)
+        assert [step.key for step in steps] == ["build", "lora", "core", "block-blocked", "blocked", "record-step-results"]
+        # Does not wait for the blocked step
+        assert steps[-1].depends_on == [{"step": "lora", "allow_failure": True}, {"step": "core", "allow_failure": True}]
+
+        LocalResultStore(temp_dir).put(pipeline_generator.step_fingerprints["lora"], StepResult(commit=TEST_COMMIT))
+        steps = PipelineGenerator(config).generate(test_steps)
+        assert steps[1].label == "LoRA (cached pass)"
+        assert "--fingerprint lora=" not in steps[-1].commands[-1]
+        assert "--fingerprint core=" in steps[-1].commands[-1]
+
+        file_path = os.path.join(temp_dir, "pipeline.yaml")
+        write_buildkite_steps(steps, file_path)
+        with open(file_path, "r") as f:
+            assert yaml.safe_load(f)["steps"][-1]["depends_on"] == [{"step": "core", "allow_failure": True}]
+
+
+def test_generate_with_result_store_and_coalescing():
+    import_graph = ImportGraph(ImportCache(files={"tests/lora/test_layers.py": CachedImports(blob="1", imports=[])}))
+    test_steps = [
+        TestStep(label=f"Test {index}", command=f"pytest -v -s test_{index}.py", source_file_dependencies=["vllm/"])
+        for index in range(3)
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = _get_pipeline_generator_config(run_all=True)
+        config.import_graph = import_graph
+        config.file_blobs = {"tests/lora/test_layers.py": "1"}
+        config.result_store_url = temp_dir
+        config.timing_database = TimingDatabase(steps={f"test-{index}": 60 for index in range(3)})
+        config.coalesce_budget = 600
+        pipeline_generator = PipelineGenerator(config)
+        steps = pipeline_generator.generate(test_steps)
+        assert [step.key for step in steps[:2]] == ["build", "coalesced-test-0"]
+        assert steps[-1].key == "record-step-results"
+        # The merged steps are recorded with the outcome of their combined job
+        fingerprint_options = steps[-1].commands[-1].split(" --fingerprint ")[1:]
+        assert fingerprint_options == [
+            f"coalesced-test-0={pipeline_generator.step_fingerprints[f'test-{index}']}" for index in range(3)
+        ]
+
+
 def test_read_test_steps():
     current_dir = os.path.dirname(os.path.abspath(__file__))
     test_path = os.path.join(current_dir, "test_files/test-pipeline.yaml")
@@ -62,6 +415,20 @@ def test_read_test_steps():
     assert test_steps[3].num_gpus == 4
 
 
+def test_read_test_steps_invalid():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        test_path = os.path.join(temp_dir, "test-pipeline.yaml")
+        with open(test_path, "w") as f:
+            f.write(
+                "steps:\n"
+                "- label: Valid\n  command: echo 1\n"
+                "- label: No command\n"
+                "- label: Bad GPU\n  command: echo 3\n  gpu: abc100\n"
+            )
+        with pytest.raises(ValueError, match=r"Invalid test steps \['No command', 'Bad GPU'\]"):
+            read_test_steps(test_path)
+
+
 def test_write_buildkite_steps():
     current_dir = os.path.dirname(os.path.abspath(__file__))
     expected_output_path = os.path.join(current_dir, "test_files/expected_pipeline.yaml")
@@ -82,7 +449,33 @@ def test_write_buildkite_steps():
         with open(expected_output_path, "r") as f:
             expected_content = f.read()
         assert content == expected_content
-        
+
+
+def test_write_buildkite_steps_matches_single_dump():
+    config = _get_pipeline_generator_config(run_all=True)
+    steps = PipelineGenerator(config).generate([
+        *_get_test_steps(),
+        TestStep(label="A100 test", command="echo 5", gpu="a100", num_gpus=2),
+        TestStep(label="Multi-node test", commands=["echo 6", "echo 7"], num_nodes=2, num_gpus=2),
+    ])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_file_path = os.path.join(temp_dir, "output.yaml")
+        # Steps can come from any iterable, including a generator
+        write_buildkite_steps((step for step in steps), output_file_path)
+        with open(output_file_path, "r") as f:
+            content = f.read()
+    expected_content = yaml.dump({"steps": [step.model_dump(exclude_none=True) for step in steps]}, sort_keys=False)
+    assert content == expected_content
+
+
+def test_write_buildkite_steps_empty():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_file_path = os.path.join(temp_dir, "output.yaml")
+        write_buildkite_steps([], output_file_path)
+        with open(output_file_path, "r") as f:
+            content = f.read()
+    assert content == yaml.dump({"steps": []}, sort_keys=False)
+
 
 if __name__ == "__main__":
     sys.exit(pytest.main(["-v", __file__]))
@@ -2,8 +2,11 @@ import pytest
 import sys
 from unittest import mock
 
-from scripts.pipeline_generator.pipeline_generator_helper import get_plugin_config, convert_test_step_to_buildkite_step
-from scripts.pipeline_generator.utils import GPUType
+import shlex
+
+from scripts.pipeline_generator.pipeline_generator_helper import get_plugin_config, convert_test_step_to_buildkite_step, get_build_commands, get_bake_build_commands, add_checkpoint, add_profiler
+from scripts.pipeline_generator.build_cache import BuildCache, ImageBuild
+from scripts.pipeline_generator.utils import AGENT_RETRY_RULES, CHECKPOINT_SCRIPT, PROFILER_SCRIPT, GPUType, get_full_test_command
 from scripts.pipeline_generator.step import TestStep, BuildkiteStep
 
 @mock.patch("scripts.pipeline_generator.pipeline_generator_helper.get_kubernetes_plugin_config")
@@ -72,5 +75,78 @@ def test_convert_test_step(mock_get_plugin_config, mock_get_multi_node_test_comm
     assert buildkite_step == expected_buildkite_step
 
 
+def test_add_checkpoint():
+    test_step = TestStep(label="LoRA", commands=["pip install x", "pytest -v -s lora --shard-id=$$BUILDKITE_PARALLEL_JOB"], parallelism=2)
+    buildkite_step = convert_test_step_to_buildkite_step(test_step, "image:latest")
+    add_checkpoint(buildkite_step, test_step.working_dir)
+    assert len(buildkite_step.commands) == 1
+    assert shlex.split(buildkite_step.commands[0]) == [
+        "python3", CHECKPOINT_SCRIPT, "--artifact", "--name", "checkpoint-lora-$$BUILDKITE_PARALLEL_JOB", "--",
+        "bash", "-c", get_full_test_command(test_step.commands, test_step.working_dir),
+    ]
+    assert buildkite_step.plugins[0]["docker#v5.2.0"]["mount-buildkite-agent"]
+    assert buildkite_step.retry == {"automatic": AGENT_RETRY_RULES}
+    # The shared plugin config is left as it is
+    assert not convert_test_step_to_buildkite_step(test_step, "image:latest").plugins[0]["docker#v5.2.0"]["mount-buildkite-agent"]
+
+
+def test_add_profiler():
+    test_step = TestStep(label="LoRA", commands=["pytest -v -s lora"])
+    buildkite_step = convert_test_step_to_buildkite_step(test_step, "image:latest")
+    add_profiler(buildkite_step, test_step.working_dir)
+    assert buildkite_step.commands == [get_full_test_command(test_step.commands, test_step.working_dir, "profile-lora")]
+    assert buildkite_step.plugins[0]["docker#v5.2.0"]["mount-buildkite-agent"]
+
+    # The checkpoint wrapper runs the profiler
+    buildkite_step = convert_test_step_to_buildkite_step(test_step, "image:latest")
+    add_checkpoint(buildkite_step, test_step.working_dir, profile=True)
+    checkpoint_command = shlex.split(buildkite_step.commands[0])
+    assert checkpoint_command[:5] == ["python3", CHECKPOINT_SCRIPT, "--artifact", "--name", "checkpoint-lora"]
+    assert checkpoint_command[-1].startswith(f"python3 {PROFILER_SCRIPT} --artifact --name profile-lora -- ")
+
+
+def test_get_build_commands():
+    commands = get_build_commands("registry", "abc", "registry/repo:abc")
+    assert len(commands) == 4
+    assert "--tag registry/repo:abc --target test" in commands[2]
+    assert "imagetools" not in commands[1]
+    assert commands[3] == "docker push registry/repo:abc"
+
+
+def test_get_build_commands_content_addressed_image():
+    commands = get_build_commands("registry", "abc", "registry/repo:abc", "registry/repo:content-123")
+    assert "docker buildx imagetools create --tag registry/repo:abc registry/repo:content-123" in commands[1]
+    assert "--tag registry/repo:abc --tag registry/repo:content-123 --target test" in commands[2]
+    assert commands[3:] == ["docker push registry/repo:abc", "docker push registry/repo:content-123"]
+
+
+def test_get_build_commands_with_build_cache():
+    commands = get_build_commands("registry", "abc", "registry/repo:abc", cuda_version="12.1.0", build_cache=BuildCache(ref="registry/cache", branch="feature/x"))
+    assert len(commands) == 4
+    assert "docker buildx create --name vllm-builder" in commands[2]
+    assert commands[3].startswith("docker buildx build --builder vllm-builder ")
+    assert "--cache-from type=registry,ref=registry/cache:feature-x-cu121-test --cache-from type=registry,ref=registry/cache:main-cu121-test " in commands[3]
+    assert "--cache-to type=registry,ref=registry/cache:feature-x-cu121-test,mode=max,image-manifest=true,oci-mediatypes=true --push " in commands[3]
+
+
+def test_get_build_commands_with_stage_images():
+    commands = get_build_commands(
+        "registry", "abc", "registry/repo:abc", build_cache=BuildCache(ref="registry/cache"), stage_images={"build": "registry/repo:abc-wheel"}
+    )
+    assert "[[ -z $(docker manifest inspect registry/repo:abc-wheel) ]] || [[ -z $(docker manifest inspect registry/repo:abc) ]]" in commands[1]
+    assert "--tag registry/repo:abc-wheel --target build" in commands[3]
+    assert "--cache-to" not in commands[3] and "--push" in commands[3]
+    assert "--tag registry/repo:abc --target test" in commands[4]
+    assert "--cache-to" in commands[4]
+
+
+def test_get_bake_build_commands():
+    image_builds = [ImageBuild(name="image", tags=["registry/repo:abc"]), ImageBuild(name="image-cu121", tags=["registry/repo:abc-cu121"], cuda_version="12.1.0")]
+    commands = get_bake_build_commands("registry", "abc", image_builds)
+    assert "for image in registry/repo:abc registry/repo:abc-cu121; do" in commands[1]
+    assert '"buildkite_commit": "abc"' in commands[2]
+    assert commands[3] == "docker buildx bake --file docker-bake.json --push --progress plain"
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main(["-v", __file__]))
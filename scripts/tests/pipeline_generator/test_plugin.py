@@ -25,8 +25,8 @@ def test_get_kubernetes_plugin_config():
                             {"name": "hf-cache", "mountPath": "/root/.cache/huggingface"}
                         ],
                         "env": [
-                            {"name": "HF_HOME", "value": "/root/.cache/huggingface"},
                             {"name": "VLLM_USAGE_SOURCE", "value": "ci-test"},
+                            {"name": "HF_HOME", "value": "/root/.cache/huggingface"},
                             {
                                 "name": "HF_TOKEN",
                                 "valueFrom": {
@@ -108,5 +108,28 @@ def test_get_docker_plugin_config(docker_image_path, no_gpu, expected_config):
     assert get_docker_plugin_config(docker_image_path, no_gpu) == expected_config
 
 
+def test_get_plugin_config_with_command():
+    docker_config = get_docker_plugin_config("image:a", True, ("bash", "-xc", "pytest"), ("HF_TOKEN",), ("/a:/a",), None)
+    assert docker_config[DOCKER_PLUGIN_NAME] == {
+        "image": "image:a",
+        "always-pull": True,
+        "propagate-environment": True,
+        "command": ["bash", "-xc", "pytest"],
+        "environment": ["HF_TOKEN"],
+        "volumes": ["/a:/a"],
+    }
+    kubernetes_config = get_kubernetes_plugin_config("image:a", 2, ("bash",), ("-c", "pytest"))
+    container = kubernetes_config[KUBERNETES_PLUGIN_NAME]["podSpec"]["containers"][0]
+    assert container["command"] == ["bash"]
+    assert container["args"] == ["-c", "pytest"]
+
+
+def test_plugin_configs_are_memoized():
+    assert get_docker_plugin_config("image:a", False) is get_docker_plugin_config("image:a", False)
+    assert get_docker_plugin_config("image:a", False) is not get_docker_plugin_config("image:b", False)
+    assert get_kubernetes_plugin_config("image:a", 2) is get_kubernetes_plugin_config("image:a", 2)
+    assert get_kubernetes_plugin_config("image:a", 2) is not get_kubernetes_plugin_config("image:a", 4)
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,82 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+from scripts.pipeline_generator.profiler import (
+    FIRST_PHASE,
+    Sampler,
+    get_phase_durations,
+    get_summary,
+    main,
+    read_process_tree,
+    run_with_profiler,
+)
+
+
+def _read_gpus():
+    # Two GPUs, only the first one used
+    return [(0, 90.0, 20000.0), (1, 0.0, 300.0)]
+
+
+def test_get_phase_durations():
+    assert get_phase_durations([], 100.0, 110.0) == {FIRST_PHASE: 10.0}
+    # The first phase starts with the command, whenever it is marked
+    assert get_phase_durations([("test", 103.0), ("setup", 100.5)], 100.0, 110.0) == {"setup": 3.0, "test": 7.0}
+
+
+def test_read_process_tree():
+    if not os.path.isdir("/proc"):
+        pytest.skip("/proc is not available")
+    cpu_seconds, rss = read_process_tree(os.getpid())
+    assert cpu_seconds > 0
+    assert rss > 0
+
+
+def test_run_with_profiler():
+    command = [
+        "bash", "-c",
+        'echo "setup $(date +%s.%N)" >> "$PROFILE_PHASE_FILE"; sleep 0.2; '
+        'echo "test $(date +%s.%N)" >> "$PROFILE_PHASE_FILE"; '
+        f"{sys.executable} -c 'import time; end = time.time() + 0.5\nwhile time.time() < end: pass'; exit 3",
+    ]
+    returncode, summary = run_with_profiler(command, "profile-test", interval=0.05, read_gpus=_read_gpus)
+    assert returncode == 3
+    assert summary["exit_status"] == 3
+    assert set(summary["phases"]) == {"setup", "test"}
+    assert summary["phases"]["setup"] >= 0.2
+    assert summary["phases"]["test"] >= 0.5
+    assert summary["samples"] > 5
+    assert summary["cpu"]["total_seconds"] > 0.3
+    assert summary["gpus"][0] == {"index": 0, "mean_utilization": 90.0, "max_utilization": 90.0, "peak_memory_mib": 20000.0}
+    assert (summary["gpus_available"], summary["gpus_used"]) == (2, 1)
+    if os.path.isdir("/proc"):
+        assert summary["cpu"]["max_cores"] > 0.5
+        assert summary["memory"]["peak_rss_bytes"] > 0
+
+
+def test_summary_without_gpus():
+    sampler = Sampler(os.getpid(), 1, read_gpus=lambda: None)
+    sampler.sample()
+    sampler.sample()
+    assert not sampler.gpu_available
+    summary = get_summary("profile-test", 0, 1.0, {FIRST_PHASE: 1.0}, sampler)
+    assert summary["gpus"] == []
+    assert (summary["gpus_available"], summary["gpus_used"]) == (0, 0)
+    assert summary["cpu"]["total_seconds"] is None
+
+
+def test_main():
+    with tempfile.TemporaryDirectory() as output_dir:
+        returncode = main(["--output_dir", output_dir, "--name", "profile-test-0", "--interval", "0.05", "--", "true"])
+        assert returncode == 0
+        with open(os.path.join(output_dir, "profile-test-0.json"), "r") as f:
+            summary = json.load(f)
+    assert summary["name"] == "profile-test-0"
+    assert list(summary["phases"]) == [FIRST_PHASE]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,213 @@
+import io
+import os
+import pytest
+import sys
+import tempfile
+from click.testing import CliRunner
+
+from scripts.pipeline_generator import result_cache
+from scripts.pipeline_generator.impact import CachedImports, ImportCache, ImportGraph
+from scripts.pipeline_generator.result_cache import (
+    LocalResultStore,
+    ResultStore,
+    S3ResultStore,
+    SqliteResultStore,
+    StepFingerprinter,
+    StepResult,
+    get_cached_pass_step,
+    get_record_steps,
+    get_result_store,
+    main,
+)
+from scripts.pipeline_generator.step import BuildkiteStep, TestStep
+from scripts.pipeline_generator.utils import AgentQueue
+
+TEST_CONTAINER_IMAGE = "registry/repo:abcdef"
+IMPORTS = {
+    "vllm/__init__.py": [],
+    "vllm/lora/layers.py": [],
+    "vllm/core/block.py": [],
+    "tests/utils.py": [],
+    "tests/lora/test_layers.py": ["vllm.lora.layers", "tests.utils"],
+}
+FILE_BLOBS = {
+    **{path: "0" for path in IMPORTS},
+    "setup.py": "0",
+    "docs/index.md": "0",
+    "tests/lora/data/adapter.json": "0",
+}
+
+
+class FakeS3Client:
+    """In-memory stand-in for a boto3 S3 client."""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def _get_import_graph():
+    return ImportGraph(ImportCache(files={
+        path: CachedImports(blob="0", imports=imports) for path, imports in IMPORTS.items()
+    }))
+
+
+def _get_test_steps():
+    return [
+        TestStep(label="LoRA", source_file_dependencies=["vllm/lora"], commands=["pytest -v -s lora"]),
+        TestStep(label="Script", source_file_dependencies=["vllm/lora"], commands=["bash run.sh"]),
+    ]
+
+
+def _get_buildkite_step(label="LoRA"):
+    return BuildkiteStep(
+        label=label,
+        key=label.lower(),
+        commands=["pytest -v -s lora"],
+        plugins=[{"docker#v5.2.0": {"image": TEST_CONTAINER_IMAGE}}],
+        agents={"queue": AgentQueue.AWS_1xL4.value},
+    )
+
+
+def _get_fingerprint(file_blobs, test_step_index=0, container_image=TEST_CONTAINER_IMAGE):
+    test_steps = _get_test_steps()
+    fingerprinter = StepFingerprinter(test_steps, file_blobs, _get_import_graph())
+    buildkite_step = _get_buildkite_step()
+    buildkite_step.plugins[0]["docker#v5.2.0"]["image"] = container_image
+    return fingerprinter.get_fingerprint(test_steps[test_step_index], buildkite_step, container_image)
+
+
+def test_get_input_files():
+    fingerprinter = StepFingerprinter(_get_test_steps(), FILE_BLOBS, _get_import_graph())
+    lora, script = _get_test_steps()
+    assert fingerprinter.get_input_files(lora) == {
+        "setup.py",
+        "vllm/__init__.py",
+        "vllm/lora/layers.py",
+        "tests/utils.py",
+        "tests/lora/test_layers.py",
+        "tests/lora/data/adapter.json",
+    }
+    assert fingerprinter.get_input_files(script) == set(FILE_BLOBS)
+
+
+@pytest.mark.parametrize(
+    ("changed_file", "test_step_index", "expected_changed"),
+    [
+        ("vllm/lora/layers.py", 0, True),
+        ("tests/utils.py", 0, True),
+        ("setup.py", 0, True),
+        ("tests/lora/data/adapter.json", 0, True),
+        ("vllm/core/block.py", 0, False),
+        ("docs/index.md", 0, False),
+        ("docs/index.md", 1, True),
+    ],
+)
+def test_get_fingerprint(changed_file, test_step_index, expected_changed):
+    fingerprint = _get_fingerprint(FILE_BLOBS, test_step_index)
+    changed_fingerprint = _get_fingerprint({**FILE_BLOBS, changed_file: "1"}, test_step_index)
+    assert (fingerprint != changed_fingerprint) == expected_changed
+
+
+def test_get_fingerprint_ignores_image_tag():
+    assert _get_fingerprint(FILE_BLOBS) == _get_fingerprint(FILE_BLOBS, container_image="registry/repo:012345")
+
+
+def test_local_result_store():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = get_result_store(f"file://{temp_dir}/results")
+        assert isinstance(store, LocalResultStore)
+        assert store.get("abc") is None
+        store.put("abc", StepResult(commit="1234"))
+        assert store.get("abc") == StepResult(commit="1234")
+        assert os.listdir(os.path.join(temp_dir, "results")) == ["abc.json"]
+
+
+def test_sqlite_result_store():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = get_result_store(f"sqlite://{temp_dir}/results.db")
+        assert isinstance(store, SqliteResultStore)
+        assert store.get("abc") is None
+        store.put("abc", StepResult(commit="1234"))
+        store.put("abc", StepResult(commit="5678", build_url="https://buildkite.com/vllm/ci/builds/1"))
+        assert SqliteResultStore(f"{temp_dir}/results.db").get("abc").commit == "5678"
+
+
+def test_s3_result_store():
+    client = FakeS3Client()
+    store = S3ResultStore("bucket", "/step-results/", client=client)
+    assert store.get("abc") is None
+    store.put("abc", StepResult(commit="1234"))
+    assert list(client.objects) == [("bucket", "step-results/abc.json")]
+    assert store.get("abc") == StepResult(commit="1234")
+
+
+def test_get_cached_pass_step():
+    result = StepResult(commit="1234", build_url="https://buildkite.com/vllm/ci/builds/1")
+    cached_step = get_cached_pass_step(_get_buildkite_step(), result)
+    assert cached_step.label == "LoRA (cached pass)"
+    assert cached_step.key == "lora"
+    assert cached_step.plugins is None
+    assert cached_step.depends_on is None
+    assert cached_step.agents == {"queue": AgentQueue.AWS_SMALL_CPU.value}
+    assert "https://buildkite.com/vllm/ci/builds/1" in cached_step.commands[0]
+
+
+def test_get_record_steps():
+    (record_step,) = get_record_steps({"lora": "abc", "core": "def"}, "s3://bucket/results")
+    # Not behind a wait step, which would also wait for the blocked steps
+    assert record_step.depends_on == [{"step": "lora", "allow_failure": True}, {"step": "core", "allow_failure": True}]
+    assert record_step.model_dump(exclude_none=True)["depends_on"] == record_step.depends_on
+    assert record_step.commands[1:] == [
+        "mkdir -p .result-cache && buildkite-agent artifact download pipeline_generator.tar.gz .result-cache",
+        "tar xzf .result-cache/pipeline_generator.tar.gz -C .result-cache",
+        "PYTHONPATH=.result-cache python -m pipeline_generator.result_cache "
+        "--result_store s3://bucket/results --fingerprint lora=abc --fingerprint core=def",
+    ]
+    (record_step,) = get_record_steps({"lora": "abc", "core": "def"}, "s3://bucket/results", {"lora": "coalesced-lora", "core": "coalesced-lora"})
+    assert record_step.commands[-1].endswith("--fingerprint coalesced-lora=abc --fingerprint coalesced-lora=def")
+    assert record_step.depends_on == [{"step": "coalesced-lora", "allow_failure": True}]
+
+
+def test_record_cli(monkeypatch):
+    outcomes = {"lora": "passed", "core": "hard_failed"}
+    monkeypatch.setattr(result_cache, "get_step_outcome", lambda step_key: outcomes[step_key])
+    monkeypatch.setenv("BUILDKITE_COMMIT", "1234")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        result = CliRunner().invoke(main, ["--result_store", temp_dir, "--fingerprint", "lora=abc", "--fingerprint", "core=def"])
+        assert result.exit_code == 0
+        assert LocalResultStore(temp_dir).get("abc") == StepResult(commit="1234")
+        assert LocalResultStore(temp_dir).get("def") is None
+
+
+def test_record_cli_coalesced_steps(monkeypatch):
+    calls = []
+    monkeypatch.setattr(result_cache, "get_step_outcome", lambda step_key: calls.append(step_key) or "passed")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        result = CliRunner().invoke(main, [
+            "--result_store", temp_dir, "--fingerprint", "coalesced-a=abc", "--fingerprint", "coalesced-a=def",
+        ])
+        assert result.exit_code == 0
+        assert calls == ["coalesced-a"]
+        assert LocalResultStore(temp_dir).get("abc") is not None
+        assert LocalResultStore(temp_dir).get("def") is not None
+
+
+def test_result_store_is_abstract():
+    with pytest.raises(TypeError):
+        ResultStore()
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,40 @@
+import pytest
+import sys
+
+from scripts.pipeline_generator.run_all import RunAllMatcher
+
+
+@pytest.mark.parametrize(
+    ("list_file_diff", "expected_result"),
+    [
+        ([], None),
+        (["vllm/engine/llm_engine.py", "docs/README.md"], None),
+        (["vllm/engine/llm_engine.py", "csrc/ops.h"], ("csrc/ops.h", "csrc/")),
+        (["setup.py"], ("setup.py", "setup.py")),
+        ([".buildkite/test-pipeline.yaml"], (".buildkite/test-pipeline.yaml", ".buildkite/test-pipeline")),
+        (["docker/Dockerfile"], ("docker/Dockerfile", "docker/Dockerfile")),
+        # Ignored even though it matches the docker/Dockerfile prefix
+        (["docker/Dockerfile.rocm"], None),
+        (["docker/Dockerfile.rocm", "CMakeLists.txt"], ("CMakeLists.txt", "CMakeLists.txt")),
+        # Patterns match as prefixes only
+        (["tools/csrc/build.sh"], None),
+    ],
+)
+def test_run_all_matcher_default_rules(list_file_diff, expected_result):
+    assert RunAllMatcher().find_trigger(list_file_diff) == expected_result
+
+
+def test_run_all_matcher_glob_patterns():
+    matcher = RunAllMatcher(patterns=["requirements/*.txt", "vllm/*/CMakeLists.txt"], ignore_patterns=["requirements/dev"])
+    assert matcher.find_trigger(["requirements/rocm.txt"]) == ("requirements/rocm.txt", "requirements/*.txt")
+    assert matcher.find_trigger(["requirements/dev.txt"]) is None
+    assert matcher.find_trigger(["requirements/rocm.in"]) is None
+    assert matcher.find_trigger(["vllm/a/b/CMakeLists.txt"]) == ("vllm/a/b/CMakeLists.txt", "vllm/*/CMakeLists.txt")
+
+
+def test_run_all_matcher_no_patterns():
+    assert RunAllMatcher(patterns=[], ignore_patterns=[]).find_trigger(["csrc/ops.h"]) is None
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,87 @@
+import json
+import os
+import pytest
+import sys
+import tempfile
+from click.testing import CliRunner
+
+from scripts.pipeline_generator.scheduling import (
+    SimulatedJob,
+    assign_priorities,
+    get_dispatch_order,
+    main,
+    schedule_steps,
+    simulate_build,
+)
+from scripts.pipeline_generator.sharding import TimingDatabase
+from scripts.pipeline_generator.step import BuildkiteStep, BuildkiteBlockStep
+from scripts.pipeline_generator.utils import AgentQueue
+
+
+def test_get_dispatch_order():
+    jobs = [
+        SimulatedJob(key="short-l4", queue=AgentQueue.AWS_1xL4.value, duration=60),
+        SimulatedJob(key="long-l4", queue=AgentQueue.AWS_1xL4.value, duration=600),
+        SimulatedJob(key="4xl4", queue=AgentQueue.AWS_4xL4.value, duration=100),
+        SimulatedJob(key="a100", queue=AgentQueue.A100.value, duration=10),
+        SimulatedJob(key="sharded-l4", queue=AgentQueue.AWS_1xL4.value, duration=800, parallelism=4),
+    ]
+    assert [job.key for job in get_dispatch_order(jobs)] == ["a100", "4xl4", "long-l4", "sharded-l4", "short-l4"]
+
+
+def test_assign_priorities():
+    jobs = [
+        SimulatedJob(key="a", queue="q1", duration=60),
+        SimulatedJob(key="b", queue="q1", duration=600),
+        SimulatedJob(key="c", queue="q2", duration=100),
+    ]
+    assign_priorities(jobs)
+    assert [job.priority for job in jobs] == [1, 2, 1]
+
+
+def test_simulate_build():
+    jobs = [
+        SimulatedJob(key="a", queue="q1", duration=10),
+        SimulatedJob(key="b", queue="q1", duration=10),
+        SimulatedJob(key="c", queue="q1", duration=40),
+        SimulatedJob(key="d", queue="q2", duration=30, parallelism=3),
+    ]
+    # Longest job last: the two agents of q1 finish at 10+40 and 10
+    assert simulate_build(jobs, {"q1": 2, "q2": 1}) == {"q1": 50, "q2": 30}
+    # Longest job first thanks to its priority
+    jobs[2].priority = 1
+    assert simulate_build(jobs, {"q1": 2, "q2": 3}) == {"q1": 40, "q2": 10}
+
+
+def test_schedule_steps():
+    steps = [
+        BuildkiteStep(label="Short", key="short", commands=["a"], agents={"queue": AgentQueue.AWS_1xL4.value}),
+        BuildkiteBlockStep(block="Run Long", key="block-long"),
+        BuildkiteStep(label="Long", key="long", commands=["b"], agents={"queue": AgentQueue.AWS_1xL4.value}, depends_on="block-long"),
+        BuildkiteStep(label="Unknown", key="unknown", commands=["c"], agents={"queue": AgentQueue.AWS_1xL4.value}),
+        BuildkiteStep(label="A100", key="a100", commands=["d"], agents={"queue": AgentQueue.A100.value}),
+    ]
+    timing_database = TimingDatabase(steps={"short": 60, "long": 3600}, tests={"a100": {"t.py": 120}})
+    scheduled_steps = schedule_steps(steps, timing_database)
+    assert [step.key for step in scheduled_steps] == ["a100", "block-long", "long", "unknown", "short"]
+    # Unknown is ranked at the default duration, between Short and Long
+    assert [getattr(step, "priority", None) for step in scheduled_steps] == [1, None, 3, 2, 1]
+
+
+def test_simulator_cli():
+    jobs = [
+        {"key": "short", "queue": "q1", "duration": 10},
+        {"key": "short-2", "queue": "q1", "duration": 10},
+        {"key": "long", "queue": "q1", "duration": 40},
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        recorded_build = os.path.join(temp_dir, "build.json")
+        with open(recorded_build, "w") as f:
+            json.dump(jobs, f)
+        result = CliRunner().invoke(main, ["--recorded_build", recorded_build, "--agents", "q1=2"])
+    assert result.exit_code == 0
+    assert "makespan: 50s -> 40s" in result.output
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
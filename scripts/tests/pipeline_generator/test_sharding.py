@@ -0,0 +1,136 @@
+import os
+import pytest
+import subprocess
+import sys
+import tempfile
+
+from scripts.pipeline_generator.sharding import (
+    ShardPlan,
+    TimingDatabase,
+    get_shard_plan,
+    get_sharded_commands,
+    partition_tests,
+    read_timing_database,
+)
+from scripts.pipeline_generator.step import TestStep
+
+SHARDED_COMMAND = "pytest -v -s kernels --shard-id=$$BUILDKITE_PARALLEL_JOB --num-shards=$$BUILDKITE_PARALLEL_JOB_COUNT"
+
+
+def _get_sharded_test_step():
+    return TestStep(label="Kernels Test %N", parallelism=4, commands=[SHARDED_COMMAND])
+
+
+@pytest.mark.parametrize(
+    ("test_durations", "num_shards", "expected_result"),
+    [
+        ({"a": 10, "b": 8, "c": 6, "d": 4}, 2, [["a", "d"], ["b", "c"]]),
+        ({"a": 10, "b": 1, "c": 1, "d": 1}, 2, [["a"], ["b", "c", "d"]]),
+        ({"a": 5, "b": 5}, 3, [["a"], ["b"], []]),
+    ],
+)
+def test_partition_tests(test_durations, num_shards, expected_result):
+    assert partition_tests(test_durations, num_shards) == expected_result
+
+
+def test_get_shard_plan_not_shardable():
+    test_step = TestStep(label="Test", command="pytest -v -s basic_correctness")
+    timing_database = TimingDatabase(steps={"test": 10000})
+    assert get_shard_plan(test_step, "test", timing_database) is None
+
+
+def test_get_shard_plan_no_history():
+    assert get_shard_plan(_get_sharded_test_step(), "kernels-test-n", TimingDatabase()) is None
+
+
+@pytest.mark.parametrize(
+    ("step_duration", "expected_parallelism"),
+    [
+        (100, 1),
+        (3000, 3),
+        (100000, 8),
+    ],
+)
+def test_get_shard_plan_from_step_duration(step_duration, expected_parallelism):
+    timing_database = TimingDatabase(steps={"kernels-test-n": step_duration})
+    shard_plan = get_shard_plan(_get_sharded_test_step(), "kernels-test-n", timing_database, target_duration=1200)
+    assert shard_plan == ShardPlan(parallelism=expected_parallelism)
+
+
+def test_get_shard_plan_from_test_durations():
+    timing_database = TimingDatabase(
+        steps={"kernels-test-n": 10},
+        tests={"kernels-test-n": {"tests/kernels/test_a.py": 900, "tests/kernels/test_b.py": 700, "tests/kernels/test_c.py": 500}},
+    )
+    shard_plan = get_shard_plan(_get_sharded_test_step(), "kernels-test-n", timing_database, target_duration=1000)
+    assert shard_plan.parallelism == 3
+    assert shard_plan.shards == [["tests/kernels/test_a.py"], ["tests/kernels/test_b.py"], ["tests/kernels/test_c.py"]]
+
+
+def test_get_shard_plan_capped_by_number_of_tests():
+    timing_database = TimingDatabase(tests={"kernels-test-n": {"tests/kernels/test_a.py": 5000, "tests/kernels/test_b.py": 5000}})
+    shard_plan = get_shard_plan(_get_sharded_test_step(), "kernels-test-n", timing_database, target_duration=1000)
+    assert shard_plan.parallelism == 2
+
+
+def test_get_sharded_commands():
+    shard_plan = ShardPlan(parallelism=2, shards=[["tests/kernels/test_a.py"], ["tests/kernels/test_b.py::test_x[a b]"]])
+    commands = get_sharded_commands(["echo start", SHARDED_COMMAND], shard_plan)
+    assert commands == [
+        (
+            "case $$BUILDKITE_PARALLEL_JOB in "
+            "0) SHARD_DESELECT=(--deselect 'tests/kernels/test_b.py::test_x[a b]') ;; "
+            "1) SHARD_DESELECT=(--deselect tests/kernels/test_a.py::) ;; "
+            "esac"
+        ),
+        "echo start",
+        'pytest -v -s kernels "$${SHARD_DESELECT[@]}"',
+    ]
+
+
+def _run_sharded_pytest(root_dir, shard_plan, shard_index):
+    """Run the commands of one shard with real pytest from tests/, below the rootdir set by pyproject.toml."""
+    command = SHARDED_COMMAND.replace("pytest -v -s", f"{sys.executable} -m pytest -p no:cacheprovider --collect-only -q")
+    script = "\n".join(get_sharded_commands([command], shard_plan)).replace("$$", "$")
+    result = subprocess.run(
+        ["bash", "-c", script],
+        cwd=os.path.join(root_dir, "tests"),
+        env={**os.environ, "BUILDKITE_PARALLEL_JOB": str(shard_index), "BUILDKITE_PARALLEL_JOB_COUNT": "2"},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    return [line for line in result.stdout.splitlines() if "::" in line]
+
+
+def test_get_sharded_commands_with_pytest():
+    with tempfile.TemporaryDirectory() as root_dir:
+        with open(os.path.join(root_dir, "pyproject.toml"), "w") as f:
+            f.write("[tool.pytest.ini_options]\n")
+        os.makedirs(os.path.join(root_dir, "tests", "kernels"))
+        for name in ("test_a", "test_b"):
+            with open(os.path.join(root_dir, "tests", "kernels", f"{name}.py"), "w") as f:
+                f.write("def test_x():\n    pass\n\ndef test_y():\n    pass\n")
+        shard_plan = ShardPlan(parallelism=2, shards=[["tests/kernels/test_a.py"], ["tests/kernels/test_b.py::test_x"]])
+        # Tests without timings, here test_b.py::test_y, run in every shard
+        assert _run_sharded_pytest(root_dir, shard_plan, 0) == ["tests/kernels/test_a.py::test_x", "tests/kernels/test_a.py::test_y", "tests/kernels/test_b.py::test_y"]
+        assert _run_sharded_pytest(root_dir, shard_plan, 1) == ["tests/kernels/test_b.py::test_x", "tests/kernels/test_b.py::test_y"]
+
+
+def test_get_sharded_commands_without_shards():
+    commands = [SHARDED_COMMAND]
+    assert get_sharded_commands(commands, ShardPlan(parallelism=3)) == commands
+
+
+def test_read_timing_database():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "timings.json")
+        with open(file_path, "w") as f:
+            f.write('{"steps": {"a": 1.5}, "tests": {"a": {"t.py": 1.0}}}')
+        timing_database = read_timing_database(file_path)
+    assert timing_database.steps == {"a": 1.5}
+    assert timing_database.tests == {"a": {"t.py": 1.0}}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
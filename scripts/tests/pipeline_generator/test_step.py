@@ -2,8 +2,8 @@ import pytest
 import sys
 from pydantic import ValidationError
 
-from scripts.pipeline_generator.step import get_step_key, get_block_step, BuildkiteBlockStep, TestStep, DEFAULT_TEST_WORKING_DIR, BuildkiteStep
-from scripts.pipeline_generator.utils import AgentQueue, GPUType
+from scripts.pipeline_generator.step import get_step_key, get_block_step, get_working_dir, BuildkiteBlockStep, TestStep, DEFAULT_TEST_WORKING_DIR, BuildkiteStep
+from scripts.pipeline_generator.utils import AgentQueue, GPUType, ImageStage
 
 @pytest.mark.parametrize(
     ("step_label", "expected_result"),
@@ -18,6 +18,11 @@ def test_get_step_key(step_label: str, expected_result: str):
     assert get_step_key(step_label) == expected_result
 
 
+def test_get_step_key_without_collapsing_dashes():
+    assert get_step_key("Distributed Tests (4 GPUs)", collapse_dashes=False) == "distributed-tests-4-gpus"
+    assert get_step_key("Weight Loading Multiple GPU Test - Large Models", collapse_dashes=False) == "weight-loading-multiple-gpu-test---large-models"
+
+
 @pytest.mark.parametrize(
     ("step_label", "expected_result"),
     [
@@ -95,6 +100,18 @@ def test_create_test_step_multi_node():
     assert test_step.num_gpus == 2
     assert test_step.commands == ["echo 'hello1'", "echo 'hello2'"]
 
+def test_create_test_step_image_stage():
+    with pytest.raises(ValueError, match="does not exist in the base image stage"):
+        TestStep(label="Test Step", command="echo 'hello'", image_stage="base", working_dir="/vllm-workspace/tests")
+
+    test_step = TestStep(label="Test Step", command="echo 'hello'", image_stage="wheel")
+    assert get_working_dir(test_step, ImageStage.WHEEL) == "/workspace"
+    # Mirrors on other hardware run in the test image
+    assert get_working_dir(test_step, ImageStage.TEST) == DEFAULT_TEST_WORKING_DIR
+    test_step = TestStep(label="Test Step", command="echo 'hello'", image_stage="base", working_dir="/workspace/vllm")
+    assert get_working_dir(test_step, ImageStage.BASE) == "/workspace/vllm"
+
+
 def test_create_buildkite_step():
     buildkite_step = BuildkiteStep(
         label="Test Step",
@@ -104,7 +121,20 @@ def test_create_buildkite_step():
     assert buildkite_step.label == "Test Step"
     assert buildkite_step.key == "test-step"
     assert buildkite_step.agents == {"queue": AgentQueue.AWS_CPU}
-    assert buildkite_step.depends_on == "build"
+    assert buildkite_step.depends_on == ["build"]
+
+@pytest.mark.parametrize(
+    ("depends_on", "expected_result"),
+    [
+        ("build", "build"),
+        (["build"], "build"),
+        (["build", "build-base"], ["build", "build-base"]),
+        (None, None),
+    ],
+)
+def test_buildkite_step_depends_on(depends_on, expected_result):
+    buildkite_step = BuildkiteStep(label="Test Step", commands=["echo 'hello'"], depends_on=depends_on)
+    assert buildkite_step.model_dump()["depends_on"] == expected_result
 
 def test_create_buildkite_step_fail_no_command():
     with pytest.raises(ValidationError):
@@ -0,0 +1,101 @@
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import tempfile
+import yaml
+from click.testing import CliRunner
+
+from scripts.pipeline_generator.template_pipeline import (
+    get_ci_pipeline,
+    get_fastcheck_pipeline,
+    is_blocked,
+    main,
+    read_template_steps,
+    write_pipeline,
+)
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "test_files", "templates")
+
+
+def _read_golden_file(name):
+    """Pipeline rendered from the Jinja template with the same test pipeline."""
+    with open(os.path.join(TEMPLATES_DIR, name), "r") as f:
+        return yaml.safe_load(f)["steps"]
+
+
+@pytest.fixture
+def steps():
+    return read_template_steps(os.path.join(TEMPLATES_DIR, "test-pipeline.yaml"))
+
+
+@pytest.mark.parametrize(
+    ("golden_file", "branch", "list_file_diff", "nightly"),
+    [
+        ("ci-premerge.yaml", "feature", ["vllm/lora/layers.py", "docs/index.md"], False),
+        ("ci-nightly-main.yaml", "main", [], True),
+    ],
+)
+def test_get_ci_pipeline_matches_template(steps, golden_file, branch, list_file_diff, nightly):
+    pipeline = get_ci_pipeline(steps, branch, list_file_diff, run_all=False, nightly=nightly)
+    expected_pipeline = _read_golden_file(golden_file)
+    assert [step.get("key") or step.get("label") or step.get("group") for step in pipeline] == [
+        step.get("key") or step.get("label") or step.get("group") for step in expected_pipeline
+    ]
+    assert pipeline == expected_pipeline
+
+
+def test_get_fastcheck_pipeline_matches_template(steps):
+    assert get_fastcheck_pipeline(steps) == _read_golden_file("fastcheck.yaml")
+
+
+def test_get_ci_pipeline_s390x_branch(steps):
+    labels = [step.get("label") for step in get_ci_pipeline(steps, "s390x-fix", [], run_all=False, nightly=False)]
+    assert "IBM Z (s390x) CPU Test" in labels
+    assert "GH200 Test" not in labels
+
+
+@pytest.mark.parametrize(
+    ("step", "list_file_diff", "run_all", "nightly", "expected_result"),
+    [
+        ({"source_file_dependencies": ["vllm/lora"]}, ["vllm/lora/layers.py"], False, False, False),
+        ({"source_file_dependencies": ["vllm/lora"]}, ["vllm/config.py"], False, False, True),
+        ({"source_file_dependencies": ["vllm/lora"]}, [], True, False, False),
+        ({}, [], False, False, False),
+        ({"optional": True}, [], True, False, True),
+        ({"optional": True}, [], False, True, False),
+    ],
+)
+def test_is_blocked(step, list_file_diff, run_all, nightly, expected_result):
+    assert is_blocked(step, list_file_diff, run_all, nightly) == expected_result
+
+
+def test_write_pipeline(steps):
+    pipeline = get_ci_pipeline(steps, "feature", [], run_all=True, nightly=False)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "pipeline.yaml")
+        write_pipeline(pipeline, file_path)
+        with open(file_path, "r") as f:
+            content = f.read()
+    assert "&id" not in content
+    assert yaml.safe_load(content) == {"steps": pipeline}
+
+
+def test_main_without_main_branch(steps, monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # A clone without origin/main to diff against
+        subprocess.run(["git", "init", "-q"], cwd=temp_dir, check=True)
+        os.makedirs(os.path.join(temp_dir, ".buildkite"))
+        shutil.copy(os.path.join(TEMPLATES_DIR, "test-pipeline.yaml"), temp_dir)
+        monkeypatch.chdir(temp_dir)
+        monkeypatch.setenv("BUILDKITE_BRANCH", "feature")
+        result = CliRunner().invoke(main, ["--pipeline", "ci", "--test_path", "test-pipeline.yaml"])
+        assert result.exit_code == 0, result.output
+        assert "Could not diff against origin/main" in result.output
+        with open(os.path.join(".buildkite", "pipeline.yaml"), "r") as f:
+            assert yaml.safe_load(f)["steps"] == get_ci_pipeline(steps, "feature", [], run_all=True, nightly=False)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -1,5 +1,9 @@
+import os
 import pytest
+import shlex
+import subprocess
 import sys
+import tarfile
 from typing import List
 
 from scripts.pipeline_generator.utils import (
@@ -7,9 +11,13 @@ from scripts.pipeline_generator.utils import (
     get_full_test_command,
     get_multi_node_test_command,
     AgentQueue,
-    MULTI_NODE_TEST_SCRIPT,
+    MULTI_NODE_LAUNCHER,
+    PROFILER_SCRIPT,
     TEST_DEFAULT_COMMANDS,
+    get_generator_download_commands,
+    upload_generator_artifact,
 )
+from scripts.pipeline_generator.multi_node import MultiNodeSpec
 
 TEST_DEFAULT_COMMANDS_STR = ";\n".join(TEST_DEFAULT_COMMANDS)
 
@@ -38,6 +46,19 @@ def test_get_full_test_command(test_commands: List[str], step_working_dir: str,
     assert get_full_test_command(test_commands, step_working_dir) == expected_result
 
 
+def test_get_full_test_command_with_profile():
+    command = get_full_test_command(["echo 'hello'"], None, "profile-test-$$BUILDKITE_PARALLEL_JOB")
+    python, profiler, *options, bash, bash_option, full_test_command = shlex.split(command)
+    assert (python, profiler, bash, bash_option) == ("python3", PROFILER_SCRIPT, "bash", "-c")
+    assert options == ["--artifact", "--name", "profile-test-$$BUILDKITE_PARALLEL_JOB", "--"]
+    assert full_test_command == (
+        'echo "setup $(date +%s.%N)" >> "$$PROFILE_PHASE_FILE";\n'
+        f"{TEST_DEFAULT_COMMANDS_STR};\ncd /vllm-workspace/tests;\n"
+        'echo "test $(date +%s.%N)" >> "$$PROFILE_PHASE_FILE";\n'
+        "echo 'hello'"
+    )
+
+
 def test_get_multi_node_test_command():
     test_commands = [
         (
@@ -45,23 +66,38 @@ def test_get_multi_node_test_command():
             "pytest -v -s distributed/test_multi_node_assignment.py;"
             "pytest -v -s distributed/test_pipeline_parallel.py"
         ),
-        "distributed/test_same_node.py",
+        "VLLM_TEST='a b' pytest -v -s distributed/test_same_node.py -k \"not ray\"",
     ]
     working_dir = "/vllm-workspace/tests"
     num_nodes = 2
     num_gpus = 4
     docker_image_path = "ecr-path/vllm-ci-test-repo:latest"
-    expected_multi_node_command = [
-        MULTI_NODE_TEST_SCRIPT,
-        working_dir,
-        num_nodes,
-        num_gpus,
-        docker_image_path,
-        f"'{test_commands[0]}'",
-        f"'{test_commands[1]}'",
-    ]
-    expected_result = " ".join(map(str, expected_multi_node_command))
-    assert get_multi_node_test_command(test_commands, working_dir, num_nodes, num_gpus, docker_image_path) == expected_result
+    command = get_multi_node_test_command(test_commands, working_dir, num_nodes, num_gpus, docker_image_path)
+    python, launcher, option, spec = shlex.split(command)
+    assert (python, launcher, option) == ("python3", MULTI_NODE_LAUNCHER, "--spec")
+    assert MultiNodeSpec.from_json(spec) == MultiNodeSpec(
+        num_nodes=num_nodes,
+        num_gpus=num_gpus,
+        commands=test_commands,
+        working_dir=working_dir,
+        image=docker_image_path,
+    )
+
+
+def test_upload_generator_artifact(monkeypatch, tmp_path):
+    def run(command, cwd, check):
+        assert command == ["buildkite-agent", "artifact", "upload", "pipeline_generator.tar.gz"]
+        with tarfile.open(os.path.join(cwd, command[-1])) as tar:
+            tar.extractall(tmp_path)
+
+    monkeypatch.setattr(subprocess, "run", run)
+    upload_generator_artifact()
+    assert (tmp_path / "pipeline_generator" / "result_cache.py").exists()
+    assert not (tmp_path / "pipeline_generator" / "__pycache__").exists()
+    # The commands of a step extract it where python -m finds the package
+    download_command, extract_command = get_generator_download_commands(".generator")
+    assert download_command == "mkdir -p .generator && buildkite-agent artifact download pipeline_generator.tar.gz .generator"
+    assert extract_command == "tar xzf .generator/pipeline_generator.tar.gz -C .generator"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+import gzip
+import io
+import json
+import os
+import pytest
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+from scripts.usage_stats.compaction import (
+    LocalStorage,
+    S3Storage,
+    Storage,
+    compact,
+    get_columns,
+    get_parquet_key,
+    get_partition,
+    get_storage,
+    infer_schema,
+    is_complete,
+    main,
+    read_events,
+)
+
+HOUR = "year=2024/month=08/day=01/hour=09/"
+NOW = datetime(2024, 8, 1, 12, tzinfo=timezone.utc).timestamp()
+EVENTS = [
+    {"uuid": "a", "vllm_version": "0.5.3", "gpu_count": 1, "gpu_memory_utilization": 0.9, "enable_lora": False},
+    {"uuid": "b", "vllm_version": "0.5.4", "gpu_count": 8, "gpu_memory_utilization": 1, "quantization": None},
+    {"uuid": "c", "gpu_count": "unknown", "context": {"source": "docker"}, "quantization": "fp8"},
+]
+
+
+class FakeS3Client:
+    """In-memory stand-in for a boto3 S3 client, listing one object per page."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        keys = sorted(key for (bucket, key) in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        response = {"Contents": [{"Key": key} for key in keys[start:start + 1]], "IsTruncated": start + 1 < len(keys)}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + 1)
+        return response
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[(Bucket, Key)]
+
+
+def _batch(events, compress=True):
+    data = "".join(json.dumps(event) + "\n" for event in events).encode()
+    return gzip.compress(data) if compress else data
+
+
+@pytest.fixture
+def storage():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield LocalStorage(temp_dir)
+
+
+def test_local_storage(storage):
+    storage.write("raw/a/1.log.gz", b"1")
+    storage.write("raw/b/2.log.gz", b"2")
+    storage.write("parquet/c.parquet", b"3")
+    assert storage.list("raw/") == ["raw/a/1.log.gz", "raw/b/2.log.gz"]
+    assert storage.read("raw/b/2.log.gz") == b"2"
+    storage.delete("raw/a/1.log.gz")
+    assert storage.list("") == ["parquet/c.parquet", "raw/b/2.log.gz"]
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_s3_storage():
+    client = FakeS3Client()
+    storage = S3Storage("bucket", "usage/", client=client)
+    for index in range(3):
+        storage.write(f"raw/{index}.log.gz", str(index).encode())
+    client.put_object(Bucket="bucket", Key="other/raw/3.log.gz", Body=b"3")
+    assert storage.list("raw/") == ["raw/0.log.gz", "raw/1.log.gz", "raw/2.log.gz"]
+    assert storage.read("raw/1.log.gz") == b"1"
+    storage.delete("raw/1.log.gz")
+    assert ("bucket", "usage/raw/1.log.gz") not in client.objects
+
+
+def test_get_storage():
+    assert isinstance(get_storage("/data/usage-stats"), LocalStorage)
+    assert get_storage("file:///data/usage-stats").directory == "/data/usage-stats"
+
+
+def test_get_partition():
+    assert get_partition(f"raw/{HOUR}1722502800-abc.log.gz") == (2024, 8, 1, 9)
+    assert get_partition("year=2024/1722502800-abc.log") is None
+
+
+def test_is_complete():
+    assert is_complete((2024, 8, 1, 10), NOW, min_age=15 * 60)
+    assert not is_complete((2024, 8, 1, 11), NOW, min_age=15 * 60)
+    assert not is_complete((2024, 8, 1, 10), NOW, min_age=3600 + 1)
+
+
+def test_read_events():
+    assert read_events(_batch(EVENTS)) == (EVENTS, 0)
+    assert read_events(_batch(EVENTS[:1], compress=False) + b"\n{\n[1]\n") == (EVENTS[:1], 2)
+    # Concatenated gzip members, as appended by the file sink
+    assert read_events(_batch(EVENTS[:1]) + _batch(EVENTS[1:])) == (EVENTS, 0)
+
+
+def test_infer_schema():
+    assert infer_schema(EVENTS) == {
+        "uuid": "string",
+        "vllm_version": "string",
+        "gpu_count": "string",
+        "gpu_memory_utilization": "float64",
+        "enable_lora": "bool",
+        "quantization": "string",
+        "context": "string",
+    }
+    assert infer_schema([{"a": None}, {"a": 1, "b": True}, {"a": None, "b": None}]) == {"a": "int64", "b": "bool"}
+    assert infer_schema([{"a": None}]) == {"a": "null"}
+    # Widened from an earlier schema, in its order
+    assert infer_schema([{"b": 1.5, "a": None}], {"a": "int64", "b": "int64"}) == {"a": "int64", "b": "float64"}
+    assert infer_schema([{"b": "x"}], {"a": "null", "b": "float64"}) == {"a": "null", "b": "string"}
+    # Booleans are not numbers
+    assert infer_schema([{"a": 1}, {"a": True}]) == {"a": "string"}
+
+
+def test_get_columns():
+    columns = get_columns(EVENTS, infer_schema(EVENTS))
+    assert columns["gpu_count"] == ["1", "8", "unknown"]
+    assert columns["gpu_memory_utilization"] == [0.9, 1.0, None]
+    assert columns["enable_lora"] == [False, None, None]
+    assert columns["context"] == [None, None, '{"source":"docker"}']
+
+
+def test_get_parquet_key():
+    key = get_parquet_key((2024, 8, 1, 9), ["raw/b", "raw/a"])
+    assert key.startswith(f"parquet/{HOUR}part-") and key.endswith(".parquet")
+    assert key == get_parquet_key((2024, 8, 1, 9), ["raw/a", "raw/b"])
+    assert key != get_parquet_key((2024, 8, 1, 9), ["raw/a"])
+
+
+def test_compact(storage):
+    pq = pytest.importorskip("pyarrow.parquet")
+    storage.write(f"raw/{HOUR}1722502800-a.log.gz", _batch(EVENTS[:2]))
+    storage.write(f"raw/{HOUR}1722503100-b.log.gz", _batch(EVENTS[2:]))
+    storage.write("raw/year=2024/month=08/day=01/hour=11/1722510000-c.log.gz", _batch(EVENTS))
+    written = compact(storage, now=NOW)
+    assert written == [get_parquet_key((2024, 8, 1, 9), [f"raw/{HOUR}1722502800-a.log.gz", f"raw/{HOUR}1722503100-b.log.gz"])]
+    # The incomplete hour is left for a later run
+    assert storage.list("raw/") == ["raw/year=2024/month=08/day=01/hour=11/1722510000-c.log.gz"]
+    table = pq.read_table(io.BytesIO(storage.read(written[0])))
+    assert table.column_names == list(infer_schema(EVENTS))
+    assert table.column("uuid").to_pylist() == ["a", "b", "c"]
+    assert str(table.schema.field("gpu_memory_utilization").type) == "double"
+
+
+def test_compact_keep_raw(storage):
+    pytest.importorskip("pyarrow")
+    storage.write(f"raw/{HOUR}1722502800-a.log.gz", _batch(EVENTS))
+    first = compact(storage, now=NOW, keep_raw=True)
+    # The manifest of the kept batches records that they are compacted
+    assert compact(storage, now=NOW, keep_raw=True) == []
+    assert [key for key in storage.list("parquet/") if key.endswith(".parquet")] == first
+    assert storage.list("raw/") == [f"raw/{HOUR}1722502800-a.log.gz"]
+    # Without --keep_raw, they are deleted, not compacted again
+    assert compact(storage, now=NOW) == []
+    assert storage.list("") == ["parquet/_schema.json", *first]
+
+
+def test_compact_widens_schema_across_hours(storage):
+    pq = pytest.importorskip("pyarrow.parquet")
+    storage.write(f"raw/{HOUR}1722502800-a.log.gz", _batch([{"uuid": "a", "gpu_count": 1, "quantization": None, "tensor_parallel_size": None}]))
+    (first,) = compact(storage, now=NOW)
+    next_hour = "raw/year=2024/month=08/day=01/hour=10/1722506400-b.log.gz"
+    storage.write(next_hour, _batch([{"uuid": "b", "gpu_count": "unknown", "quantization": "fp8", "tensor_parallel_size": 2, "dtype": "bf16"}]))
+    (second,) = compact(storage, now=NOW)
+    schema = {"uuid": "string", "gpu_count": "string", "quantization": "string", "tensor_parallel_size": "int64", "dtype": "string"}
+    assert json.loads(storage.read("parquet/_schema.json")) == schema
+    # The file of the first hour is rewritten with the wider schema
+    assert pq.read_table(io.BytesIO(storage.read(first))).schema.equals(pq.read_table(io.BytesIO(storage.read(second))).schema)
+    table = pq.read_table(os.path.join(storage.directory, "parquet")).sort_by("uuid")
+    assert table.select(list(schema)).to_pylist() == [
+        {"uuid": "a", "gpu_count": "1", "quantization": None, "tensor_parallel_size": None, "dtype": None},
+        {"uuid": "b", "gpu_count": "unknown", "quantization": "fp8", "tensor_parallel_size": 2, "dtype": "bf16"},
+    ]
+
+
+def test_compact_interrupted_while_deleting(storage):
+    pq = pytest.importorskip("pyarrow.parquet")
+    raw_keys = [f"raw/{HOUR}1722502800-a.log.gz", f"raw/{HOUR}1722503100-b.log.gz"]
+    storage.write(raw_keys[0], _batch(EVENTS[:2]))
+    storage.write(raw_keys[1], _batch(EVENTS[2:]))
+    delete = storage.delete
+
+    def interrupted_delete(key):
+        if key == raw_keys[1]:
+            raise KeyboardInterrupt
+        delete(key)
+
+    storage.delete = interrupted_delete
+    with pytest.raises(KeyboardInterrupt):
+        compact(storage, now=NOW)
+    storage.delete = delete
+    assert storage.list("raw/") == raw_keys[1:]
+    schema_key, manifest_key, parquet_key = storage.list("parquet/")
+    assert f"{HOUR}_manifest-" in manifest_key
+    # The next run deletes the compacted batch left over, without writing its events again
+    assert compact(storage, now=NOW) == []
+    assert storage.list("") == [schema_key, parquet_key]
+    assert pq.read_table(io.BytesIO(storage.read(parquet_key))).num_rows == len(EVENTS)
+
+
+def test_compact_without_events(storage):
+    storage.write(f"raw/{HOUR}1722502800-a.log.gz", gzip.compress(b"not json\n"))
+    assert compact(storage, now=NOW) == []
+    assert storage.list("") == []
+
+
+def test_main(storage):
+    pytest.importorskip("pyarrow")
+    storage.write(f"raw/{HOUR}1722502800-a.log.gz", _batch(EVENTS))
+    assert main(["--storage", storage.directory, "--output_prefix", "compacted/"]) == 0
+    assert len(storage.list(f"compacted/{HOUR}")) == 1
+    assert storage.list("raw/") == []
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,422 @@
+"""
+Compaction of the raw usage stats into Parquet.
+
+Vector writes the usage events as gzip-compressed NDJSON batches under
+raw/year=%Y/month=%m/day=%d/hour=%H/. Once an hour is complete, this job rewrites all its batches as a
+single Parquet file under parquet/ with the same partitioning, and deletes them. A manifest of the
+batches, written before deleting them, lets a run interrupted meanwhile be redone without compacting
+the same events twice.
+
+The Parquet schema is inferred from the events: booleans, integers, floats and strings, integers mixed
+with floats being floats, nested or conflicting values JSON-encoded strings, and always null fields null.
+The schema of the dataset is kept in _schema.json under the Parquet prefix and widened by the events of
+each hour. When it changes, the files written before are rewritten with it, so that all files of the
+dataset have the same schema and can be read together.
+
+Only pyarrow is needed besides the standard library, and only to write Parquet; google-cloud-storage
+and boto3 are only needed for their storage.
+
+Usage: python3 -m usage_stats.compaction --storage (gs://bucket | s3://bucket/prefix | DIR) [--interval SECONDS]
+"""
+import abc
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import posixpath
+import re
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+RAW_PREFIX = "raw/"
+PARQUET_PREFIX = "parquet/"
+MANIFEST_PREFIX = "_manifest-"
+SCHEMA_FILE = "_schema.json"
+# Vector flushes a batch at the latest 5 minutes after its first event, an hour is compacted after that
+MIN_AGE = 15 * 60  # seconds
+PARTITION_PATTERN = re.compile(r"year=(\d{4})/month=(\d{2})/day=(\d{2})/hour=(\d{2})/")
+GZIP_MAGIC = b"\x1f\x8b"
+BOOL_TYPE = "bool"
+INT_TYPE = "int64"
+FLOAT_TYPE = "float64"
+STRING_TYPE = "string"
+NULL_TYPE = "null"
+
+Partition = Tuple[int, int, int, int]
+
+
+class Storage(abc.ABC):
+    """Objects under `/`-separated keys: a bucket, or a directory for local testing."""
+
+    @abc.abstractmethod
+    def list(self, prefix: str) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    def read(self, key: str) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    def write(self, key: str, data: bytes) -> None:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+
+class LocalStorage(Storage):
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, *key.split("/"))
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                key = os.path.relpath(os.path.join(root, file), self.directory).replace(os.sep, "/")
+                if key.startswith(prefix) and not file.endswith(".tmp"):
+                    keys.append(key)
+        return sorted(keys)
+
+    def read(self, key: str) -> bytes:
+        with open(self._get_path(key), "rb") as f:
+            return f.read()
+
+    def write(self, key: str, data: bytes) -> None:
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a concurrent reader never sees a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def delete(self, key: str) -> None:
+        os.remove(self._get_path(key))
+
+
+class S3Storage(Storage):
+    """
+    An S3-compatible bucket, e.g. a MinIO server standing in for GCS.
+    `client` is a boto3 S3 client, created from the environment if not given.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", client=None, endpoint_url: Optional[str] = None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _get_key(self, key: str) -> str:
+        return posixpath.join(self.prefix, key)
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        options = {"Bucket": self.bucket, "Prefix": self._get_key(prefix)}
+        while True:
+            response = self.client.list_objects_v2(**options)
+            keys.extend(item["Key"][len(self.prefix) + 1 if self.prefix else 0:] for item in response.get("Contents", []))
+            if not response.get("IsTruncated"):
+                return sorted(keys)
+            options["ContinuationToken"] = response["NextContinuationToken"]
+
+    def read(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=self._get_key(key))["Body"].read()
+
+    def write(self, key: str, data: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self._get_key(key), Body=data)
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._get_key(key))
+
+
+class GcsStorage(Storage):
+    """A GCS bucket. `client` is a google-cloud-storage client, created from the environment if not given."""
+
+    def __init__(self, bucket: str, prefix: str = "", client=None):
+        if client is None:
+            from google.cloud import storage
+            client = storage.Client()
+        self.bucket = client.bucket(bucket)
+        self.prefix = prefix.strip("/")
+
+    def _get_key(self, key: str) -> str:
+        return posixpath.join(self.prefix, key)
+
+    def list(self, prefix: str) -> List[str]:
+        start = len(self.prefix) + 1 if self.prefix else 0
+        return sorted(blob.name[start:] for blob in self.bucket.list_blobs(prefix=self._get_key(prefix)))
+
+    def read(self, key: str) -> bytes:
+        return self.bucket.blob(self._get_key(key)).download_as_bytes()
+
+    def write(self, key: str, data: bytes) -> None:
+        self.bucket.blob(self._get_key(key)).upload_from_string(data)
+
+    def delete(self, key: str) -> None:
+        self.bucket.blob(self._get_key(key)).delete()
+
+
+def get_storage(url: str) -> Storage:
+    """
+    Open a storage from its URL: `gs://bucket/prefix`, `s3://bucket/prefix` (endpoint from
+    AWS_ENDPOINT_URL for S3-compatible services such as MinIO) or a local directory path.
+    """
+    if url.startswith("gs://"):
+        bucket, _, prefix = url[len("gs://"):].partition("/")
+        return GcsStorage(bucket, prefix)
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3Storage(bucket, prefix, endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
+    return LocalStorage(url[len("file://"):] if url.startswith("file://") else url)
+
+
+def get_partition(key: str) -> Optional[Partition]:
+    """(year, month, day, hour) of a key, None outside the hourly partitions."""
+    match = PARTITION_PATTERN.search(key)
+    return tuple(int(value) for value in match.groups()) if match else None
+
+
+def get_partition_prefix(partition: Partition) -> str:
+    year, month, day, hour = partition
+    return f"year={year:04d}/month={month:02d}/day={day:02d}/hour={hour:02d}/"
+
+
+def is_complete(partition: Partition, now: float, min_age: float = MIN_AGE) -> bool:
+    """Whether Vector has flushed every batch of the hour."""
+    hour_start = datetime(*partition, tzinfo=timezone.utc).timestamp()
+    return hour_start + 3600 + min_age <= now
+
+
+def read_events(data: bytes) -> Tuple[List[Dict], int]:
+    """Events of a batch, gzip-compressed or not, and the number of lines that are not JSON objects."""
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    events, invalid_lines = [], 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            event = None
+        if isinstance(event, dict):
+            events.append(event)
+        else:
+            invalid_lines += 1
+    return events, invalid_lines
+
+
+def _get_value_type(value) -> str:
+    if value is None:
+        return NULL_TYPE
+    if isinstance(value, bool):
+        return BOOL_TYPE
+    if isinstance(value, int):
+        return INT_TYPE
+    if isinstance(value, float):
+        return FLOAT_TYPE
+    return STRING_TYPE
+
+
+def _widen_type(current_type: str, value_type: str) -> str:
+    """Type of the values of both types."""
+    if current_type == value_type or value_type == NULL_TYPE:
+        return current_type
+    if current_type == NULL_TYPE:
+        return value_type
+    if {current_type, value_type} == {INT_TYPE, FLOAT_TYPE}:
+        return FLOAT_TYPE
+    return STRING_TYPE
+
+
+def infer_schema(events: Iterable[Dict], schema: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Type of each field, in order of first appearance, widened from the types of `schema`."""
+    schema = dict(schema or {})
+    for event in events:
+        for name, value in event.items():
+            schema[name] = _widen_type(schema.get(name, NULL_TYPE), _get_value_type(value))
+    return schema
+
+
+def _convert(value, value_type: str):
+    if value is None:
+        return None
+    if value_type == FLOAT_TYPE:
+        return float(value)
+    if value_type == STRING_TYPE and not isinstance(value, str):
+        return json.dumps(value, separators=(",", ":"), sort_keys=True)
+    return value
+
+
+def get_columns(events: List[Dict], schema: Dict[str, str]) -> Dict[str, List]:
+    """Values of each field of the schema, null where an event does not have it."""
+    return {
+        name: [_convert(event.get(name), value_type) for event in events]
+        for name, value_type in schema.items()
+    }
+
+
+def _get_arrow_schema(schema: Dict[str, str]):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("Writing Parquet requires pyarrow, install it with `pip install pyarrow`")
+    arrow_types = {BOOL_TYPE: pa.bool_(), INT_TYPE: pa.int64(), FLOAT_TYPE: pa.float64(), STRING_TYPE: pa.string(), NULL_TYPE: pa.null()}
+    return pa.schema([(name, arrow_types[value_type]) for name, value_type in schema.items()])
+
+
+def write_parquet(events: List[Dict], schema: Dict[str, str]) -> bytes:
+    arrow_schema = _get_arrow_schema(schema)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = get_columns(events, schema)
+    table = pa.table({field.name: pa.array(columns[field.name], type=field.type) for field in arrow_schema}, schema=arrow_schema)
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd")
+    return buffer.getvalue()
+
+
+def get_schema_key(output_prefix: str = PARQUET_PREFIX) -> str:
+    return f"{output_prefix}{SCHEMA_FILE}"
+
+
+def read_schema(storage: Storage, output_prefix: str = PARQUET_PREFIX) -> Dict[str, str]:
+    """Schema of the Parquet files written so far, empty before the first one."""
+    schema_key = get_schema_key(output_prefix)
+    if schema_key not in storage.list(schema_key):
+        return {}
+    return json.loads(storage.read(schema_key))
+
+
+def rewrite_parquet(storage: Storage, schema: Dict[str, str], output_prefix: str = PARQUET_PREFIX) -> List[str]:
+    """Rewrite the Parquet files of another schema with a wider one, and return the files rewritten."""
+    arrow_schema = _get_arrow_schema(schema)
+    import pyarrow.parquet as pq
+    rewritten = []
+    for key in storage.list(output_prefix):
+        if not key.endswith(".parquet"):
+            continue
+        table = pq.read_table(io.BytesIO(storage.read(key)))
+        if table.schema.equals(arrow_schema):
+            continue
+        storage.write(key, write_parquet(table.to_pylist(), schema))
+        rewritten.append(key)
+    return rewritten
+
+
+def _get_digest(raw_keys: List[str]) -> str:
+    return hashlib.sha256("\n".join(sorted(raw_keys)).encode()).hexdigest()[:16]
+
+
+def get_parquet_key(partition: Partition, raw_keys: List[str], output_prefix: str = PARQUET_PREFIX) -> str:
+    return f"{output_prefix}{get_partition_prefix(partition)}part-{_get_digest(raw_keys)}.parquet"
+
+
+def get_manifest_key(partition: Partition, raw_keys: List[str], output_prefix: str = PARQUET_PREFIX) -> str:
+    """Raw batches of a Parquet file, "_" prefixed so that Parquet readers skip it."""
+    return f"{output_prefix}{get_partition_prefix(partition)}{MANIFEST_PREFIX}{_get_digest(raw_keys)}.json"
+
+
+def _delete_compacted(storage: Storage, partition: Partition, raw_keys: List[str], output_prefix: str, keep_raw: bool) -> List[str]:
+    """
+    Delete the batches a run interrupted while deleting them had already compacted, and return
+    the batches left to compact.
+    """
+    compacted = set()
+    for manifest_key in storage.list(f"{output_prefix}{get_partition_prefix(partition)}{MANIFEST_PREFIX}"):
+        manifest_raw_keys = json.loads(storage.read(manifest_key))
+        compacted.update(manifest_raw_keys)
+        if keep_raw:
+            continue
+        for key in manifest_raw_keys:
+            if key in raw_keys:
+                storage.delete(key)
+        storage.delete(manifest_key)
+    return [key for key in raw_keys if key not in compacted]
+
+
+def compact(
+        storage: Storage,
+        now: Optional[float] = None,
+        min_age: float = MIN_AGE,
+        raw_prefix: str = RAW_PREFIX,
+        output_prefix: str = PARQUET_PREFIX,
+        keep_raw: bool = False,
+    ) -> List[str]:
+    """
+    Rewrite the raw batches of every complete hour as one Parquet file, and return the files written.
+
+    After writing a Parquet file, a manifest of its batches is written next to it. Unless the batches
+    are kept, the manifest is removed once they are all deleted: a run interrupted in between leaves it,
+    and the next run deletes the batches it lists instead of compacting their events a second time.
+    Kept batches are not compacted again as long as their manifest is there.
+    """
+    now = time.time() if now is None else now
+    partitions: Dict[Partition, List[str]] = {}
+    for key in storage.list(raw_prefix):
+        partition = get_partition(key[len(raw_prefix):])
+        if partition and is_complete(partition, now, min_age):
+            partitions.setdefault(partition, []).append(key)
+    written = []
+    schema = read_schema(storage, output_prefix)
+    for partition, raw_keys in sorted(partitions.items()):
+        raw_keys = _delete_compacted(storage, partition, raw_keys, output_prefix, keep_raw)
+        if not raw_keys:
+            continue
+        events, invalid_lines = [], 0
+        for key in raw_keys:
+            batch_events, batch_invalid_lines = read_events(storage.read(key))
+            events.extend(batch_events)
+            invalid_lines += batch_invalid_lines
+        if invalid_lines:
+            print(f"{get_partition_prefix(partition)}: skipped {invalid_lines} lines that are not JSON objects", file=sys.stderr)
+        if events:
+            events_schema = infer_schema(events, schema)
+            if events_schema != schema:
+                # Rewritten before the schema is saved, so that a run interrupted meanwhile is redone
+                for key in rewrite_parquet(storage, events_schema, output_prefix):
+                    print(f"{key}: rewritten with the wider schema")
+                storage.write(get_schema_key(output_prefix), json.dumps(events_schema).encode())
+                schema = events_schema
+            parquet_key = get_parquet_key(partition, raw_keys, output_prefix)
+            storage.write(parquet_key, write_parquet(events, schema))
+            written.append(parquet_key)
+            print(f"{parquet_key}: {len(events)} events from {len(raw_keys)} batches")
+        manifest_key = get_manifest_key(partition, raw_keys, output_prefix)
+        storage.write(manifest_key, json.dumps(raw_keys).encode())
+        if not keep_raw:
+            for key in raw_keys:
+                storage.delete(key)
+            storage.delete(manifest_key)
+    return written
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Rewrite the raw usage stats of complete hours as Parquet.")
+    parser.add_argument("--storage", type=str, required=True, help="gs://bucket/prefix, s3://bucket/prefix or a local directory")
+    parser.add_argument("--raw_prefix", type=str, default=RAW_PREFIX, help="Prefix of the raw NDJSON batches")
+    parser.add_argument("--output_prefix", type=str, default=PARQUET_PREFIX, help="Prefix of the Parquet files")
+    parser.add_argument("--min_age", type=float, default=MIN_AGE, help="Seconds after the end of an hour before it is compacted")
+    parser.add_argument("--keep_raw", action="store_true", help="Keep the raw batches once compacted")
+    parser.add_argument("--interval", type=float, help="If set, compact again every this many seconds until stopped")
+    args = parser.parse_args(argv)
+    storage = get_storage(args.storage)
+    while True:
+        compact(storage, min_age=args.min_age, raw_prefix=args.raw_prefix, output_prefix=args.output_prefix, keep_raw=args.keep_raw)
+        if not args.interval:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())